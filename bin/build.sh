@@ -0,0 +1,14 @@
+#!/usr/bin/env bash
+
+# Renders each environment file given into build/<name>/, in parallel and
+# skipping unchanged ones; see tools/matrix.py for the file format
+SCRIPT_PATH="${BASH_SOURCE[0]}";
+if ([ -h "${SCRIPT_PATH}" ]) then
+  while([ -h "${SCRIPT_PATH}" ]) do SCRIPT_PATH=`readlink "${SCRIPT_PATH}"`; done
+fi
+pushd . > /dev/null
+cd `dirname ${SCRIPT_PATH}` > /dev/null
+SCRIPT_PATH=`pwd`;
+popd  > /dev/null
+
+cd $SCRIPT_PATH/.. && python -m tools.matrix "$@"
@@ -12,8 +12,41 @@ popd  > /dev/null
 
 WORKING_DIR=$SCRIPT_PATH/../build
 
+# Nested stacks can only be deployed from S3, so stop before building them
+case $(echo "$BIGID_NESTED_STACKS" | tr -d '[:space:]' | tr '[:upper:]' '[:lower:]') in
+  1|true|yes|on)
+    if [ -z "$BIGID_TEMPLATE_BUCKET" ]; then
+      echo "BIGID_NESTED_STACKS needs BIGID_TEMPLATE_BUCKET to upload the nested templates to" >&2
+      exit 1
+    fi
+    ;;
+esac
+
 if [ -d "$WORKING_DIR" ]; then rm -Rf $WORKING_DIR; fi
 mkdir $WORKING_DIR
-python $SCRIPT_PATH/../create.py > ${WORKING_DIR}/${STACK_NAME}.cfn.json
+BIGID_BUILD_DIR=$WORKING_DIR python $SCRIPT_PATH/../create.py > ${WORKING_DIR}/${STACK_NAME}.cfn.json
+TEMPLATE=${WORKING_DIR}/${STACK_NAME}.cfn.json
+
+# Stops before deploying tasks that fit none of the container instances
+(cd $SCRIPT_PATH/.. && python -m tools.capacity $WORKING_DIR --parameters params.json) || exit 1
+
+# Nested stacks (BIGID_NESTED_STACKS) reference their children by local
+# path; package uploads them and rewrites the references to S3
+if [ -n "$BIGID_TEMPLATE_BUCKET" ]; then
+  aws cloudformation package --use-json --template-file $TEMPLATE --s3-bucket $BIGID_TEMPLATE_BUCKET --output-template-file ${WORKING_DIR}/${STACK_NAME}.packaged.cfn.json
+  TEMPLATE=${WORKING_DIR}/${STACK_NAME}.packaged.cfn.json
+fi
+
+# Past the --template-body limit the template is read from S3 instead
+TEMPLATE_SOURCE="--template-body file://${TEMPLATE}"
+if [ $(wc -c < $TEMPLATE) -gt 51200 ]; then
+  if [ -z "$BIGID_TEMPLATE_BUCKET" ]; then
+    echo "${TEMPLATE} is over the 51200-byte --template-body limit; set BIGID_TEMPLATE_BUCKET to deploy it from S3" >&2
+    exit 1
+  fi
+  TEMPLATE_KEY=${STACK_NAME}/$(date -u +%Y%m%dT%H%M%SZ).cfn.json
+  aws s3 cp $TEMPLATE s3://${BIGID_TEMPLATE_BUCKET}/${TEMPLATE_KEY} || exit 1
+  TEMPLATE_SOURCE="--template-url https://${BIGID_TEMPLATE_BUCKET}.s3.amazonaws.com/${TEMPLATE_KEY}"
+fi
 
-aws cloudformation create-stack --disable-rollback --stack-name $STACK_NAME --template-body file://${WORKING_DIR}/${STACK_NAME}.cfn.json --parameters file://${SCRIPT_PATH}/../params.json --capabilities CAPABILITY_IAM
+aws cloudformation create-stack --disable-rollback --stack-name $STACK_NAME $TEMPLATE_SOURCE --parameters file://${SCRIPT_PATH}/../params.json --capabilities CAPABILITY_IAM
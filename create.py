@@ -1,7 +1,25 @@
-from stack.template import template
-from stack.vpc import vpc_id
-from stack.cluster.infrastructure import main_cluster
-from stack.cluster.mongo import mongo_instance
-from stack.cluster.main import bigid_task_definition
+import os
+import sys
 
-print(template.to_json())
\ No newline at end of file
+from stack.config import Config
+from stack.template import render_template, size_report
+
+config = Config.from_environ()
+
+# Profiling hooks, see tools/bench.py
+profile = os.environ.get("BIGID_PROFILE")
+tracemalloc_top = int(os.environ.get("BIGID_TRACEMALLOC", "0"))
+if profile or tracemalloc_top:
+    from tools.bench import profiled
+    template, nested = profiled(lambda: render_template(config), profile,
+                                tracemalloc_top)
+else:
+    template, nested = render_template(config)
+
+for name, child in nested.items():
+    with open(os.path.join(config.build_dir, name), "w") as f:
+        f.write(child)
+print(template)
+
+for line in size_report(template, nested):
+    sys.stderr.write(line + "\n")
@@ -0,0 +1,72 @@
+from troposphere import Ref
+
+# UserData prelude. boot_mark logs a step with the seconds since kernel
+# boot from /proc/uptime, which NTP can't step like the wall clock, so
+# /tmp/init.log reads as a boot timeline:
+#   12.31 userdata-start
+#   40.87 docker-start-done
+boot_timeline = [
+    "#!/bin/bash -xe\n",
+    "boot_mark() { echo \"$(cut -d' ' -f1 /proc/uptime) $1\" >> /tmp/init.log; }\n",
+    "boot_mark userdata-start\n",
+]
+
+
+def boot_mark(step):
+    return "boot_mark %s\n" % step
+
+
+def wait_until(command):
+    return "until %s; do sleep 1; done\n" % command
+
+
+def cfn_signal(title, status="$?"):
+    return [
+        "/opt/aws/bin/cfn-signal -e %s " % status,
+        "         --stack ",
+        Ref('AWS::StackName'),
+        "         --resource %s " % title,
+        '         --region ',
+        Ref('AWS::Region'),
+        '\n',
+    ]
+
+
+def signal_when(command, title, step, timeout):
+    """UserData that signals title once command succeeds, polling it
+    every second, and signals failure after timeout seconds.
+
+    The polling runs detached with its output redirected, so the UserData
+    and cloud-init finish without waiting for it.
+    """
+    return [
+        "(for attempt in $(seq %d); do\n" % timeout,
+        "   if %s; then\n" % command,
+        "     " + boot_mark(step),
+        "     ",
+    ] + cfn_signal(title, 0) + [
+        "     exit\n",
+        "   fi\n",
+        "   sleep 1\n",
+        " done\n",
+        " " + boot_mark("%s-timeout" % step),
+        " ",
+    ] + cfn_signal(title, 1) + [
+        ") >> /tmp/signal.log 2>&1 &\n",
+    ]
+
+
+def network_ready(config):
+    if config.fast_boot:
+        # Poll for what the fixed sleep was waiting for, and leave the OS
+        # update to the AMI instead of running it on every boot
+        return [
+            wait_until("curl -sf -m 2 http://169.254.169.254/latest/meta-data/"
+                       "instance-id > /dev/null"),
+            boot_mark("network-ready"),
+        ]
+    return [
+        "sleep 30s\n",
+        "yum update -y\n",
+        boot_mark("update-done"),
+    ]
@@ -0,0 +1,24 @@
+from troposphere import (
+    GetAtt,
+    Ref,
+)
+
+from troposphere import servicediscovery as sd
+
+
+def add_discovery(build):
+    template = build.template
+
+    # Cloud Map namespace the split or on-demand services find each other
+    # in. ECS Service Connect registers the services in it and answers
+    # their usual hostnames (bigid-orch, bigid-scanner, ...) from it.
+    namespace = sd.PrivateDnsNamespace(
+        "ServiceDiscoveryNamespace",
+        template=template,
+        Name=Ref(build.discovery_namespace),
+        Vpc=Ref(build.vpc_id),
+    )
+
+    build.add(
+        service_connect_namespace=GetAtt(namespace, "Arn"),
+    )
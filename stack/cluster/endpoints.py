@@ -0,0 +1,50 @@
+from troposphere import (
+    AWS_REGION,
+    Join,
+    Ref,
+)
+
+from troposphere.ec2 import VPCEndpoint
+
+
+def service_name(service):
+    return Join("", ["com.amazonaws.", Ref(AWS_REGION), ".%s" % service])
+
+
+def add_endpoints(build):
+    template = build.template
+    vpc_id = build.vpc_id
+
+    # With private DNS the regular ECR/CloudWatch Logs host names resolve to
+    # these interfaces, so the agent needs no configuration to use them
+    interface_endpoints = {}
+    for title, service in [
+        ("EcrApiEndpoint", "ecr.api"),
+        ("EcrDkrEndpoint", "ecr.dkr"),
+        ("LogsEndpoint", "logs"),
+    ]:
+        interface_endpoints[service] = VPCEndpoint(
+            title,
+            template=template,
+            VpcId=Ref(vpc_id),
+            ServiceName=service_name(service),
+            VpcEndpointType="Interface",
+            PrivateDnsEnabled=True,
+            SubnetIds=Ref(build.public_subnets),
+            SecurityGroupIds=[Ref(build.instance_security_group)],
+        )
+
+    # ECR serves image layers out of S3
+    s3_endpoint = VPCEndpoint(
+        "S3Endpoint",
+        template=template,
+        VpcId=Ref(vpc_id),
+        ServiceName=service_name("s3"),
+        VpcEndpointType="Gateway",
+        RouteTableIds=Ref(build.route_table_ids),
+    )
+
+    build.add(
+        interface_endpoints=interface_endpoints,
+        s3_endpoint=s3_endpoint,
+    )
@@ -6,6 +6,7 @@ from troposphere import (
     autoscaling,
     Base64,
     cloudformation,
+    ec2,
     FindInMap,
     GetAtt,
     iam,
@@ -21,181 +22,374 @@ from troposphere.ec2 import (
 )
 
 from troposphere.ecs import (
+    AutoScalingGroupProvider,
+    CapacityProvider,
+    CapacityProviderStrategy,
     Cluster,
+    ClusterCapacityProviderAssociations,
+    ClusterSetting,
+    ManagedScaling,
 )
 
-from troposphere import elasticloadbalancing as elb
-
 from troposphere.autoscaling import (
     LaunchConfiguration,
     Metadata,
     AutoScalingGroup
 )
 
-from stack.template import template
-from stack.vpc import (
-    vpc_id,
-	public_subnet,
-	instance_type,
-	secret_key
+from troposphere.policies import (
+    AutoScalingRollingUpdate,
+    CreationPolicy,
+    ResourceSignal,
+    UpdatePolicy,
 )
 
+from stack.cluster.boot import boot_timeline, boot_mark, signal_when
 
 
-repo_id = "238481145981.dkr.ecr.us-west-2.amazonaws.com"
-
-template.add_mapping("ECSRegionMap", {
-    "eu-central-1": {"AMI": "ami-38dc1157"},
-    "eu-west-1": {"AMI": "ami-e3fbd290"},
-    "us-east-1": {"AMI": "ami-a58760b3"},
-    "us-west-2": {"AMI": "ami-5b6dde3b"},
-    "us-west-1": {"AMI": "ami-74cb9b14"},
-})
-
-instance_security_group = SecurityGroup(
-    'InstanceSecurityGroup',
-    template=template,
-    GroupDescription="Instance security group.",
-    VpcId=Ref(vpc_id),
-    SecurityGroupIngress=[
-        SecurityGroupRule(
-            IpProtocol='-1',
-            FromPort='-1',
-            ToPort='-1',
-            CidrIp='0.0.0.0/0',
-        )
+registry_id = "238481145981"
+
+bigid_images = [
+    "bigid-web",
+    "bigid-orch",
+    "bigid-corr",
+    "bigid-scanner",
+    "bigid-ui",
+]
+
+# Seconds a new container instance's ECS agent gets to register before the
+# instance signals failure; under the default RollingUpdatePauseTime
+agent_registration_timeout = 300
+
+
+def component_title(name):
+    # bigid-scanner -> BigIdScanner, the prefix of its resource titles
+    title = "".join(part.capitalize() for part in name.split("-"))
+    return title.replace("Bigid", "BigId")
+
+
+def add_infrastructure(build):
+    template, config = build.template, build.config
+    vpc_id = build.vpc_id
+    public_subnets = build.public_subnets
+    instance_type = build.instance_type
+    secret_key = build.secret_key
+    cluster_min_size = build.cluster_min_size
+    cluster_max_size = build.cluster_max_size
+    cluster_reservation_target = build.cluster_reservation_target
+    rolling_update_batch_size = build.rolling_update_batch_size
+    rolling_update_pause_time = build.rolling_update_pause_time
+    health_check_interval = build.health_check_interval
+    deregistration_delay = build.deregistration_delay
+    idle_timeout = build.idle_timeout
+    image_pull_behavior = build.image_pull_behavior
+    image_cleanup_interval = build.image_cleanup_interval
+    image_minimum_cleanup_age = build.image_minimum_cleanup_age
+    images_deleted_per_cycle = build.images_deleted_per_cycle
+    pre_pull_images = build.pre_pull_images
+
+    repo_id = "%s.dkr.ecr.us-west-2.amazonaws.com" % registry_id
+    repo_region = "us-west-2"
+
+    if config.vpc_endpoints:
+        # VPC endpoints only reach their own region's registry. The bigid
+        # repositories are replicated to these regions.
+        template.add_mapping("RegistryRegionMap", {
+            region: {"Registry": "%s.dkr.ecr.%s.amazonaws.com" % (registry_id, region)}
+            for region in [
+                "eu-central-1",
+                "eu-west-1",
+                "us-east-1",
+                "us-west-2",
+                "us-west-1",
+            ]
+        })
+        repo_id = FindInMap("RegistryRegionMap", Ref(AWS_REGION), "Registry")
+        repo_region = Ref(AWS_REGION)
+
+    def bigid_image(name):
+        return Join("", [
+            repo_id,
+            "/bigid/%s" % name,
+        ])
+
+    if config.ssm_amis:
+        container_instance_image = Ref(build.ecs_image_id)
+    else:
+        template.add_mapping("ECSRegionMap", {
+            "eu-central-1": {"AMI": "ami-38dc1157"},
+            "eu-west-1": {"AMI": "ami-e3fbd290"},
+            "us-east-1": {"AMI": "ami-a58760b3"},
+            "us-west-2": {"AMI": "ami-5b6dde3b"},
+            "us-west-1": {"AMI": "ami-74cb9b14"},
+        })
+        container_instance_image = FindInMap("ECSRegionMap", Ref(AWS_REGION), "AMI")
+
+    instance_security_group = SecurityGroup(
+        'InstanceSecurityGroup',
+        template=template,
+        GroupDescription="Instance security group.",
+        VpcId=Ref(vpc_id),
+        SecurityGroupIngress=[
+            SecurityGroupRule(
+                IpProtocol='-1',
+                FromPort='-1',
+                ToPort='-1',
+                CidrIp='0.0.0.0/0',
+            )
+        ]
+    )
+
+    # (load balancer port, container, container port) published to clients
+    balanced_ports = [
+        (80, "bigid-ui", 8080),
+        (3000, "bigid-web", 3000),
+        (3001, "bigid-orch", 3001),
+        (3002, "bigid-corr", 3002),
     ]
-)
 
-load_balancer = elb.LoadBalancer(
-    'LoadBalancer',
-    template=template,
-    Subnets=[
-        Ref(public_subnet),
-    ],
-    SecurityGroups=[Ref(instance_security_group)],
-    Listeners=[
-		elb.Listener(
-        LoadBalancerPort=80,
-        InstanceProtocol='HTTP',
-        InstancePort=8080,
-        Protocol='HTTP'
-		),
-		elb.Listener(
-        LoadBalancerPort=3000,
-        InstanceProtocol='tcp',
-        InstancePort=3000,
-        Protocol='tcp'
-		),
-		elb.Listener(
-        LoadBalancerPort=3001,
-        InstanceProtocol='tcp',
-        InstancePort=3001,
-        Protocol='tcp'
-		),
-		elb.Listener(
-        LoadBalancerPort=3002,
-        InstanceProtocol='tcp',
-        InstancePort=3002,
-        Protocol='tcp'
-		),
-	],
-    HealthCheck=elb.HealthCheck(
-        Target=Join("", ["HTTP:", 8080, "/"]),
-        HealthyThreshold="2",
-        UnhealthyThreshold="2",
-        Interval="100",
-        Timeout="10",
-    ),
-	Scheme="internal"
-)
+    # ECS container name -> target group, for services behind elbv2 balancers
+    target_groups = {}
+    load_balancer_listener_names = []
 
-template.add_output(Output(
-    "LoadBalancerDNSName",
-    Description="Loadbalancer DNS",
-    Value=Join("", ["http://", GetAtt(load_balancer, "DNSName")])
-))
-
-# ECS cluster
-main_cluster = Cluster(
-    "MainCluster",
-    ClusterName=Join("", ["MainCluster-", Ref(AWS_STACK_NAME)]),
-    template=template,
-)
+    # Only the load balancer type in use is imported
+    if config.load_balancer_type == "classic":
+        from troposphere import elasticloadbalancing as elb
+        load_balancer_listeners = []
+        for lb_port, container_name, container_port in balanced_ports:
+            protocol = 'HTTP' if lb_port == 80 else 'tcp'
+            load_balancer_listeners.append(elb.Listener(
+                LoadBalancerPort=lb_port,
+                InstanceProtocol=protocol,
+                InstancePort=container_port,
+                Protocol=protocol
+            ))
 
-# ECS container role
-container_instance_role = iam.Role(
-    "ContainerInstanceRole",
-    template=template,
-    AssumeRolePolicyDocument=dict(Statement=[dict(
-        Effect="Allow",
-        Principal=dict(Service=["ec2.amazonaws.com"]),
-        Action=["sts:AssumeRole"],
-    )]),
-    Path="/",
-    Policies=[
-        iam.Policy(
-            PolicyName="ECSManagementPolicy",
-            PolicyDocument=dict(
-                Statement=[dict(
-                    Effect="Allow",
-                    Action=[
-                        "ecs:*",
-                        "elasticloadbalancing:*",
-                    ],
-                    Resource="*",
-                )],
+        load_balancer = elb.LoadBalancer(
+            'LoadBalancer',
+            template=template,
+            Subnets=Ref(public_subnets),
+            SecurityGroups=[Ref(instance_security_group)],
+            Listeners=load_balancer_listeners,
+            HealthCheck=elb.HealthCheck(
+                Target=Join("", ["HTTP:", 8080, "/"]),
+                HealthyThreshold="2",
+                UnhealthyThreshold="2",
+                Interval=Ref(health_check_interval),
+                Timeout="5",
             ),
-        ),
-        iam.Policy(
-            PolicyName='ECRManagementPolicy',
-            PolicyDocument=dict(
-                Statement=[dict(
-                    Effect='Allow',
-                    Action=[
-                        ecr.GetAuthorizationToken,
-                        ecr.GetDownloadUrlForLayer,
-                        ecr.BatchGetImage,
-                        ecr.BatchCheckLayerAvailability,
-                    ],
-                    Resource="*",
-                )],
+            ConnectionDrainingPolicy=elb.ConnectionDrainingPolicy(
+                Enabled=True,
+                Timeout=Ref(deregistration_delay),
             ),
-        ),
-        iam.Policy(
-            PolicyName="LoggingPolicy",
-            PolicyDocument=dict(
-                Statement=[dict(
-                    Effect="Allow",
-                    Action=[
-                        "logs:Create*",
-                        "logs:PutLogEvents",
-                    ],
-                    Resource="arn:aws:logs:*:*:*",
+            ConnectionSettings=elb.ConnectionSettings(
+                IdleTimeout=Ref(idle_timeout),
+            ),
+            CrossZone=True,
+            Scheme="internal"
+        )
+        tcp_load_balancer = load_balancer
+    else:
+        # A classic ELB only forwards to fixed instance ports; target groups
+        # follow whatever host port ECS picked for each task. The UI gets an
+        # ALB, the raw TCP ports an NLB.
+        from troposphere import elasticloadbalancingv2 as elbv2
+        load_balancer = elbv2.LoadBalancer(
+            'LoadBalancer',
+            template=template,
+            Type="application",
+            Subnets=Ref(public_subnets),
+            SecurityGroups=[Ref(instance_security_group)],
+            LoadBalancerAttributes=[
+                elbv2.LoadBalancerAttributes(
+                    Key="idle_timeout.timeout_seconds",
+                    Value=Ref(idle_timeout),
+                ),
+            ],
+            Scheme="internal"
+        )
+
+        tcp_load_balancer = elbv2.LoadBalancer(
+            'TcpLoadBalancer',
+            template=template,
+            Type="network",
+            Subnets=Ref(public_subnets),
+            LoadBalancerAttributes=[
+                elbv2.LoadBalancerAttributes(
+                    Key="load_balancing.cross_zone.enabled",
+                    Value="true",
+                ),
+            ],
+            Scheme="internal"
+        )
+
+        for lb_port, container_name, container_port in balanced_ports:
+            if lb_port == 80:
+                balancer, protocol = load_balancer, "HTTP"
+                health_check = dict(
+                    HealthCheckProtocol="HTTP",
+                    HealthCheckPath="/",
+                    HealthCheckTimeoutSeconds=5,
+                    Matcher=elbv2.Matcher(HttpCode="200-399"),
+                )
+            else:
+                # NLB TCP checks have a fixed timeout
+                balancer, protocol = tcp_load_balancer, "TCP"
+                health_check = dict(HealthCheckProtocol="TCP")
+
+            target_group = elbv2.TargetGroup(
+                "%s%sTargetGroup" % (balancer.title, lb_port),
+                template=template,
+                VpcId=Ref(vpc_id),
+                Port=container_port,
+                Protocol=protocol,
+                TargetType="instance",
+                HealthCheckIntervalSeconds=Ref(health_check_interval),
+                HealthyThresholdCount=2,
+                UnhealthyThresholdCount=2,
+                TargetGroupAttributes=[
+                    elbv2.TargetGroupAttribute(
+                        Key="deregistration_delay.timeout_seconds",
+                        Value=Ref(deregistration_delay),
+                    ),
+                ],
+                **health_check
+            )
+            target_groups[container_name] = target_group
+
+            listener = elbv2.Listener(
+                "%s%sListener" % (balancer.title, lb_port),
+                template=template,
+                LoadBalancerArn=Ref(balancer),
+                Port=lb_port,
+                Protocol=protocol,
+                DefaultActions=[elbv2.Action(
+                    Type="forward",
+                    TargetGroupArn=Ref(target_group),
                 )],
+            )
+            load_balancer_listener_names.append(listener.title)
+
+    template.add_output(Output(
+        "LoadBalancerDNSName",
+        Description="Loadbalancer DNS",
+        Value=Join("", ["http://", GetAtt(load_balancer, "DNSName")])
+    ))
+
+    if tcp_load_balancer is not load_balancer:
+        template.add_output(Output(
+            "TcpLoadBalancerDNSName",
+            Description="Loadbalancer DNS for the bigid-web/orch/corr ports",
+            Value=GetAtt(tcp_load_balancer, "DNSName")
+        ))
+
+    # ECS cluster
+    cluster_settings = {}
+    if config.monitoring:
+        # Per-service task counts for the dashboard and alarms
+        cluster_settings["ClusterSettings"] = [
+            ClusterSetting(Name="containerInsights", Value="enabled"),
+        ]
+
+    main_cluster = Cluster(
+        "MainCluster",
+        ClusterName=Join("", ["MainCluster-", Ref(AWS_STACK_NAME)]),
+        template=template,
+        **cluster_settings
+    )
+
+    # ECS container role
+    container_instance_role = iam.Role(
+        "ContainerInstanceRole",
+        template=template,
+        AssumeRolePolicyDocument=dict(Statement=[dict(
+            Effect="Allow",
+            Principal=dict(Service=["ec2.amazonaws.com"]),
+            Action=["sts:AssumeRole"],
+        )]),
+        Path="/",
+        Policies=[
+            iam.Policy(
+                PolicyName="ECSManagementPolicy",
+                PolicyDocument=dict(
+                    Statement=[dict(
+                        Effect="Allow",
+                        Action=[
+                            "ecs:*",
+                            "elasticloadbalancing:*",
+                        ],
+                        Resource="*",
+                    )],
+                ),
             ),
-        ),
-    ]
-)
+            iam.Policy(
+                PolicyName='ECRManagementPolicy',
+                PolicyDocument=dict(
+                    Statement=[dict(
+                        Effect='Allow',
+                        Action=[
+                            ecr.GetAuthorizationToken,
+                            ecr.GetDownloadUrlForLayer,
+                            ecr.BatchGetImage,
+                            ecr.BatchCheckLayerAvailability,
+                        ],
+                        Resource="*",
+                    )],
+                ),
+            ),
+            iam.Policy(
+                PolicyName="LoggingPolicy",
+                PolicyDocument=dict(
+                    Statement=[dict(
+                        Effect="Allow",
+                        Action=[
+                            "logs:Create*",
+                            "logs:PutLogEvents",
+                        ],
+                        Resource="arn:aws:logs:*:*:*",
+                    )],
+                ),
+            ),
+        ]
+    )
 
-# ECS container instance profile
-container_instance_profile = iam.InstanceProfile(
-    "ContainerInstanceProfile",
-    template=template,
-    Path="/",
-    Roles=[Ref(container_instance_role)],
-)
+    # ECS container instance profile
+    container_instance_profile = iam.InstanceProfile(
+        "ContainerInstanceProfile",
+        template=template,
+        Path="/",
+        Roles=[Ref(container_instance_role)],
+    )
 
-container_instance_configuration_name = "MainContainerLaunchConfiguration"
+    if config.launch_template:
+        container_instance_configuration_name = "MainContainerLaunchTemplate"
+    else:
+        container_instance_configuration_name = "MainContainerLaunchConfiguration"
 
-container_instance_configuration = LaunchConfiguration(
-    container_instance_configuration_name,
-    template=template,
-    KeyName=Ref(secret_key),
-    Metadata=Metadata(
+    container_instance_metadata = Metadata(
         cloudformation.Init(dict(
             config=cloudformation.InitConfig(
+                # cfn-init runs commands in name order, so the images are
+                # pulled before the agent is pointed at the cluster
                 commands=dict(
+                    pull_images=dict(
+                        test=Join("", ["test ", Ref(pre_pull_images), " = true"]),
+                        command=Join("", [
+                            "#!/bin/bash\n",
+                            "command -v aws > /dev/null || ",
+                            "yum install -y awscli || yum install -y aws-cli\n",
+                            "$(aws ecr get-login --no-include-email",
+                            " --region ", repo_region,
+                            " --registry-ids %s)\n" % registry_id,
+                            # All images at once rather than one by one as
+                            # the agent starts each container
+                        ] + [
+                            Join("", ["docker pull ", bigid_image(name), " &\n"])
+                            for name in bigid_images
+                        ] + [
+                            "wait\n",
+                        ]),
+                    ),
                     register_cluster=dict(command=Join("", [
                         "#!/bin/bash\n",
                         # Register the cluster
@@ -206,7 +400,26 @@ container_instance_configuration = LaunchConfiguration(
                         'echo \'ECS_AVAILABLE_LOGGING_DRIVERS=',
                         '["json-file","awslogs"]\'',
                         " >> /etc/ecs/ecs.config\n",
-                    ]))
+                        # Reuse cached images, and keep them around long
+                        # enough to survive a service redeploy
+                        "echo ECS_IMAGE_PULL_BEHAVIOR=",
+                        Ref(image_pull_behavior),
+                        " >> /etc/ecs/ecs.config\n",
+                        "echo ECS_IMAGE_CLEANUP_INTERVAL=",
+                        Ref(image_cleanup_interval),
+                        " >> /etc/ecs/ecs.config\n",
+                        "echo ECS_IMAGE_MINIMUM_CLEANUP_AGE=",
+                        Ref(image_minimum_cleanup_age),
+                        " >> /etc/ecs/ecs.config\n",
+                        "echo ECS_NUM_IMAGES_DELETE_PER_CYCLE=",
+                        Ref(images_deleted_per_cycle),
+                        " >> /etc/ecs/ecs.config\n",
+                    ] + ([
+                        # Drain tasks off a Spot instance once it gets its
+                        # two-minute interruption notice
+                        "echo ECS_ENABLE_SPOT_INSTANCE_DRAINING=true",
+                        " >> /etc/ecs/ecs.config\n",
+                    ] if config.launch_template else [])))
                 ),
                 files=cloudformation.InitFiles({
                     "/etc/cfn/cfn-hup.conf": cloudformation.InitFile(
@@ -257,69 +470,231 @@ container_instance_configuration = LaunchConfiguration(
                 )
             )
         ))
-    ),
-    SecurityGroups=[Ref(instance_security_group)],
-	AssociatePublicIpAddress=True,
-    InstanceType=instance_type,
-    ImageId=FindInMap("ECSRegionMap", Ref(AWS_REGION), "AMI"),
-    IamInstanceProfile=Ref(container_instance_profile),
-    UserData=Base64(Join('', [
-        "#!/bin/bash -xe\n",
+    )
+
+    autoscaling_group_name = "ECSAutoScalingGroup"
+
+    container_instance_user_data = Base64(Join('', boot_timeline + [
+        # Skip the yum round trip when the AMI already ships the helpers
+        "[ -x /opt/aws/bin/cfn-init ] || " if config.fast_boot else "",
         "yum install -y aws-cfn-bootstrap\n",
+        boot_mark("cfn-bootstrap-ready"),
 
         "/opt/aws/bin/cfn-init -v ",
         "         --stack ", Ref(AWS_STACK_NAME),
         "         --resource %s " % container_instance_configuration_name,
         "         --region ", Ref(AWS_REGION), "\n",
-    ]))
-)
+        boot_mark("cfn-init-done"),
 
-autoscaling_group_name = "ECSAutoScalingGroup"
-AutoScalingGroup(
-    autoscaling_group_name,
-    template=template,
-    VPCZoneIdentifier=[Ref(public_subnet)],
-    MinSize=1,
-    MaxSize=1,
-    DesiredCapacity=1,
-    LaunchConfigurationName=Ref(container_instance_configuration),
-	DependsOn=["LoadBalancer"],
-    # Since one instance within the group is a reserved slot
-    # for rolling ECS service upgrade, it's not possible to rely
-    # on a "dockerized" `ELB` health-check, else this reserved
-    # instance will be flagged as `unhealthy` and won't stop respawning'
-    HealthCheckType="EC2",
-    HealthCheckGracePeriod=300,
-    Tags=[autoscaling.Tag("Name", "ecs-auto-scaling-group-instances", True)],
-)
+        # Ready once the agent has joined the cluster; this paces the rolling
+        # update instead of a fixed pause. The agent only starts after
+        # cloud-init, so the wait can't hold up the UserData.
+    ] + signal_when("curl -sf http://localhost:51678/v1/metadata "
+                    "| grep -q ContainerInstanceArn",
+                    autoscaling_group_name, "ecs-agent-registered",
+                    agent_registration_timeout)))
 
-app_service_role = iam.Role(
-    "AppServiceRole",
-    template=template,
-    AssumeRolePolicyDocument=dict(Statement=[dict(
-        Effect="Allow",
-        Principal=dict(Service=["ecs.amazonaws.com"]),
-        Action=["sts:AssumeRole"],
-    )]),
-    Path="/",
-    Policies=[
-        iam.Policy(
-            PolicyName="WebServicePolicy",
-            PolicyDocument=dict(
-                Statement=[dict(
-                    Effect="Allow",
-                    Action=[
-                        "elasticloadbalancing:Describe*",
-                        "elasticloadbalancing"
-                        ":DeregisterInstancesFromLoadBalancer",
-                        "elasticloadbalancing"
-                        ":RegisterInstancesWithLoadBalancer",
-                        "ec2:Describe*",
-                        "ec2:AuthorizeSecurityGroupIngress",
-                    ],
-                    Resource="*",
+    if config.launch_template:
+        container_instance_configuration = ec2.LaunchTemplate(
+            container_instance_configuration_name,
+            template=template,
+            Metadata=container_instance_metadata,
+            LaunchTemplateData=ec2.LaunchTemplateData(
+                KeyName=Ref(secret_key),
+                NetworkInterfaces=[ec2.NetworkInterfaces(
+                    DeviceIndex=0,
+                    AssociatePublicIpAddress=True,
+                    Groups=[Ref(instance_security_group)],
                 )],
+                InstanceType=instance_type,
+                ImageId=container_instance_image,
+                IamInstanceProfile=ec2.IamInstanceProfile(
+                    Arn=GetAtt(container_instance_profile, "Arn"),
+                ),
+                UserData=container_instance_user_data,
+            ),
+        )
+    else:
+        container_instance_configuration = LaunchConfiguration(
+            container_instance_configuration_name,
+            template=template,
+            KeyName=Ref(secret_key),
+            Metadata=container_instance_metadata,
+            SecurityGroups=[Ref(instance_security_group)],
+            AssociatePublicIpAddress=True,
+            InstanceType=instance_type,
+            ImageId=container_instance_image,
+            IamInstanceProfile=Ref(container_instance_profile),
+            UserData=container_instance_user_data,
+        )
+
+    if config.launch_template:
+        # Same-sized alternatives to each InstanceType, so the container sizing
+        # profile still fits whichever type a Spot pool has available
+        template.add_mapping("InstanceTypeOverrideMap", {
+            "t2.large": {"1": "t3.large", "2": "m5.large", "3": "m5a.large"},
+            "t2.xlarge": {"1": "t3.xlarge", "2": "m5.xlarge", "3": "m5a.xlarge"},
+            "m4.large": {"1": "m5.large", "2": "m5a.large", "3": "t3.large"},
+            "m4.xlarge": {"1": "m5.xlarge", "2": "m5a.xlarge", "3": "t3.xlarge"},
+        })
+
+        instance_launch = dict(
+            MixedInstancesPolicy=autoscaling.MixedInstancesPolicy(
+                InstancesDistribution=autoscaling.InstancesDistribution(
+                    OnDemandBaseCapacity=Ref(build.on_demand_base_capacity),
+                    OnDemandPercentageAboveBaseCapacity=Ref(
+                        build.on_demand_percentage),
+                    SpotAllocationStrategy="capacity-optimized",
+                ),
+                LaunchTemplate=autoscaling.LaunchTemplate(
+                    LaunchTemplateSpecification=(
+                        autoscaling.LaunchTemplateSpecification(
+                            LaunchTemplateId=Ref(container_instance_configuration),
+                            Version=GetAtt(container_instance_configuration,
+                                           "LatestVersionNumber"),
+                        )
+                    ),
+                    Overrides=[autoscaling.LaunchTemplateOverrides(
+                        InstanceType=instance_type,
+                    )] + [
+                        autoscaling.LaunchTemplateOverrides(
+                            InstanceType=FindInMap("InstanceTypeOverrideMap",
+                                                   instance_type, key),
+                        )
+                        for key in ["1", "2", "3"]
+                    ],
+                ),
+            ),
+        )
+    else:
+        instance_launch = dict(
+            LaunchConfigurationName=Ref(container_instance_configuration),
+        )
+
+    autoscaling_group = AutoScalingGroup(
+        autoscaling_group_name,
+        template=template,
+        # The group keeps its instances balanced across these subnets' zones
+        VPCZoneIdentifier=Ref(public_subnets),
+        # No DesiredCapacity: the group starts at MinSize and the capacity
+        # provider's managed scaling owns it afterwards, so updates don't
+        # reset it
+        MinSize=Ref(cluster_min_size),
+        MaxSize=Ref(cluster_max_size),
+        # Lets the capacity provider keep instances with running tasks out
+        # of a scale-in
+        NewInstancesProtectedFromScaleIn=True,
+        DependsOn=["LoadBalancer"],
+        # Since one instance within the group is a reserved slot
+        # for rolling ECS service upgrade, it's not possible to rely
+        # on a "dockerized" `ELB` health-check, else this reserved
+        # instance will be flagged as `unhealthy` and won't stop respawning'
+        HealthCheckType="EC2",
+        HealthCheckGracePeriod=300,
+        CreationPolicy=CreationPolicy(
+            ResourceSignal=ResourceSignal(
+                Count=Ref(cluster_min_size),
+                Timeout=Ref(rolling_update_pause_time),
             ),
         ),
-    ]
-)
+        # Replace instances in batches, each waiting for the new hosts to
+        # register, while MinSize instances keep serving
+        UpdatePolicy=UpdatePolicy(
+            AutoScalingRollingUpdate=AutoScalingRollingUpdate(
+                MinInstancesInService=Ref(cluster_min_size),
+                MaxBatchSize=Ref(rolling_update_batch_size),
+                PauseTime=Ref(rolling_update_pause_time),
+                WaitOnResourceSignals=True,
+                SuspendProcesses=[
+                    "HealthCheck",
+                    "ReplaceUnhealthy",
+                    "AZRebalance",
+                    "AlarmNotification",
+                    "ScheduledActions",
+                ],
+            ),
+        ),
+        Tags=[autoscaling.Tag("Name", "ecs-auto-scaling-group-instances", True)],
+        **instance_launch
+    )
+
+    # Managed scaling sizes the group to keep CapacityProviderReservation at
+    # the target. Unlike the cluster's CPU/memory reservation it counts the
+    # tasks no instance has room for, e.g. a second task whose fixed host
+    # ports are taken, so the group grows for them.
+    capacity_provider = CapacityProvider(
+        "ClusterCapacityProvider",
+        template=template,
+        AutoScalingGroupProvider=AutoScalingGroupProvider(
+            AutoScalingGroupArn=Ref(autoscaling_group),
+            ManagedScaling=ManagedScaling(
+                Status="ENABLED",
+                TargetCapacity=Ref(cluster_reservation_target),
+            ),
+            ManagedTerminationProtection="ENABLED",
+        ),
+    )
+
+    # A separate resource, as the cluster name is already part of the
+    # instances' UserData
+    capacity_provider_associations = ClusterCapacityProviderAssociations(
+        "ClusterCapacityProviderAssociations",
+        template=template,
+        Cluster=Ref(main_cluster),
+        CapacityProviders=[Ref(capacity_provider)],
+        DefaultCapacityProviderStrategy=[CapacityProviderStrategy(
+            CapacityProvider=Ref(capacity_provider),
+            Weight=1,
+        )],
+    )
+
+    # Services wait for these so they start on the capacity provider
+    capacity_provider_association_names = [capacity_provider_associations.title]
+
+    app_service_role = iam.Role(
+        "AppServiceRole",
+        template=template,
+        AssumeRolePolicyDocument=dict(Statement=[dict(
+            Effect="Allow",
+            Principal=dict(Service=["ecs.amazonaws.com"]),
+            Action=["sts:AssumeRole"],
+        )]),
+        Path="/",
+        Policies=[
+            iam.Policy(
+                PolicyName="WebServicePolicy",
+                PolicyDocument=dict(
+                    Statement=[dict(
+                        Effect="Allow",
+                        Action=[
+                            "elasticloadbalancing:Describe*",
+                            "elasticloadbalancing"
+                            ":DeregisterInstancesFromLoadBalancer",
+                            "elasticloadbalancing"
+                            ":RegisterInstancesWithLoadBalancer",
+                            "elasticloadbalancing:RegisterTargets",
+                            "elasticloadbalancing:DeregisterTargets",
+                            "ec2:Describe*",
+                            "ec2:AuthorizeSecurityGroupIngress",
+                        ],
+                        Resource="*",
+                    )],
+                ),
+            ),
+        ]
+    )
+
+    build.add(
+        bigid_image=bigid_image,
+        instance_security_group=instance_security_group,
+        load_balancer=load_balancer,
+        tcp_load_balancer=tcp_load_balancer,
+        target_groups=target_groups,
+        load_balancer_listener_names=load_balancer_listener_names,
+        main_cluster=main_cluster,
+        autoscaling_group_name=autoscaling_group_name,
+        autoscaling_group=autoscaling_group,
+        capacity_provider_association_names=(
+            capacity_provider_association_names),
+        app_service_role=app_service_role,
+    )
@@ -0,0 +1,41 @@
+from troposphere import (
+    AWS_REGION,
+    AWS_STACK_NAME,
+    Join,
+    Ref,
+)
+from troposphere.ecs import LogConfiguration
+from troposphere.logs import LogGroup
+
+from stack.cluster.infrastructure import bigid_images, component_title
+
+
+def add_log_groups(build):
+    template = build.template
+
+    # bigid component -> its CloudWatch Logs group
+    log_groups = {}
+    for name in bigid_images:
+        log_groups[name] = LogGroup(
+            "%sLogGroup" % component_title(name),
+            template=template,
+            LogGroupName=Join("/", ["/ecs", Ref(AWS_STACK_NAME), name]),
+            RetentionInDays=Ref(build.log_retention_days),
+        )
+
+    def container_logging(name):
+        options = {
+            "awslogs-group": Ref(log_groups[name]),
+            "awslogs-region": Ref(AWS_REGION),
+            "awslogs-stream-prefix": "bigid",
+        }
+        # In non-blocking mode the container's writes go to a ring buffer;
+        # when CloudWatch Logs falls behind the oldest lines are dropped
+        # instead of stalling the process on stdout. The Docker of the
+        # ECSRegionMap AMIs doesn't know the mode.
+        if build.config.ssm_amis:
+            options["mode"] = "non-blocking"
+            options["max-buffer-size"] = Ref(build.log_max_buffer_size)
+        return LogConfiguration(LogDriver="awslogs", Options=options)
+
+    build.add(container_logging=container_logging)
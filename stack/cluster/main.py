@@ -1,251 +1,450 @@
 from troposphere import (
-    AWS_REGION,
-    AWS_STACK_ID,
-    AWS_STACK_NAME,
-    autoscaling,
-    Base64,
-    cloudformation,
-    FindInMap,
+    AWSProperty,
     GetAtt,
+    If,
     Join,
     Ref,
 )
 
-from stack.cluster.infrastructure import (
-    main_cluster,
-    container_instance_profile,
-    load_balancer,
-	autoscaling_group_name,
-	app_service_role, 
-	repo_id
-)
-
-from stack.vpc import (
-	instance_type,
-	secret_key,
-	aws_access_key,
-	aws_secret_key
-)
-
+from troposphere import ecs
 from troposphere.ecs import (
     ContainerDefinition,
+    DeploymentConfiguration,
     Environment,
-    LogConfiguration,
-    VolumesFrom,
-    Volume,
-    MountPoint,
-    PortMapping,
+    HealthCheck,
+    PlacementStrategy,
     TaskDefinition,
-    Service,
     LoadBalancer,
-	HostEntry
+    HostEntry
 )
+from troposphere.validators import boolean, integer
 
-from stack.template import template
+from stack.cluster.infrastructure import component_title
+from stack.cluster.mongo import mongo_user, mongo_pass
+from stack.cluster.sizing import container_sizing, java_heap
 
-from stack.cluster.mongo import mongo_instance, mongo_user, mongo_pass
 
-bigid_task_definition = TaskDefinition(
-    "BigIdTask",
-    template=template,
-    ContainerDefinitions=[
-        ContainerDefinition(
-            Name="bigid-web",
-			Memory="1024",
-            Essential=True,
-            Image=Join("", [
-                repo_id,
-                "/bigid/bigid-web",
-            ]),
-            PortMappings=[PortMapping(
-                ContainerPort="3000",
-                HostPort="3000"
-            )],
-			Links=["bigid-orch"],
-			ExtraHosts=[HostEntry(
-				Hostname="bigid-mongo",
-				IpAddress=GetAtt(mongo_instance, "PrivateIp")
-			)],
-			Environment=[
-                Environment(
-                    Name="BIGID_MONGO_USER",
-                    Value=mongo_user,
-                ),
-                Environment(
-                    Name="BIGID_MONGO_PWD",
-                    Value=mongo_pass,
-                ),
-				Environment(
-                    Name="WEB_URL_EXT",
-                    Value=Join("", ["http://", GetAtt(load_balancer, "DNSName"), ":3000"]),
-                ),
-				Environment(
-                    Name="AWS_ACCESS_KEY",
-                    Value=Ref(aws_access_key),
-                ),
-				Environment(
-                    Name="AWS_SECRET_KEY",
-                    Value=Ref(aws_secret_key),
-                ),
-			],
-        ),
-		ContainerDefinition(
-            Name="bigid-orch",
-			Memory="1024",
+# troposphere 2.7 predates ECS Service Connect
+class ServiceConnectClientAlias(AWSProperty):
+    props = {
+        "DnsName": (str, False),
+        "Port": (integer, True),
+    }
+
+
+class ServiceConnectService(AWSProperty):
+    props = {
+        "ClientAliases": ([ServiceConnectClientAlias], False),
+        "DiscoveryName": (str, False),
+        "PortName": (str, True),
+    }
+
+
+class ServiceConnectConfiguration(AWSProperty):
+    props = {
+        "Enabled": (boolean, True),
+        "Namespace": (str, False),
+        "Services": ([ServiceConnectService], False),
+    }
+
+
+class PortMapping(ecs.PortMapping):
+    props = dict(ecs.PortMapping.props, Name=(str, False))
+
+
+class Service(ecs.Service):
+    props = dict(ecs.Service.props, ServiceConnectConfiguration=(
+        ServiceConnectConfiguration, False))
+
+
+# Seconds a container gets to boot before failed health checks count; the
+# JVM-based scanner is the slowest to start
+health_check_start_periods = {
+    "bigid-web": 60,
+    "bigid-orch": 60,
+    "bigid-corr": 60,
+    "bigid-scanner": 120,
+    "bigid-ui": 30,
+}
+
+
+def container_health_check(name, port):
+    # A plain TCP connect, so it doesn't depend on any HTTP route or on
+    # curl being in the image; the image needs bash though
+    return HealthCheck(
+        Command=["CMD", "bash", "-c", "echo > /dev/tcp/127.0.0.1/%s" % port],
+        Interval=30,
+        Timeout=5,
+        Retries=3,
+        StartPeriod=health_check_start_periods[name],
+    )
+
+
+def health_check_grace_period(containers):
+    # Keeps the load balancer checks from failing a task its containers'
+    # own health checks still consider starting
+    return max(health_check_start_periods[c.Name] for c in containers)
+
+
+def add_services(build):
+    template, config = build.template, build.config
+    unknown = sorted(set(config.health_checks) - set(health_check_start_periods))
+    if unknown:
+        raise ValueError("BIGID_HEALTH_CHECKS names unknown containers: %s"
+                         % ", ".join(unknown))
+    main_cluster = build.main_cluster
+    load_balancer = build.load_balancer
+    tcp_load_balancer = build.tcp_load_balancer
+    target_groups = build.target_groups
+    app_service_role = build.app_service_role
+    bigid_image = build.bigid_image
+    mongo_instance = build.mongo_instance
+    container_logging = build.container_logging
+
+    def external_url(name, port):
+        if name == "bigid-ui":
+            host = GetAtt(load_balancer, "DNSName")
+        else:
+            host = GetAtt(tcp_load_balancer, "DNSName")
+        return Join("", ["http://", host, ":%s" % port])
+
+    def port_mappings(name, ports):
+        mappings = []
+        for port in ports:
+            port, protocol = port if isinstance(port, tuple) else (port, None)
+            if config.dynamic_host_ports:
+                host_port = "0"
+            else:
+                host_port = str(port)
+            mapping = PortMapping(ContainerPort=str(port), HostPort=host_port)
+            if protocol:
+                mapping.Protocol = protocol
+            elif config.split_services or (config.on_demand_scanner and
+                                           name == "bigid-scanner"):
+                # Service Connect serves the named ports; it only proxies TCP
+                mapping.Name = "%s-%s" % (name, port)
+            mappings.append(mapping)
+        return mappings
+
+    # Container -> the containers it reaches by their hostname
+    container_links = {}
+
+    def bigid_container(name, links=(), mongo=True, environment=(), ports=(),
+                        **kwargs):
+        environment = list(environment)
+        container_links[name] = list(links)
+        if ports:
+            kwargs["PortMappings"] = port_mappings(name, ports)
+            first_port = ports[0][0] if isinstance(ports[0], tuple) else ports[0]
+            if name in config.health_checks:
+                kwargs["HealthCheck"] = container_health_check(name,
+                                                               first_port)
+        # Split services resolve the linked hostnames through Service Connect
+        if links and not config.split_services:
+            kwargs["Links"] = list(links)
+        if mongo:
+            kwargs["ExtraHosts"] = [HostEntry(
+                Hostname="bigid-mongo",
+                IpAddress=GetAtt(mongo_instance, "PrivateIp")
+            )]
+        if environment:
+            kwargs["Environment"] = environment
+        kwargs.update(container_sizing(name, build.instance_type))
+        kwargs["LogConfiguration"] = container_logging(name)
+        return ContainerDefinition(
+            Name=name,
             Essential=True,
-            Image=Join("", [
-                repo_id,
-                "/bigid/bigid-orch",
-            ]),
-            PortMappings=[PortMapping(
-                ContainerPort="3001",
-                HostPort="3001"
-            )],
-			Links=["bigid-scanner"],
-			ExtraHosts=[HostEntry(
-				Hostname="bigid-mongo",
-				IpAddress=GetAtt(mongo_instance, "PrivateIp")
-			)],
-			Hostname="bigid-orch",
-			Environment=[
-                Environment(
-                    Name="BIGID_MONGO_USER",
-                    Value=mongo_user,
-                ),
-                Environment(
-                    Name="BIGID_MONGO_PWD",
-                    Value=mongo_pass,
-                ),
-				Environment(
-                    Name="ORCHESTRATOR_URL_EXT",
-			        Value=Join("", ["http://", GetAtt(load_balancer, "DNSName"), ":3001"]),
-                ),
-                Environment(
-                    Name="BIGID_MONGO_HOST_EXT",
-                    Value=GetAtt(mongo_instance, "PrivateIp"),
-                ),
-				Environment(
-                    Name="SAVE_SCANNED_IDENTITIES_AS_PII_FINDINGS",
-                    Value="False",
-                ),
-				Environment(
-                    Name="AWS_ACCESS_KEY",
-                    Value=Ref(aws_access_key),
-                ),
-				Environment(
-                    Name="AWS_SECRET_KEY",
-                    Value=Ref(aws_secret_key),
-                ),
-			],
+            Image=bigid_image(name),
+            **kwargs
+        )
+
+    mongo_credentials = [
+        Environment(
+            Name="BIGID_MONGO_USER",
+            Value=mongo_user,
         ),
-		ContainerDefinition(
-            Name="bigid-corr",
-			Memory="1024",
-            Essential=True,
-            Image=Join("", [
-                repo_id,
-                "/bigid/bigid-corr",
-            ]),
-            PortMappings=[PortMapping(
-                ContainerPort="3002",
-                HostPort="3002"
-            )],
-			Links=["bigid-orch"],
-			ExtraHosts=[HostEntry(
-				Hostname="bigid-mongo",
-				IpAddress=GetAtt(mongo_instance, "PrivateIp")
-			)],
-			Hostname="bigid-corr",
-			Environment=[
-                Environment(
-                    Name="BIGID_MONGO_USER",
-                    Value=mongo_user,
-                ),
-                Environment(
-                    Name="BIGID_MONGO_PWD",
-                    Value=mongo_pass,
-                ),
-				Environment(
-                    Name="CORR_URL_EXT",
-                    Value=Join("", ["http://", GetAtt(load_balancer, "DNSName"), ":3002"]),
-                ),
-			],
+        Environment(
+            Name="BIGID_MONGO_PWD",
+            Value=mongo_pass,
         ),
-		ContainerDefinition(
-            Name="bigid-scanner",
-			Memory="1024",
-            Essential=True,
-			Privileged=True,
-            Image=Join("", [
-                repo_id,
-                "/bigid/bigid-scanner",
-            ]),
-			ExtraHosts=[HostEntry(
-				Hostname="bigid-mongo",
-				IpAddress=GetAtt(mongo_instance, "PrivateIp")
-			)],
-            PortMappings=[
-				PortMapping(
-					ContainerPort="9999",
-					HostPort="9999"
-				),
-				PortMapping(
-					ContainerPort="2049",
-					HostPort="2049"
-				),
-				PortMapping(
-					ContainerPort="2049",
-					HostPort="2049",
-					Protocol="udp"
-				),
-				PortMapping(
-					ContainerPort="111",
-					HostPort="111",
-				),
-				PortMapping(
-					ContainerPort="111",
-					HostPort="111",
-					Protocol="udp"
-				),
-			],
-			Environment=[
-                Environment(
-                    Name="JAVA_OPTS",
-                    Value="-Xmx1024m",
-                ),
-				Environment(
-                    Name="ORCHESTRATOR_URL_EXT",
-			        Value=Join("", ["http://", GetAtt(load_balancer, "DNSName"), ":3001"]),
-                )
-			],
+    ]
+
+    aws_credentials = [
+        Environment(
+            Name="AWS_ACCESS_KEY",
+            Value=Ref(build.aws_access_key),
         ),
-		ContainerDefinition(
-            Name="bigid-ui",
-			Memory="1024",
-            Essential=True,
-            Image=Join("", [
-                repo_id,
-                "/bigid/bigid-ui",
-            ]),
-            PortMappings=[PortMapping(
-                ContainerPort="8080",
-                HostPort="8080"
-            )],
+        Environment(
+            Name="AWS_SECRET_KEY",
+            Value=Ref(build.aws_secret_key),
         ),
-    ],
-)
+    ]
 
-app_service = Service(
-    "AppService",
-    template=template,
-    Cluster=Ref(main_cluster),
-    DependsOn=[autoscaling_group_name],
-    DesiredCount=1,
-    LoadBalancers=[LoadBalancer(
-        ContainerName="bigid-ui",
-        ContainerPort=8080,
-        LoadBalancerName=Ref(load_balancer),
-    )],
-    TaskDefinition=Ref(bigid_task_definition),
-    Role=Ref(app_service_role),
-)
+    web_container = bigid_container(
+        "bigid-web",
+        links=["bigid-orch"],
+        ports=[3000],
+        environment=mongo_credentials + [
+            Environment(
+                Name="WEB_URL_EXT",
+                Value=external_url("bigid-web", 3000),
+            ),
+        ] + aws_credentials,
+    )
+
+    # An on-demand scanner runs outside BigIdTask, so there is nothing to
+    # link; bigid-orch reaches it through Service Connect instead, and it
+    # reaches the orchestrator through ORCHESTRATOR_URL_EXT
+    linked_scanner = config.split_services or not config.on_demand_scanner
+
+    orch_container = bigid_container(
+        "bigid-orch",
+        links=["bigid-scanner"] if linked_scanner else [],
+        Hostname="bigid-orch",
+        ports=[3001],
+        environment=mongo_credentials + [
+            Environment(
+                Name="ORCHESTRATOR_URL_EXT",
+                Value=external_url("bigid-orch", 3001),
+            ),
+            Environment(
+                Name="BIGID_MONGO_HOST_EXT",
+                Value=GetAtt(mongo_instance, "PrivateIp"),
+            ),
+            Environment(
+                Name="SAVE_SCANNED_IDENTITIES_AS_PII_FINDINGS",
+                Value="False",
+            ),
+        ] + aws_credentials,
+    )
+
+    corr_container = bigid_container(
+        "bigid-corr",
+        links=["bigid-orch"],
+        Hostname="bigid-corr",
+        ports=[3002],
+        environment=mongo_credentials + [
+            Environment(
+                Name="CORR_URL_EXT",
+                Value=external_url("bigid-corr", 3002),
+            ),
+        ],
+    )
+
+    scanner_container = bigid_container(
+        "bigid-scanner",
+        Privileged=True,
+        ports=[9999, 2049, (2049, "udp"), 111, (111, "udp")],
+        environment=[
+            Environment(
+                Name="JAVA_OPTS",
+                Value=java_heap("bigid-scanner", build.instance_type),
+            ),
+            Environment(
+                Name="ORCHESTRATOR_URL_EXT",
+                Value=external_url("bigid-orch", 3001),
+            )
+        ],
+    )
+
+    ui_container = bigid_container(
+        "bigid-ui",
+        mongo=False,
+        ports=[8080],
+    )
+
+    bigid_containers = [
+        web_container,
+        orch_container,
+        corr_container,
+        scanner_container,
+        ui_container,
+    ]
+
+    def service_load_balancers(containers):
+        if not target_groups:
+            return [LoadBalancer(
+                ContainerName="bigid-ui",
+                ContainerPort=8080,
+                LoadBalancerName=Ref(load_balancer),
+            )]
+        return [
+            LoadBalancer(
+                ContainerName=container.Name,
+                ContainerPort=int(container.PortMappings[0].ContainerPort),
+                TargetGroupArn=Ref(target_groups[container.Name]),
+            )
+            for container in containers
+            if container.Name in target_groups
+        ]
+
+    def service_connect(container=None):
+        # A split or on-demand scanner service answers to its container's
+        # name on the container's TCP ports; every service resolves the
+        # other services' names
+        if container is None:
+            return ServiceConnectConfiguration(
+                Enabled=True,
+                Namespace=build.service_connect_namespace,
+            )
+        return ServiceConnectConfiguration(
+            Enabled=True,
+            Namespace=build.service_connect_namespace,
+            Services=[
+                ServiceConnectService(
+                    PortName=mapping.Name,
+                    ClientAliases=[ServiceConnectClientAlias(
+                        DnsName=container.Name,
+                        Port=int(mapping.ContainerPort),
+                    )],
+                )
+                for mapping in container.PortMappings
+                if "Name" in mapping.properties
+            ],
+        )
+
+    # Tasks are always balanced across Availability Zones first, so losing a
+    # zone only takes its share of the tasks down
+    placement_strategies = If(
+        "SpreadTasks",
+        [
+            PlacementStrategy(Type="spread", Field="attribute:ecs.availability-zone"),
+            PlacementStrategy(Type="spread", Field="instanceId"),
+            PlacementStrategy(Type="binpack", Field="memory"),
+        ],
+        [
+            PlacementStrategy(Type="spread", Field="attribute:ecs.availability-zone"),
+            PlacementStrategy(Type="binpack", Field="memory"),
+        ],
+    )
+
+    deployment_configuration = DeploymentConfiguration(
+        MinimumHealthyPercent=Ref(build.deployment_minimum_healthy_percent),
+        MaximumPercent=Ref(build.deployment_maximum_percent),
+    )
+
+    # Target groups must be attached to a listener before a service can use them
+    service_depends_on = (
+        [build.autoscaling_group_name]
+        + build.load_balancer_listener_names
+        + build.capacity_provider_association_names
+        + build.mongo_ready_names
+    )
+
+    if not config.split_services:
+        if linked_scanner:
+            task_containers = bigid_containers
+        else:
+            task_containers = [c for c in bigid_containers
+                               if c is not scanner_container]
+
+        bigid_task_definition = TaskDefinition(
+            "BigIdTask",
+            template=template,
+            ContainerDefinitions=task_containers,
+        )
+
+        app_service_args = {}
+        app_depends_on = service_depends_on
+        if not linked_scanner:
+            # bigid-orch's Service Connect client, see the split services
+            app_service_args["ServiceConnectConfiguration"] = service_connect()
+            app_depends_on = service_depends_on + ["BigIdScannerService"]
+
+        # No DesiredCount on the services the autoscaling policies drive: an
+        # update would reset them to it, ECS starts them at one task and the
+        # scalable target's MinCapacity takes over from there
+        app_service = Service(
+            "AppService",
+            template=template,
+            Cluster=Ref(main_cluster),
+            DependsOn=app_depends_on,
+            DeploymentConfiguration=deployment_configuration,
+            LoadBalancers=service_load_balancers(task_containers),
+            HealthCheckGracePeriodSeconds=health_check_grace_period(
+                task_containers),
+            PlacementStrategies=placement_strategies,
+            TaskDefinition=Ref(bigid_task_definition),
+            Role=Ref(app_service_role),
+            **app_service_args
+        )
+
+        # The service the autoscaling policies drive
+        scaled_service = app_service
+        bigid_services = [app_service]
+        scanner_service = None
+
+        if not linked_scanner:
+            scanner_task_definition = TaskDefinition(
+                "BigIdScannerTask",
+                template=template,
+                ContainerDefinitions=[scanner_container],
+            )
+
+            scanner_service = Service(
+                "BigIdScannerService",
+                template=template,
+                Cluster=Ref(main_cluster),
+                DependsOn=service_depends_on,
+                DeploymentConfiguration=deployment_configuration,
+                PlacementStrategies=placement_strategies,
+                ServiceConnectConfiguration=service_connect(scanner_container),
+                TaskDefinition=Ref(scanner_task_definition),
+            )
+            bigid_services.append(scanner_service)
+    else:
+        component_services = {}
+        for container in bigid_containers:
+            name = container.Name
+            title = component_title(name)
+
+            task_definition = TaskDefinition(
+                "%sTask" % title,
+                template=template,
+                ContainerDefinitions=[container],
+            )
+            service_args = dict(
+                ServiceConnectConfiguration=service_connect(container),
+            )
+
+            load_balancers = service_load_balancers([container])
+            if load_balancers:
+                service_args.update(
+                    LoadBalancers=load_balancers,
+                    HealthCheckGracePeriodSeconds=health_check_grace_period(
+                        [container]),
+                    Role=Ref(app_service_role),
+                )
+
+            # The scanner is the autoscaled one, see AppService
+            if name != "bigid-scanner":
+                service_args["DesiredCount"] = Ref(
+                    build.component_desired_counts[name])
+
+            component_services[name] = Service(
+                "%sService" % title,
+                template=template,
+                Cluster=Ref(main_cluster),
+                # A Service Connect client only finds the services that are
+                # in the namespace when its tasks start, so the linked ones
+                # come first
+                DependsOn=service_depends_on + [
+                    "%sService" % component_title(peer)
+                    for peer in container_links[name]
+                ],
+                DeploymentConfiguration=deployment_configuration,
+                PlacementStrategies=placement_strategies,
+                TaskDefinition=Ref(task_definition),
+                **service_args
+            )
+
+        scanner_service = component_services["bigid-scanner"]
+        # An on-demand scanner is scaled on the scan queue instead
+        scaled_service = None if config.on_demand_scanner else scanner_service
+        bigid_services = [component_services[c.Name] for c in bigid_containers]
+
+    build.add(
+        scaled_service=scaled_service,
+        scanner_service=scanner_service,
+        bigid_services=bigid_services,
+    )
@@ -1,98 +1,438 @@
+import json
+
 from troposphere import (
     GetAtt,
+    iam,
+    If,
     Tags,
     Base64,
     Join,
     Ref,
 	FindInMap,
+	Select,
+	AWS_ACCOUNT_ID,
+	AWS_PARTITION,
 	AWS_REGION,
 	Parameter,
 	Output
 )
-from troposphere.ec2 import Instance, NetworkInterfaceProperty
+from troposphere import ec2
+from troposphere.cloudformation import WaitCondition
+from troposphere.ec2 import (
+    Instance,
+    NetworkInterfaceProperty,
+    VolumeAttachment,
+)
 from troposphere.policies import CreationPolicy, ResourceSignal
+from troposphere.validators import integer
 
-from stack.cluster.infrastructure import instance_security_group
-from stack.template import template
-
-from stack.vpc import (
-    vpc_id,
-    public_subnet,
-	instance_type,
-	secret_key
+from stack.cluster.boot import (
+    boot_timeline,
+    network_ready,
+    boot_mark,
+    wait_until,
+    cfn_signal,
 )
 
 mongo_user = "bigid"
 
 mongo_pass = "bigid111"
 
-template.add_mapping("InstanceRegionMap", {
-    "eu-central-1": {"AMI": "ami-f9619996"},
-    "eu-west-1": {"AMI": "ami-9398d3e0"},
-    "us-east-1": {"AMI": "ami-b73b63a0"},
-    "us-west-2": {"AMI": "ami-5ec1673e"},
-    "us-west-1": {"AMI": "ami-23e8a343"},
-})
+replica_set_name = "rs0"
+
+create_user = [
+    "docker exec mongo mongo admin --eval \"db.createUser({ user: '",
+    mongo_user,
+    "', pwd: '",
+    mongo_pass,
+    "', roles: [ { role: 'userAdminAnyDatabase', db: 'admin' }, { role: 'dbAdminAnyDatabase', db: 'admin' }, { role: 'readWriteAnyDatabase', db: 'admin' } ] });\"\n",
+]
+
+# The data volume shows up as xvdf on Xen hosts and as an NVMe device on
+# Nitro ones (m5/r5)
+data_device = "/dev/xvdf"
+
+
+class Volume(ec2.Volume):
+    # troposphere 2.7 predates gp3's Throughput
+    props = dict(ec2.Volume.props, Throughput=(integer, False))
+
+
+# The volume is attached once the instance is running, so it may show up
+# after the UserData started
+data_volume_mount = [
+    wait_until("[ -b %s ] || [ -e /dev/sdf ] || [ -b /dev/nvme1n1 ]"
+               % data_device),
+    "DATA_DEVICE=%s\n" % data_device,
+    "[ -b $DATA_DEVICE ] || DATA_DEVICE=$(readlink -f /dev/sdf)\n",
+    "[ -b $DATA_DEVICE ] || DATA_DEVICE=/dev/nvme1n1\n",
+    "blkid $DATA_DEVICE || mkfs.xfs $DATA_DEVICE\n",
+    "mkdir -p /data\n",
+    "echo \"$DATA_DEVICE /data xfs defaults,noatime,nofail 0 2\" >> /etc/fstab\n",
+    "mount /data\n",
+    # WiredTiger reads small random pages; a large readahead wastes IO
+    "blockdev --setra 32 $DATA_DEVICE\n",
+    boot_mark("data-volume-mounted"),
+]
+
+host_tuning = [
+    "mkdir -p /data\n",
+    "echo never > /sys/kernel/mm/transparent_hugepage/enabled\n",
+    "echo never > /sys/kernel/mm/transparent_hugepage/defrag\n",
+    # Again on every boot, before docker restarts mongod
+    "echo 'echo never > /sys/kernel/mm/transparent_hugepage/enabled' "
+    ">> /etc/rc.d/rc.local\n",
+    "echo 'echo never > /sys/kernel/mm/transparent_hugepage/defrag' "
+    ">> /etc/rc.d/rc.local\n",
+    "chmod +x /etc/rc.d/rc.local\n",
+    # WiredTiger's own default, made explicit: half of (RAM - 1 GiB)
+    "CACHE_GB=$(awk '/MemTotal/ {c = ($2 / 1048576 - 1) / 2; ",
+    "if (c < 0.25) c = 0.25; printf \"%.2f\", c}' /proc/meminfo)\n",
+    boot_mark("host-tuning-done"),
+]
+
+# MongoDB host metrics the EC2 hypervisor can't see, published by the
+# CloudWatch agent per instance
+metrics_namespace = "BigId/Mongo"
+
+def cloudwatch_agent_config(data_mount):
+    return {
+        "metrics": {
+            "namespace": metrics_namespace,
+            "append_dimensions": {"InstanceId": "${aws:InstanceId}"},
+            # Roll the per-device/per-path series up to one per instance, so
+            # alarms don't depend on the device name the volume got
+            "aggregation_dimensions": [["InstanceId"]],
+            "metrics_collected": {
+                "disk": {
+                    "resources": [data_mount],
+                    "measurement": ["used_percent", "inodes_free"],
+                },
+                "diskio": {
+                    "measurement": ["reads", "writes", "io_time"],
+                },
+                "mem": {
+                    "measurement": ["used_percent"],
+                },
+            },
+        },
+    }
+
+
+def cloudwatch_agent_install(data_mount):
+    # data_mount: the filesystem /data is on
+    return [
+        "rpm -Uvh https://s3.amazonaws.com/amazoncloudwatch-agent/"
+        "amazon_linux/amd64/latest/amazon-cloudwatch-agent.rpm\n",
+        "cat > /opt/aws/amazon-cloudwatch-agent/etc/bigid.json <<'EOF'\n",
+        json.dumps(cloudwatch_agent_config(data_mount), indent=2,
+                   sort_keys=True),
+        "\nEOF\n",
+        "/opt/aws/amazon-cloudwatch-agent/bin/amazon-cloudwatch-agent-ctl "
+        "-a fetch-config -m ec2 -s "
+        "-c file:/opt/aws/amazon-cloudwatch-agent/etc/bigid.json\n",
+        boot_mark("cloudwatch-agent-started"),
+    ]
+
+
+# An update that changes the UserData stops and starts the instance, so
+# docker starts at boot and brings mongod back up
+mongod_run = (
+    "docker run --name mongo --restart unless-stopped -v /data:/data/db "
+    "--ulimit nofile=64000:64000 --ulimit nproc=64000:64000 "
+)
+
+mongod_options = "--wiredTigerCacheSizeGB $CACHE_GB"
+
+mongod_ready = wait_until("docker exec mongo mongo --quiet --eval 'db.version()'")
 
 mongo_instance_name = "MongoDB"
-mongo_instance = Instance(
-    mongo_instance_name,
-    template=template,
-    KeyName=Ref(secret_key),
-	NetworkInterfaces=[
-		NetworkInterfaceProperty(
-			AssociatePublicIpAddress=True,
-			SubnetId=Ref(public_subnet),
-			DeviceIndex="0",
-			GroupSet=[Ref(instance_security_group)],
-	)],
-    ImageId=FindInMap("InstanceRegionMap", Ref(AWS_REGION), "AMI"),
-#    SecurityGroupIds=[Ref(default_security_group)],
-    InstanceType=instance_type,
-    UserData=Base64(Join('', [
-        "#!/bin/bash -xe\n",
-        "sleep 30s\n",
-        "touch /tmp/init.log\n",
-        "yum update -y\n",
-        "echo update-done >> /tmp/init.log\n",
-        "yum install -y docker \n",
-        "echo docker-install-done >> /tmp/init.log\n",
+
+
+def add_mongo(build):
+    template, config = build.template, build.config
+    public_subnets = build.public_subnets
+    mongo_instance_type = build.mongo_instance_type
+    secret_key = build.secret_key
+    instance_security_group = build.instance_security_group
+
+    if config.ssm_amis:
+        mongo_image = Ref(build.mongo_image_id)
+    else:
+        template.add_mapping("InstanceRegionMap", {
+            "eu-central-1": {"AMI": "ami-f9619996"},
+            "eu-west-1": {"AMI": "ami-9398d3e0"},
+            "us-east-1": {"AMI": "ami-b73b63a0"},
+            "us-west-2": {"AMI": "ami-5ec1673e"},
+            "us-west-1": {"AMI": "ami-23e8a343"},
+        })
+        mongo_image = FindInMap("InstanceRegionMap", Ref(AWS_REGION), "AMI")
+
+    docker_install = boot_timeline + network_ready(config) + [
+        "yum install -y docker xfsprogs \n",
+        boot_mark("docker-install-done"),
         "usermod -a -G docker ec2-user \n",
         "service docker start\n",
-        "echo docker-start-done >> /tmp/init.log\n",
-        "mkdir -p /data\n",
-        "docker run --name mongo -v /data:/data/db -p 27017:27017 -d mongo --auth\n",
-        "echo docker-mongo-started >> /tmp/init.log\n",
-        "sleep 5s \n",
-		"docker exec mongo mongo admin --eval \"db.createUser({ user: '",
-		mongo_user, 
-		"', pwd: '",
-		mongo_pass, 
-		"', roles: [ { role: 'userAdminAnyDatabase', db: 'admin' }, { role: 'dbAdminAnyDatabase', db: 'admin' }, { role: 'readWriteAnyDatabase', db: 'admin' } ] });\"\n",
-        "/opt/aws/bin/cfn-signal -e $? ",
-        "         --stack ",
-        Ref('AWS::StackName'),
-        "         --resource %s " % mongo_instance_name,
-        '         --region ',
-        Ref('AWS::Region'),
-        '\n',
-		"docker restart mongo",
-		"echo docker-mongo-restarted >> /tmp/init.log\n"
-    ])),
-    CreationPolicy=CreationPolicy(
-        ResourceSignal=ResourceSignal(
-            Timeout='PT15M')),
-    Tags=Tags(Name="mongo_db_instance")
-)
+        "chkconfig docker on\n",
+        wait_until("docker info > /dev/null 2>&1"),
+        boot_mark("docker-start-done"),
+    ]
+
+    if config.mongo_data_volume:
+        host_setup = data_volume_mount + host_tuning
+    else:
+        host_setup = host_tuning
+
+    mongo_instance_policies = []
+    if config.monitoring:
+        cloudwatch_agent = cloudwatch_agent_install(
+            "/data" if config.mongo_data_volume else "/")
+        mongo_instance_policies.append(iam.Policy(
+            PolicyName="MetricsPolicy",
+            PolicyDocument=dict(
+                Statement=[dict(
+                    Effect="Allow",
+                    Action=["cloudwatch:PutMetricData"],
+                    Resource="*",
+                )],
+            ),
+        ))
+    else:
+        cloudwatch_agent = []
+
+    if config.mongo_replicas > 1:
+        # Decrypting with the default aws/ssm key needs no KMS grant
+        mongo_instance_policies.append(iam.Policy(
+            PolicyName="KeyFilePolicy",
+            PolicyDocument=dict(
+                Statement=[dict(
+                    Effect="Allow",
+                    Action=["ssm:GetParameter"],
+                    Resource=Join("", [
+                        "arn:", Ref(AWS_PARTITION), ":ssm:", Ref(AWS_REGION),
+                        ":", Ref(AWS_ACCOUNT_ID), ":parameter",
+                        Ref(build.mongo_key_file),
+                    ]),
+                )],
+            ),
+        ))
+
+    if mongo_instance_policies:
+        mongo_instance_role = iam.Role(
+            "MongoInstanceRole",
+            template=template,
+            AssumeRolePolicyDocument=dict(Statement=[dict(
+                Effect="Allow",
+                Principal=dict(Service=["ec2.amazonaws.com"]),
+                Action=["sts:AssumeRole"],
+            )]),
+            Path="/",
+            Policies=mongo_instance_policies,
+        )
+
+        mongo_instance_profile = iam.InstanceProfile(
+            "MongoInstanceProfile",
+            template=template,
+            Path="/",
+            Roles=[Ref(mongo_instance_role)],
+        )
+        mongo_instance_args = dict(
+            IamInstanceProfile=Ref(mongo_instance_profile),
+        )
+    else:
+        mongo_instance_args = {}
+
+    def ready_title(title):
+        # With a data volume the instance is up before the volume is
+        # attached, so a wait condition that follows the attachment takes
+        # the signal the instance's CreationPolicy would
+        if config.mongo_data_volume:
+            return "%sReady" % title
+        return title
+
+    def standalone_user_data(title):
+        return docker_install + host_setup + cloudwatch_agent + [
+            mongod_run + "-p 27017:27017 -d mongo --auth %s\n" % mongod_options,
+            boot_mark("docker-mongo-started"),
+            mongod_ready if config.fast_boot else "sleep 5s \n",
+        ] + create_user + cfn_signal(ready_title(title)) + [
+            boot_mark("signalled"),
+            "docker restart mongo\n",
+            boot_mark("docker-mongo-restarted"),
+        ]
+
+    def replica_member_user_data(title, peers):
+        # With a key file mongod enforces auth, including between members
+        user_data = docker_install + host_setup + cloudwatch_agent + [
+            "mkdir -p /etc/mongo\n",
+            # Retried while the instance profile's credentials come up
+            "for attempt in $(seq 30); do aws ssm get-parameter --region ",
+            Ref(AWS_REGION), " --name ", Ref(build.mongo_key_file),
+            " --with-decryption --query Parameter.Value --output text"
+            " > /etc/mongo/keyfile && break; sleep 2; done\n",
+            "chmod 400 /etc/mongo/keyfile\n",
+            # uid of the mongodb user inside the official image
+            "chown 999:999 /etc/mongo/keyfile\n",
+            mongod_run,
+            "-v /etc/mongo/keyfile:/etc/mongo/keyfile:ro ",
+            "-p 27017:27017 -d mongo %s " % mongod_options,
+            "--replSet %s --keyFile /etc/mongo/keyfile\n" % replica_set_name,
+            mongod_ready,
+            boot_mark("docker-mongo-started"),
+        ]
+        if peers is None:
+            return user_data + cfn_signal(ready_title(title)) + [
+                boot_mark("signalled")]
+
+        # The first member waits for its peers, then initiates the set and
+        # creates the bigid user on the primary it becomes
+        members = [Join("", [
+            "{_id: 0, host: '",
+            "$(curl -s http://169.254.169.254/latest/meta-data/local-ipv4)",
+            ":27017'}",
+        ])]
+        for index, peer in enumerate(peers, 1):
+            user_data += [
+                "until (echo > /dev/tcp/", GetAtt(peer, "PrivateIp"),
+                "/27017) 2>/dev/null; do sleep 1; done\n",
+            ]
+            members.append(Join("", [
+                "{_id: %d, host: '" % index,
+                GetAtt(peer, "PrivateIp"),
+                ":27017'}",
+            ]))
+        return user_data + [
+            "docker exec mongo mongo admin --eval \"rs.initiate({_id: '%s', members: ["
+            % replica_set_name,
+            Join(", ", members),
+            "]})\"\n",
+            wait_until("docker exec mongo mongo admin --quiet --eval "
+                       "'db.isMaster().ismaster' | grep -q true"),
+            boot_mark("replica-set-initiated"),
+        ] + create_user + cfn_signal(ready_title(title)) + [boot_mark("signalled")]
+
+    def mongo_member(title, subnet, user_data):
+        instance_args = dict(mongo_instance_args)
+        if not config.mongo_data_volume:
+            instance_args["CreationPolicy"] = CreationPolicy(
+                ResourceSignal=ResourceSignal(Timeout='PT15M'))
+        instance = Instance(
+            title,
+            template=template,
+            KeyName=Ref(secret_key),
+            NetworkInterfaces=[
+                NetworkInterfaceProperty(
+                    AssociatePublicIpAddress=True,
+                    SubnetId=subnet,
+                    DeviceIndex="0",
+                    GroupSet=[Ref(instance_security_group)],
+            )],
+            ImageId=mongo_image,
+            InstanceType=mongo_instance_type,
+            UserData=Base64(Join('', user_data)),
+            Tags=Tags(Name="mongo_db_instance"),
+            **instance_args
+        )
+        if not config.mongo_data_volume:
+            return instance
+
+        # A resource of its own, so replacing the instance doesn't take the
+        # data with it, and deleting the stack or replacing the volume
+        # leaves a snapshot. The new instance only gets the volume once
+        # the old one has let go of it: stop the old instance before an
+        # update that replaces it.
+        volume = Volume(
+            "%sDataVolume" % title,
+            template=template,
+            AvailabilityZone=GetAtt(instance, "AvailabilityZone"),
+            VolumeType=Ref(build.mongo_volume_type),
+            Size=Ref(build.mongo_volume_size),
+            Iops=Ref(build.mongo_volume_iops),
+            Throughput=If("MongoVolumeIsGp3",
+                          Ref(build.mongo_volume_throughput),
+                          Ref("AWS::NoValue")),
+            Tags=Tags(Name="mongo_db_data"),
+            DeletionPolicy="Snapshot",
+            UpdateReplacePolicy="Snapshot",
+        )
+        attachment = VolumeAttachment(
+            "%sDataVolumeAttachment" % title,
+            template=template,
+            Device=data_device,
+            InstanceId=Ref(instance),
+            VolumeId=Ref(volume),
+        )
+        WaitCondition(
+            ready_title(title),
+            template=template,
+            DependsOn=[attachment.title],
+            CreationPolicy=CreationPolicy(
+                ResourceSignal=ResourceSignal(Timeout='PT15M')),
+        )
+        return instance
+
+    if config.mongo_replicas == 1:
+        mongo_instance = mongo_member(
+            mongo_instance_name,
+            Select(0, Ref(public_subnets)),
+            standalone_user_data(mongo_instance_name),
+        )
+        mongo_instances = [mongo_instance]
+        mongo_connection_string = None
+    else:
+        secondaries = []
+        for index in range(1, config.mongo_replicas):
+            title = "%s%d" % (mongo_instance_name, index + 1)
+            secondaries.append(mongo_member(
+                title,
+                Select(index, Ref(build.mongo_subnets)),
+                replica_member_user_data(title, None),
+            ))
+
+        # Initially the primary; bigid-mongo resolves to it, as the bigid
+        # images take a single host
+        mongo_instance = mongo_member(
+            mongo_instance_name,
+            Select(0, Ref(build.mongo_subnets)),
+            replica_member_user_data(mongo_instance_name, secondaries),
+        )
+        mongo_instances = [mongo_instance] + secondaries
+
+        mongo_connection_string = Join("", [
+            "mongodb://", mongo_user, ":", mongo_pass, "@",
+            Join(",", [
+                Join("", [GetAtt(member, "PrivateIp"), ":27017"])
+                for member in mongo_instances
+            ]),
+            "/?replicaSet=%s&authSource=admin&readPreference=" % replica_set_name,
+            Ref(build.mongo_read_preference),
+        ])
+
+        template.add_output(Output(
+            "MongoConnectionString",
+            Description="MongoDB replica set connection string, for "
+                        "clients that take a replica set; bigid uses the "
+                        "first member",
+            Value=mongo_connection_string
+        ))
+
+    template.add_output(Output(
+        "Login",
+        Description="BigId Login",
+        Value=mongo_user
+    ))
+
+    template.add_output(Output(
+        "Password",
+        Description="BigId Password",
+        Value=mongo_pass
+    ))
 
-template.add_output(Output(
-    "Login",
-    Description="BigId Login",
-    Value=mongo_user
-))
-
-template.add_output(Output(
-    "Password",
-    Description="BigId Password",
-    Value=mongo_pass
-))
+    build.add(
+        mongo_instance=mongo_instance,
+        mongo_instances=mongo_instances,
+        mongo_connection_string=mongo_connection_string,
+        # What to wait for until MongoDB serves, besides the instances
+        mongo_ready_names=[ready_title(m.title) for m in mongo_instances]
+        if config.mongo_data_volume else [],
+    )
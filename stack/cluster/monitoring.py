@@ -0,0 +1,300 @@
+import json
+
+from troposphere import (
+    AWS_REGION,
+    GetAtt,
+    Join,
+    Output,
+    Ref,
+    Sub,
+)
+from troposphere import cloudwatch, sns
+
+from stack.cluster.mongo import metrics_namespace
+
+
+def dimensions(**values):
+    return [
+        cloudwatch.MetricDimension(Name=name, Value=value)
+        for name, value in sorted(values.items())
+    ]
+
+
+def metric_widget(title, metrics, x, y, stat="Average"):
+    return {
+        "type": "metric",
+        "x": x,
+        "y": y,
+        "width": 12,
+        "height": 6,
+        "properties": {
+            "title": title,
+            "region": "${AWS::Region}",
+            "view": "timeSeries",
+            "stat": stat,
+            "period": 60,
+            "metrics": metrics,
+        },
+    }
+
+
+def add_monitoring(build):
+    template, config = build.template, build.config
+    main_cluster = build.main_cluster
+    load_balancer = build.load_balancer
+    tcp_load_balancer = build.tcp_load_balancer
+    target_groups = build.target_groups
+    bigid_services = build.bigid_services
+    mongo_instances = build.mongo_instances
+
+    alarm_topic = sns.Topic(
+        "AlarmTopic",
+        template=template,
+    )
+
+    sns.SubscriptionResource(
+        "AlarmEmailSubscription",
+        template=template,
+        Condition="HasAlarmEmail",
+        Protocol="email",
+        Endpoint=Ref(build.alarm_email),
+        TopicArn=Ref(alarm_topic),
+    )
+
+    def alarm(title, description, namespace, metric_name, dimensions,
+              threshold, statistic="Average", period=60, evaluation_periods=5):
+        return cloudwatch.Alarm(
+            title,
+            template=template,
+            AlarmDescription=description,
+            Namespace=namespace,
+            MetricName=metric_name,
+            Dimensions=dimensions,
+            Statistic=statistic,
+            Period=period,
+            EvaluationPeriods=evaluation_periods,
+            ComparisonOperator="GreaterThanThreshold",
+            Threshold=str(threshold),
+            # A stopped host or an idle load balancer reports nothing
+            TreatMissingData="notBreaching",
+            AlarmActions=[Ref(alarm_topic)],
+            OKActions=[Ref(alarm_topic)],
+        )
+
+    def tasks_below_desired_alarm(title, service):
+        def task_count(query_id, metric_name):
+            return cloudwatch.MetricDataQuery(
+                Id=query_id,
+                ReturnData=False,
+                MetricStat=cloudwatch.MetricStat(
+                    Metric=cloudwatch.Metric(
+                        Namespace="ECS/ContainerInsights",
+                        MetricName=metric_name,
+                        Dimensions=dimensions(
+                            ClusterName=Ref(main_cluster),
+                            ServiceName=GetAtt(service, "Name"),
+                        ),
+                    ),
+                    Period=60,
+                    Stat="Average",
+                ),
+            )
+
+        return cloudwatch.Alarm(
+            title,
+            template=template,
+            AlarmDescription="Tasks of the service keep failing to start or "
+                             "to be placed",
+            Metrics=[
+                task_count("running", "RunningTaskCount"),
+                task_count("desired", "DesiredTaskCount"),
+                cloudwatch.MetricDataQuery(
+                    Id="missing",
+                    Expression="desired - running",
+                    ReturnData=True,
+                ),
+            ],
+            EvaluationPeriods=5,
+            ComparisonOperator="GreaterThanThreshold",
+            Threshold="0",
+            TreatMissingData="notBreaching",
+            AlarmActions=[Ref(alarm_topic)],
+            OKActions=[Ref(alarm_topic)],
+        )
+
+    # Cluster saturation: reservation is what blocks placing another task,
+    # utilization what the running ones actually use
+    cluster_dimensions = dimensions(ClusterName=Ref(main_cluster))
+    for metric_name, threshold in [
+        ("CPUReservation", 90),
+        ("MemoryReservation", 90),
+        ("CPUUtilization", 85),
+        ("MemoryUtilization", 85),
+    ]:
+        alarm(
+            "Cluster%sAlarm" % metric_name.replace("CPU", "Cpu"),
+            "%s of the ECS cluster above %d%%" % (metric_name, threshold),
+            "AWS/ECS",
+            metric_name,
+            cluster_dimensions,
+            threshold,
+        )
+
+    for service in bigid_services:
+        tasks_below_desired_alarm("%sTasksAlarm" % service.title, service)
+
+    # Load balancer latency (seconds), queueing and server errors per minute
+    if config.load_balancer_type == "classic":
+        lb_namespace = "AWS/ELB"
+        lb_dimensions = dimensions(LoadBalancerName=Ref(load_balancer))
+        lb_dashboard_dimension = ["LoadBalancerName", "${LoadBalancer}"]
+        lb_metrics = [
+            ("Latency", "Average", 1),
+            ("SurgeQueueLength", "Maximum", 100),
+            ("HTTPCode_Backend_5XX", "Sum", 10),
+            ("HTTPCode_ELB_5XX", "Sum", 10),
+        ]
+    else:
+        lb_namespace = "AWS/ApplicationELB"
+        lb_dimensions = dimensions(
+            LoadBalancer=GetAtt(load_balancer, "LoadBalancerFullName"))
+        lb_dashboard_dimension = ["LoadBalancer",
+                                  "${LoadBalancer.LoadBalancerFullName}"]
+        # An ALB has no surge queue; it rejects once it can't keep up
+        lb_metrics = [
+            ("TargetResponseTime", "Average", 1),
+            ("RejectedConnectionCount", "Sum", 0),
+            ("HTTPCode_Target_5XX_Count", "Sum", 10),
+            ("HTTPCode_ELB_5XX_Count", "Sum", 10),
+        ]
+
+    for metric_name, statistic, threshold in lb_metrics:
+        alarm(
+            "LoadBalancer%sAlarm" % metric_name.replace("_", ""),
+            "%s %s of the load balancer above %s" % (statistic, metric_name,
+                                                      threshold),
+            lb_namespace,
+            metric_name,
+            lb_dimensions,
+            threshold,
+            statistic=statistic,
+        )
+
+    # Hosts failing the load balancer health checks, per target group with
+    # elbv2: the ALB's UI group and the NLB's web/orch/corr groups
+    if config.load_balancer_type == "classic":
+        unhealthy_hosts = [
+            ("LoadBalancerUnHealthyHostAlarm", "the load balancer",
+             lb_namespace, lb_dimensions, lb_dashboard_dimension),
+        ]
+    else:
+        unhealthy_hosts = []
+        for container_name in sorted(target_groups):
+            target_group = target_groups[container_name]
+            if target_group.Protocol == "TCP":
+                namespace, balancer = "AWS/NetworkELB", tcp_load_balancer
+            else:
+                namespace, balancer = "AWS/ApplicationELB", load_balancer
+            unhealthy_hosts.append((
+                "%sUnHealthyHostAlarm" % target_group.title,
+                "the %s target group" % container_name,
+                namespace,
+                dimensions(
+                    LoadBalancer=GetAtt(balancer, "LoadBalancerFullName"),
+                    TargetGroup=GetAtt(target_group, "TargetGroupFullName"),
+                ),
+                ["LoadBalancer", "${%s.LoadBalancerFullName}" % balancer.title,
+                 "TargetGroup", "${%s.TargetGroupFullName}" % target_group.title],
+            ))
+
+    for title, subject, namespace, alarm_dimensions, _ in unhealthy_hosts:
+        alarm(
+            title,
+            "Hosts failing the health checks of %s" % subject,
+            namespace,
+            "UnHealthyHostCount",
+            alarm_dimensions,
+            0,
+            statistic="Maximum",
+        )
+
+    for member in mongo_instances:
+        member_dimensions = dimensions(InstanceId=Ref(member))
+        alarm(
+            "%sDiskAlarm" % member.title,
+            "MongoDB data volume of %s above 80%% full" % member.title,
+            metrics_namespace,
+            "disk_used_percent",
+            member_dimensions,
+            80,
+            period=300,
+            evaluation_periods=1,
+        )
+        alarm(
+            "%sMemoryAlarm" % member.title,
+            "Memory of %s above 90%% used" % member.title,
+            metrics_namespace,
+            "mem_used_percent",
+            member_dimensions,
+            90,
+        )
+
+    # Dimension values are ${...} references, resolved by Fn::Sub
+    dashboard_widgets = [
+        metric_widget("Cluster reservation (%)", [
+            ["AWS/ECS", metric_name, "ClusterName", "${MainCluster}"]
+            for metric_name in ["CPUReservation", "MemoryReservation"]
+        ], 0, 0),
+        metric_widget("Cluster utilization (%)", [
+            ["AWS/ECS", metric_name, "ClusterName", "${MainCluster}"]
+            for metric_name in ["CPUUtilization", "MemoryUtilization"]
+        ], 12, 0),
+        metric_widget("Running tasks", [
+            ["ECS/ContainerInsights", "RunningTaskCount",
+             "ClusterName", "${MainCluster}",
+             "ServiceName", "${%s.Name}" % service.title]
+            for service in bigid_services
+        ], 0, 6),
+        metric_widget("Load balancer latency (s)", [
+            [lb_namespace, lb_metrics[0][0]] + lb_dashboard_dimension,
+        ], 12, 6),
+        metric_widget("Load balancer queueing and 5xx", [
+            [lb_namespace, metric_name] + lb_dashboard_dimension
+            + [{"stat": statistic}]
+            for metric_name, statistic, _ in lb_metrics[1:]
+        ], 0, 12),
+        metric_widget("MongoDB data volume and memory used (%)", [
+            [metrics_namespace, metric_name, "InstanceId", "${%s}" % member.title]
+            for member in mongo_instances
+            for metric_name in ["disk_used_percent", "mem_used_percent"]
+        ], 12, 12),
+        metric_widget("MongoDB disk operations", [
+            [metrics_namespace, metric_name, "InstanceId", "${%s}" % member.title]
+            for member in mongo_instances
+            for metric_name in ["diskio_reads", "diskio_writes"]
+        ], 0, 18, stat="Sum"),
+        metric_widget("Unhealthy load balancer hosts", [
+            [namespace, "UnHealthyHostCount"] + dashboard_dimension
+            for _, _, namespace, _, dashboard_dimension in unhealthy_hosts
+        ], 12, 18, stat="Maximum"),
+    ]
+
+    dashboard = cloudwatch.Dashboard(
+        "Dashboard",
+        template=template,
+        DashboardBody=Sub(json.dumps({"widgets": dashboard_widgets},
+                                     sort_keys=True)),
+    )
+
+    template.add_output(Output(
+        "DashboardURL",
+        Description="CloudWatch dashboard of the stack",
+        Value=Join("", [
+            "https://console.aws.amazon.com/cloudwatch/home?region=",
+            Ref(AWS_REGION),
+            "#dashboards:name=",
+            Ref(dashboard),
+        ])
+    ))
+
+    build.add(dashboard=dashboard)
@@ -0,0 +1,199 @@
+from troposphere import (
+    AWS_ACCOUNT_ID,
+    GetAtt,
+    Join,
+    Output,
+    Ref,
+)
+
+from troposphere import applicationautoscaling as aas
+
+# Service-linked role Application Auto Scaling creates on first use
+ecs_scaling_role_arn = Join("", [
+    "arn:aws:iam::",
+    Ref(AWS_ACCOUNT_ID),
+    ":role/aws-service-role/ecs.application-autoscaling.amazonaws.com/",
+    "AWSServiceRoleForApplicationAutoScaling_ECSService",
+])
+
+
+def add_scaling(build):
+    template, config = build.template, build.config
+    service_min_count = build.service_min_count
+    service_max_count = build.service_max_count
+    main_cluster = build.main_cluster
+    scaled_service = build.scaled_service
+    scanner_service = build.scanner_service
+
+    def service_scalable_target(title, service, min_count=service_min_count,
+                                max_count=service_max_count, **kwargs):
+        return aas.ScalableTarget(
+            title,
+            template=template,
+            ServiceNamespace="ecs",
+            ScalableDimension="ecs:service:DesiredCount",
+            ResourceId=Join("/", [
+                "service",
+                Ref(main_cluster),
+                GetAtt(service, "Name"),
+            ]),
+            MinCapacity=Ref(min_count),
+            MaxCapacity=Ref(max_count),
+            RoleARN=ecs_scaling_role_arn,
+            **kwargs
+        )
+
+    def service_target_tracking(title, scalable_target, metric_type, target):
+        return aas.ScalingPolicy(
+            title,
+            template=template,
+            PolicyName=title,
+            PolicyType="TargetTrackingScaling",
+            ScalingTargetId=Ref(scalable_target),
+            TargetTrackingScalingPolicyConfiguration=(
+                aas.TargetTrackingScalingPolicyConfiguration(
+                    PredefinedMetricSpecification=aas.PredefinedMetricSpecification(
+                        PredefinedMetricType=metric_type,
+                    ),
+                    TargetValue=Ref(target),
+                    ScaleOutCooldown=60,
+                    ScaleInCooldown=300,
+                )
+            ),
+        )
+
+    def service_step_scaling(title, scalable_target, adjustments, cooldown):
+        return aas.ScalingPolicy(
+            title,
+            template=template,
+            PolicyName=title,
+            PolicyType="StepScaling",
+            ScalingTargetId=Ref(scalable_target),
+            StepScalingPolicyConfiguration=aas.StepScalingPolicyConfiguration(
+                AdjustmentType="ChangeInCapacity",
+                Cooldown=cooldown,
+                MetricAggregationType="Maximum",
+                StepAdjustments=[
+                    aas.StepAdjustment(ScalingAdjustment=adjustment, **dict(
+                        (bound, value) for bound, value in [
+                            ("MetricIntervalLowerBound", lower),
+                            ("MetricIntervalUpperBound", upper),
+                        ] if value is not None
+                    ))
+                    for lower, upper, adjustment in adjustments
+                ],
+            ),
+        )
+
+    def scan_queue_alarm(title, policy, comparison, periods, missing_data):
+        # Only the on-demand scanner has alarms, so only it imports them
+        from troposphere import cloudwatch
+        return cloudwatch.Alarm(
+            title,
+            template=template,
+            Namespace=Ref(build.scan_queue_metric_namespace),
+            MetricName=Ref(build.scan_queue_metric_name),
+            Dimensions=[cloudwatch.MetricDimension(
+                Name="ClusterName",
+                Value=Ref(main_cluster),
+            )],
+            Statistic="Maximum",
+            Period=60,
+            EvaluationPeriods=periods,
+            ComparisonOperator=comparison,
+            Threshold="0",
+            TreatMissingData=missing_data,
+            AlarmActions=[Ref(policy)],
+        )
+
+    if scaled_service is not None:
+        service_scalable_target_resource = service_scalable_target(
+            "%sScalableTarget" % scaled_service.title,
+            scaled_service,
+        )
+
+        service_target_tracking(
+            "%sCpuScalingPolicy" % scaled_service.title,
+            service_scalable_target_resource,
+            "ECSServiceAverageCPUUtilization",
+            build.service_cpu_target,
+        )
+
+        service_target_tracking(
+            "%sMemoryScalingPolicy" % scaled_service.title,
+            service_scalable_target_resource,
+            "ECSServiceAverageMemoryUtilization",
+            build.service_memory_target,
+        )
+
+    if config.on_demand_scanner:
+        # Nightly full scans get a floor of scanners for the window; outside
+        # it the service idles at ScannerMinCount
+        scanner_scalable_target = service_scalable_target(
+            "%sScalableTarget" % scanner_service.title,
+            scanner_service,
+            min_count=build.scanner_min_count,
+            max_count=build.scanner_max_count,
+            ScheduledActions=[
+                aas.ScheduledAction(
+                    ScheduledActionName="NightlyScanStart",
+                    Schedule=Ref(build.nightly_scan_start),
+                    ScalableTargetAction=aas.ScalableTargetAction(
+                        MinCapacity=Ref(build.nightly_scanner_count),
+                    ),
+                ),
+                aas.ScheduledAction(
+                    ScheduledActionName="NightlyScanEnd",
+                    Schedule=Ref(build.nightly_scan_end),
+                    ScalableTargetAction=aas.ScalableTargetAction(
+                        MinCapacity=Ref(build.scanner_min_count),
+                    ),
+                ),
+            ],
+        )
+
+        # Steps are measured from the alarm threshold: a handful of queued
+        # scans adds one scanner, a deep backlog several at once
+        scan_queue_scale_out = service_step_scaling(
+            "%sScaleOutPolicy" % scanner_service.title,
+            scanner_scalable_target,
+            [(0, 5, 1), (5, 20, 2), (20, None, 4)],
+            cooldown=60,
+        )
+
+        # Scale in one task at a time, once nothing was queued for 15
+        # minutes. An empty queue doesn't mean idle scanners: ECS stops
+        # whichever task it picks, and a scan still running on it is cut
+        # off. Task scale-in protection would have to be set by the
+        # scanner itself through the ECS agent, which the image doesn't do.
+        scan_queue_scale_in = service_step_scaling(
+            "%sScaleInPolicy" % scanner_service.title,
+            scanner_scalable_target,
+            [(None, 0, -1)],
+            cooldown=300,
+        )
+
+        # The orchestrator may only publish while scans are queued, so no
+        # data counts as an empty queue
+        scan_queue_alarm(
+            "ScanQueueBacklogAlarm",
+            scan_queue_scale_out,
+            "GreaterThanThreshold",
+            periods=1,
+            missing_data="notBreaching",
+        )
+
+        scan_queue_alarm(
+            "ScanQueueEmptyAlarm",
+            scan_queue_scale_in,
+            "LessThanOrEqualToThreshold",
+            periods=15,
+            missing_data="breaching",
+        )
+
+        template.add_output(Output(
+            "ScannerTaskDefinition",
+            Description="bigid-scanner task definition, for one-off scans "
+                        "started with ecs run-task",
+            Value=scanner_service.TaskDefinition,
+        ))
@@ -0,0 +1,91 @@
+from troposphere import (
+    FindInMap,
+    Join,
+)
+
+# Per instance type: container -> (cpu units, hard memory limit MiB,
+# soft memory reservation MiB). ECS places tasks by the reservation, so a
+# busy container can burst towards its limit while idle ones don't hold
+# the RAM. The ECS agent keeps ~300 MiB of each host for itself.
+# "Two tasks per host" is what the reservations leave room for; with the
+# default fixed host ports a second task's ports are taken, so only
+# BIGID_DYNAMIC_HOST_PORTS places more than one task per host.
+sizing_profiles = {
+    # 2 vCPU / 8 GiB, burstable: one full task per host
+    "t2.large": {
+        "bigid-web": (256, 1024, 768),
+        "bigid-orch": (256, 1024, 768),
+        "bigid-corr": (128, 768, 512),
+        "bigid-scanner": (512, 3072, 2048),
+        "bigid-ui": (128, 512, 256),
+    },
+    # 4 vCPU / 16 GiB, burstable: room for two tasks per host
+    "t2.xlarge": {
+        "bigid-web": (256, 1536, 1024),
+        "bigid-orch": (256, 1536, 1024),
+        "bigid-corr": (128, 1024, 512),
+        "bigid-scanner": (1024, 5120, 3584),
+        "bigid-ui": (128, 512, 256),
+    },
+    # 2 vCPU / 8 GiB, sustained CPU: the scanner gets the spare cycles
+    "m4.large": {
+        "bigid-web": (256, 1024, 768),
+        "bigid-orch": (256, 1024, 768),
+        "bigid-corr": (128, 768, 512),
+        "bigid-scanner": (1024, 3072, 2048),
+        "bigid-ui": (128, 512, 256),
+    },
+    # 4 vCPU / 16 GiB, sustained CPU: room for two tasks per host
+    "m4.xlarge": {
+        "bigid-web": (256, 1536, 1024),
+        "bigid-orch": (256, 1536, 1024),
+        "bigid-corr": (256, 1024, 512),
+        "bigid-scanner": (1152, 5120, 3584),
+        "bigid-ui": (128, 512, 256),
+    },
+}
+
+# The JVM needs room outside the heap (metaspace, thread stacks, direct
+# buffers), so heaps stay at ~2/3 of the hard limit. Only the scanner
+# takes JAVA_OPTS, so only it gets a heap size.
+heap_ratio = 2.0 / 3
+heap_containers = ("bigid-scanner",)
+
+
+def _key(name, field):
+    # bigid-scanner, Memory -> ScannerMemory
+    return name.split("-", 1)[1].capitalize() + field
+
+
+sizing_map = {}
+for profile_instance_type, containers in sizing_profiles.items():
+    profile = sizing_map[profile_instance_type] = {}
+    for name, (cpu, memory, reservation) in containers.items():
+        profile[_key(name, "Cpu")] = str(cpu)
+        profile[_key(name, "Memory")] = str(memory)
+        profile[_key(name, "MemoryReservation")] = str(reservation)
+        if name in heap_containers:
+            profile[_key(name, "Heap")] = str(
+                int(memory * heap_ratio) // 64 * 64)
+
+
+def add_container_sizing(build):
+    build.template.add_mapping("ContainerSizingMap", sizing_map)
+
+
+def container_sizing(name, instance_type):
+    return dict(
+        Cpu=FindInMap("ContainerSizingMap", instance_type, _key(name, "Cpu")),
+        Memory=FindInMap("ContainerSizingMap", instance_type,
+                         _key(name, "Memory")),
+        MemoryReservation=FindInMap("ContainerSizingMap", instance_type,
+                                    _key(name, "MemoryReservation")),
+    )
+
+
+def java_heap(name, instance_type):
+    return Join("", [
+        "-Xmx",
+        FindInMap("ContainerSizingMap", instance_type, _key(name, "Heap")),
+        "m",
+    ])
@@ -0,0 +1,143 @@
+import os
+
+# Build-time switches for build_template(). Unlike the template parameters
+# they decide which resources get generated at all. create.py reads them
+# from the environment of the build (e.g. `BIGID_MONITORING=1
+# bin/create.sh`), other tooling can pass a Config directly.
+
+
+def _flag(environ, name, default=False):
+    value = environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+class Config(object):
+
+    def __init__(self, split_services=False, dynamic_host_ports=False,
+                 load_balancer_type=None, fast_boot=False, ssm_amis=False,
+                 vpc_endpoints=False, launch_template=False,
+                 on_demand_scanner=False, monitoring=False,
+                 nested_stacks=False, build_dir="build", mongo_replicas=1,
+                 compact=True, health_checks=(), mongo_data_volume=False):
+        # One TaskDefinition/Service per bigid component, reached under
+        # their usual hostnames through ECS Service Connect and a Cloud Map
+        # namespace, instead of the single linked BigIdTask. Service
+        # Connect needs a recent ECS agent, so this takes the SSM AMIs;
+        # every component keeps its load balancer port, so it takes the
+        # elbv2 target groups too.
+        self.split_services = split_services
+
+        # Publish container ports on HostPort 0 so several tasks can share
+        # a host; needs the elbv2 target groups instead of the classic ELB
+        self.dynamic_host_ports = dynamic_host_ports
+
+        # "classic" ELB, or "elbv2": an ALB for the HTTP UI plus an NLB for
+        # the raw TCP ports, both routing through target groups
+        if load_balancer_type is None:
+            load_balancer_type = "elbv2" if dynamic_host_ports or \
+                split_services else "classic"
+        if load_balancer_type not in ("classic", "elbv2"):
+            raise ValueError("BIGID_LOAD_BALANCER must be classic or elbv2, "
+                             "not %r" % load_balancer_type)
+        if dynamic_host_ports and load_balancer_type == "classic":
+            raise ValueError("BIGID_DYNAMIC_HOST_PORTS needs "
+                             "BIGID_LOAD_BALANCER=elbv2")
+        if split_services and load_balancer_type == "classic":
+            # The classic ELB checks every port on the UI's health check
+            raise ValueError("BIGID_SPLIT_SERVICES needs "
+                             "BIGID_LOAD_BALANCER=elbv2")
+        if split_services and not ssm_amis:
+            raise ValueError("BIGID_SPLIT_SERVICES needs BIGID_SSM_AMIS")
+        if on_demand_scanner and not ssm_amis:
+            raise ValueError("BIGID_ON_DEMAND_SCANNER needs BIGID_SSM_AMIS")
+        self.load_balancer_type = load_balancer_type
+
+        # Poll for readiness instead of sleeping, and skip the full `yum
+        # update` at boot
+        self.fast_boot = fast_boot
+
+        # Resolve the latest ECS-optimized and Amazon Linux AMIs through
+        # SSM public parameters; without it the hard-coded region maps are
+        # used, which also keeps the template checkable without AWS access
+        self.ssm_amis = ssm_amis
+
+        # Interface endpoints for ECR and CloudWatch Logs plus an S3
+        # gateway endpoint, and images pulled from the stack region's
+        # registry, so image pulls and logs stay inside the VPC
+        self.vpc_endpoints = vpc_endpoints
+
+        # Launch container instances from a LaunchTemplate with a
+        # Spot/on-demand MixedInstancesPolicy, scaled by an ECS capacity
+        # provider
+        self.launch_template = launch_template
+
+        # bigid-scanner leaves BigIdTask for its own service that idles at
+        # zero tasks and is scaled by scan queue depth and nightly scan
+        # windows. bigid-orch still reaches it as bigid-scanner through
+        # Service Connect, which needs the SSM AMIs. Scaling in may stop a
+        # scanner in the middle of a scan, see add_scaling.
+        self.on_demand_scanner = on_demand_scanner
+
+        # CloudWatch dashboard and alarms for the cluster, load balancers
+        # and MongoDB hosts, with Container Insights and a CloudWatch agent
+        # on MongoDB
+        self.monitoring = monitoring
+
+        # Emit a parent stack with network, data, cluster and services
+        # nested stacks, written as <layer>.cfn.json into build_dir. The
+        # parent has to go through `aws cloudformation package`, which
+        # bin/create.sh and bin/update.sh do when BIGID_TEMPLATE_BUCKET is
+        # set.
+        self.nested_stacks = nested_stacks
+        self.build_dir = build_dir
+
+        # Members of the MongoDB replica set; 1 keeps the single dockerized
+        # mongod. The bigid images only take one MongoDB host, so they
+        # keep using the first member: the secondaries hold copies of the
+        # data but don't fail over for bigid.
+        if mongo_replicas < 1 or mongo_replicas % 2 == 0:
+            raise ValueError("BIGID_MONGO_REPLICAS must be an odd number, "
+                             "not %d" % mongo_replicas)
+        self.mongo_replicas = mongo_replicas
+
+        # Keep MongoDB's data on its own EBS volume, snapshotted when the
+        # stack deletes or replaces it, instead of the root volume. Off by
+        # default: on an existing stack the volume comes up empty and the
+        # data has to be moved onto it by hand.
+        self.mongo_data_volume = mongo_data_volume
+
+        # Write the templates without whitespace, about a third of the
+        # indented size, to stay under the --template-body limit.
+        # BIGID_COMPACT=0 indents them for reading.
+        self.compact = compact
+
+        # Containers that get a Docker health check on their first port.
+        # It connects through bash's /dev/tcp, so only list the images
+        # that ship bash.
+        self.health_checks = tuple(health_checks)
+
+    @classmethod
+    def from_environ(cls, environ=None):
+        if environ is None:
+            environ = os.environ
+        return cls(
+            split_services=_flag(environ, "BIGID_SPLIT_SERVICES"),
+            dynamic_host_ports=_flag(environ, "BIGID_DYNAMIC_HOST_PORTS"),
+            load_balancer_type=environ.get("BIGID_LOAD_BALANCER"),
+            fast_boot=_flag(environ, "BIGID_FAST_BOOT"),
+            ssm_amis=_flag(environ, "BIGID_SSM_AMIS"),
+            vpc_endpoints=_flag(environ, "BIGID_VPC_ENDPOINTS"),
+            launch_template=_flag(environ, "BIGID_LAUNCH_TEMPLATE"),
+            on_demand_scanner=_flag(environ, "BIGID_ON_DEMAND_SCANNER"),
+            monitoring=_flag(environ, "BIGID_MONITORING"),
+            nested_stacks=_flag(environ, "BIGID_NESTED_STACKS"),
+            build_dir=environ.get("BIGID_BUILD_DIR", "build"),
+            mongo_replicas=int(environ.get("BIGID_MONGO_REPLICAS", "1")),
+            mongo_data_volume=_flag(environ, "BIGID_MONGO_DATA_VOLUME"),
+            compact=_flag(environ, "BIGID_COMPACT", True),
+            health_checks=[name.strip() for name in
+                           environ.get("BIGID_HEALTH_CHECKS", "").split(",")
+                           if name.strip()],
+        )
@@ -0,0 +1,308 @@
+import re
+from collections import OrderedDict
+
+# Split of the generated template into nested stacks. Layers further down
+# only reference the ones above them, so a routine service deploy leaves
+# the network, MongoDB and container instance stacks unchanged and
+# CloudFormation skips them.
+layers = ["Network", "Data", "Cluster", "Services"]
+
+resource_type_layers = {
+    "AWS::EC2::SecurityGroup": "Network",
+    "AWS::EC2::VPCEndpoint": "Network",
+    "AWS::ElasticLoadBalancing::LoadBalancer": "Network",
+    "AWS::ElasticLoadBalancingV2::LoadBalancer": "Network",
+    "AWS::ElasticLoadBalancingV2::TargetGroup": "Network",
+    "AWS::ElasticLoadBalancingV2::Listener": "Network",
+    "AWS::ServiceDiscovery::PrivateDnsNamespace": "Network",
+    "AWS::EC2::Instance": "Data",
+    "AWS::EC2::Volume": "Data",
+    "AWS::EC2::VolumeAttachment": "Data",
+    "AWS::CloudFormation::WaitCondition": "Data",
+    "AWS::ServiceDiscovery::Instance": "Data",
+    "AWS::ECS::Cluster": "Cluster",
+    "AWS::ECS::CapacityProvider": "Cluster",
+    "AWS::ECS::ClusterCapacityProviderAssociations": "Cluster",
+    "AWS::IAM::Role": "Cluster",
+    "AWS::IAM::InstanceProfile": "Cluster",
+    "AWS::AutoScaling::LaunchConfiguration": "Cluster",
+    "AWS::EC2::LaunchTemplate": "Cluster",
+    "AWS::AutoScaling::AutoScalingGroup": "Cluster",
+    "AWS::AutoScaling::ScalingPolicy": "Cluster",
+    "AWS::ECS::TaskDefinition": "Services",
+    "AWS::ECS::Service": "Services",
+    "AWS::ServiceDiscovery::Service": "Services",
+    "AWS::Logs::LogGroup": "Services",
+    "AWS::ApplicationAutoScaling::ScalableTarget": "Services",
+    "AWS::ApplicationAutoScaling::ScalingPolicy": "Services",
+    "AWS::CloudWatch::Alarm": "Services",
+    "AWS::CloudWatch::Dashboard": "Services",
+    "AWS::SNS::Topic": "Services",
+    "AWS::SNS::Subscription": "Services",
+}
+
+# Resources that belong with another layer than their type's
+resource_title_layers = {
+    "MongoInstanceRole": "Data",
+    "MongoInstanceProfile": "Data",
+    "AppServiceRole": "Services",
+}
+
+_sub_reference = re.compile(r"\$\{([A-Za-z0-9]+)(?:\.([A-Za-z0-9.]+))?\}")
+
+
+def resource_layer(title, resource):
+    if title in resource_title_layers:
+        return resource_title_layers[title]
+    try:
+        return resource_type_layers[resource["Type"]]
+    except KeyError:
+        raise ValueError("No nested stack layer for %s (%s)"
+                         % (title, resource["Type"]))
+
+
+def child_parameter(parameter):
+    # The parent resolves SSM parameters; children get the value itself
+    parameter = dict(parameter)
+    match = re.match(r"AWS::SSM::Parameter::Value<(.+)>$", parameter["Type"])
+    if match:
+        parameter["Type"] = match.group(1)
+        parameter.pop("Default", None)
+    return parameter
+
+
+def parent_parameter_value(name, parameter):
+    # Stack parameters are strings, so lists are passed joined
+    if parameter["Type"].startswith("List<") or \
+            parameter["Type"] == "CommaDelimitedList":
+        return {"Fn::Join": [",", {"Ref": name}]}
+    return {"Ref": name}
+
+
+class _Layer(object):
+
+    def __init__(self, name, template):
+        self.name = name
+        self.template = template
+        self.resources = OrderedDict()
+        self.parameters = set()
+        self.mappings = set()
+        self.conditions = set()
+        self.condition_bodies = OrderedDict()
+        # child parameter -> (producing resource, attribute or None)
+        self.imports = OrderedDict()
+        # output name -> value
+        self.outputs = OrderedDict()
+        self.depends_on = set()
+
+    def import_name(self, title, attribute=None):
+        name = title + re.sub(r"[^A-Za-z0-9]", "", attribute or "")
+        self.imports[name] = (title, attribute)
+        return name
+
+    def rewrite(self, value, layer_of):
+        # Returns value with references to other layers' resources
+        # replaced by parameters, recording what the layer needs
+        if isinstance(value, list):
+            return [self.rewrite(item, layer_of) for item in value]
+        if not isinstance(value, dict):
+            return value
+        if len(value) == 1:
+            (function, argument), = value.items()
+            if function == "Ref":
+                if argument in self.template["Parameters"]:
+                    self.parameters.add(argument)
+                elif layer_of.get(argument, self.name) != self.name:
+                    return {"Ref": self.import_name(argument)}
+                return value
+            if function == "Fn::GetAtt":
+                title, attribute = argument
+                if layer_of.get(title, self.name) != self.name:
+                    return {"Ref": self.import_name(title, attribute)}
+                return value
+            if function == "Fn::Sub":
+                return {"Fn::Sub": self.rewrite_sub(argument, layer_of)}
+            if function == "Fn::FindInMap":
+                self.mappings.add(argument[0])
+            if function == "Fn::If":
+                self.conditions.add(argument[0])
+            if function == "Condition":
+                self.conditions.add(argument)
+        return OrderedDict(
+            (key, self.rewrite(item, layer_of))
+            for key, item in value.items()
+        )
+
+    def rewrite_sub(self, argument, layer_of):
+        if isinstance(argument, list):
+            body, variables = argument
+            variables = self.rewrite(variables, layer_of)
+        else:
+            body, variables = argument, {}
+
+        def replace(match):
+            title, attribute = match.groups()
+            if title in variables:
+                return match.group(0)
+            if title in self.template["Parameters"]:
+                self.parameters.add(title)
+            elif layer_of.get(title, self.name) != self.name:
+                return "${%s}" % self.import_name(title, attribute)
+            return match.group(0)
+
+        body = _sub_reference.sub(replace, body)
+        return [body, variables] if variables else body
+
+    def add(self, title, resource, layer_of):
+        resource = OrderedDict(resource)
+        depends_on = resource.pop("DependsOn", [])
+        if not isinstance(depends_on, list):
+            depends_on = [depends_on]
+        local_depends_on = []
+        for dependency in depends_on:
+            if layer_of[dependency] == self.name:
+                local_depends_on.append(dependency)
+            else:
+                self.depends_on.add(layer_of[dependency])
+        if local_depends_on:
+            resource["DependsOn"] = local_depends_on
+        if "Condition" in resource:
+            self.conditions.add(resource["Condition"])
+        self.resources[title] = self.rewrite(resource, layer_of)
+
+    def add_conditions(self):
+        # Conditions can build on other conditions and on parameters
+        pending = sorted(self.conditions)
+        while pending:
+            name = pending.pop()
+            if name not in self.condition_bodies:
+                self.condition_bodies[name] = self.rewrite(
+                    self.template["Conditions"][name], {})
+                pending.extend(self.conditions - set(self.condition_bodies))
+
+    def to_dict(self, description):
+        template = self.template
+        conditions = self.condition_bodies
+        child = OrderedDict([
+            ("AWSTemplateFormatVersion", "2010-09-09"),
+            ("Description", description),
+        ])
+        parameters = OrderedDict(
+            (name, child_parameter(template["Parameters"][name]))
+            for name in sorted(self.parameters)
+        )
+        for name in self.imports:
+            parameters[name] = {"Type": "String"}
+        if parameters:
+            child["Parameters"] = parameters
+        if self.mappings:
+            child["Mappings"] = OrderedDict(
+                (name, template["Mappings"][name])
+                for name in sorted(self.mappings)
+            )
+        if conditions:
+            child["Conditions"] = OrderedDict(sorted(conditions.items()))
+        child["Resources"] = self.resources
+        if self.outputs:
+            child["Outputs"] = OrderedDict(
+                (name, {"Value": value})
+                for name, value in self.outputs.items()
+            )
+        return child
+
+
+def split_template(template):
+    """Split a template dict into a parent stack and its nested stacks.
+
+    Returns the parent template dict and an OrderedDict of layer name ->
+    child template dict. The parent references each child through a
+    relative TemplateURL (network.cfn.json, ...) for `aws cloudformation
+    package` to upload.
+    """
+    template.setdefault("Parameters", {})
+    template.setdefault("Mappings", {})
+    template.setdefault("Conditions", {})
+
+    layer_of = dict(
+        (title, resource_layer(title, resource))
+        for title, resource in template["Resources"].items()
+    )
+    children = OrderedDict((name, _Layer(name, template)) for name in layers)
+    for title, resource in sorted(template["Resources"].items()):
+        children[layer_of[title]].add(title, resource, layer_of)
+    for layer in children.values():
+        layer.add_conditions()
+
+    # Every imported value becomes an output of the layer that owns it
+    def export(title, attribute):
+        producer = children[layer_of[title]]
+        name = title + re.sub(r"[^A-Za-z0-9]", "", attribute or "")
+        if attribute is None:
+            producer.outputs[name] = {"Ref": title}
+        else:
+            producer.outputs[name] = {"Fn::GetAtt": [title, attribute]}
+        return {"Fn::GetAtt": ["%sStack" % producer.name,
+                               "Outputs.%s" % name]}
+
+    # Root outputs are passed through from the owning layer
+    parent_layer = _Layer("Parent", template)
+    outputs = OrderedDict()
+    for name, output in sorted(template.get("Outputs", {}).items()):
+        output = parent_layer.rewrite(output, layer_of)
+        for import_name, (title, attribute) in parent_layer.imports.items():
+            output = _replace_ref(output, import_name, export(title, attribute))
+        outputs[name] = output
+
+    resources = OrderedDict()
+    for name, layer in children.items():
+        if not layer.resources:
+            continue
+        parameters = OrderedDict(
+            (parameter, parent_parameter_value(
+                parameter, template["Parameters"][parameter]))
+            for parameter in sorted(layer.parameters)
+        )
+        depends_on = set(layer.depends_on)
+        for import_name, (title, attribute) in layer.imports.items():
+            parameters[import_name] = export(title, attribute)
+            depends_on.add(layer_of[title])
+        stack = OrderedDict([
+            ("Type", "AWS::CloudFormation::Stack"),
+            ("Properties", OrderedDict([
+                ("TemplateURL", "%s.cfn.json" % name.lower()),
+            ])),
+        ])
+        if parameters:
+            stack["Properties"]["Parameters"] = parameters
+        if depends_on:
+            stack["DependsOn"] = sorted("%sStack" % d for d in depends_on)
+        resources["%sStack" % name] = stack
+
+    parent = OrderedDict([("AWSTemplateFormatVersion", "2010-09-09")])
+    for section in ["Description", "Metadata", "Parameters"]:
+        if template.get(section):
+            parent[section] = template[section]
+    parent["Resources"] = resources
+    if outputs:
+        parent["Outputs"] = outputs
+
+    description = template.get("Description", "BigID")
+    nested = OrderedDict(
+        (name, layer.to_dict("%s (%s)" % (description, name.lower())))
+        for name, layer in children.items()
+        if layer.resources
+    )
+    return parent, nested
+
+
+def _replace_ref(value, name, replacement):
+    if isinstance(value, list):
+        return [_replace_ref(item, name, replacement) for item in value]
+    if isinstance(value, dict):
+        if value == {"Ref": name}:
+            return replacement
+        return OrderedDict(
+            (key, _replace_ref(item, name, replacement))
+            for key, item in value.items()
+        )
+    return value
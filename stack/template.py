@@ -1,6 +1,114 @@
+import json
+from collections import OrderedDict
+
 from troposphere import (
     Template,
 )
 
-# The CloudFormation template
-template = Template()
+from stack.vpc import add_parameters
+from stack.cluster.infrastructure import add_infrastructure
+from stack.cluster.mongo import add_mongo
+from stack.cluster.sizing import add_container_sizing
+from stack.cluster.logs import add_log_groups
+from stack.cluster.main import add_services
+from stack.cluster.scaling import add_scaling
+
+# CloudFormation's limits on the size of a template: passed inline with
+# --template-body, and read from S3 with --template-url
+template_body_limit = 51200
+template_url_limit = 1000000
+
+
+class Build(object):
+    # One build_template() run: the template being built, its config, and
+    # what each step added that later steps build on
+
+    def __init__(self, template, config):
+        self.template = template
+        self.config = config
+
+    def add(self, **values):
+        self.__dict__.update(values)
+
+
+def build_template(config):
+    """Return a new CloudFormation Template built for config.
+
+    Each call starts from an empty Template, so one process can build
+    any number of variants. The steps of optional components are only
+    imported when config asks for them, which keeps create.py's startup
+    to the modules it needs.
+    """
+    build = Build(Template(), config)
+    add_parameters(build)
+    add_infrastructure(build)
+    add_mongo(build)
+    add_container_sizing(build)
+    add_log_groups(build)
+    if config.split_services or config.on_demand_scanner:
+        from stack.cluster.discovery import add_discovery
+        add_discovery(build)
+    add_services(build)
+    add_scaling(build)
+    if config.vpc_endpoints:
+        from stack.cluster.endpoints import add_endpoints
+        add_endpoints(build)
+    if config.monitoring:
+        from stack.cluster.monitoring import add_monitoring
+        add_monitoring(build)
+    return build.template
+
+
+def render_template(config):
+    """Return the JSON of the template built for config and of its nested
+    stacks.
+
+    The nested stacks are an OrderedDict of file name -> JSON, empty unless
+    config.nested_stacks is set. The parent references them by these
+    names, relative to its own location. With config.compact the JSON
+    has no whitespace at all.
+    """
+    template = build_template(config).to_dict()
+    if not config.nested_stacks:
+        return _dumps(template, config.compact), OrderedDict()
+
+    from stack.nested import split_template
+    parent, nested = split_template(template)
+    children = OrderedDict(
+        ("%s.cfn.json" % layer.lower(), _dumps(child, config.compact))
+        for layer, child in nested.items()
+    )
+    return _dumps(parent, config.compact), children
+
+
+def size_report(template, nested):
+    """Return a line per rendered file on its size against CloudFormation's
+    limits.
+
+    template is deployed inline unless it is over template_body_limit;
+    the nested stacks are always read from S3.
+    """
+    lines = []
+    files = [("template", template)] + list(nested.items())
+    for name, content in files:
+        size = len(content.encode("utf-8"))
+        if size > template_url_limit:
+            status = "over the %d-byte limit even from S3" % \
+                template_url_limit
+        elif name == "template" and size > template_body_limit:
+            status = "over the %d-byte --template-body limit, deploy it " \
+                "from S3" % template_body_limit
+        else:
+            limit = template_body_limit if name == "template" \
+                else template_url_limit
+            status = "%d%% of the %d-byte limit" % (size * 100 // limit,
+                                                     limit)
+        lines.append("%s: %d bytes, %s" % (name, size, status))
+    return lines
+
+
+def _dumps(template, compact=False):
+    if compact:
+        return json.dumps(template, sort_keys=True, separators=(',', ':'))
+    return json.dumps(template, indent=4, sort_keys=True,
+                      separators=(',', ': '))
@@ -1,70 +1,681 @@
+from collections import OrderedDict
+
 from troposphere import (
+    Equals,
+    Not,
     Parameter,
 	Ref
 )
 
-from stack.template import template
-
-vpc_id = template.add_parameter(Parameter(
-	"VPCID",
-	Description="Select Your VPC ID",
-	Type="AWS::EC2::VPC::Id",
-))
-
-public_subnet = template.add_parameter(Parameter(
-	"PublicSubnet",
-	Description="Select Your Public Subnet ID",
-	Type="AWS::EC2::Subnet::Id",
-))
-
-instance_type = Ref(template.add_parameter(Parameter(
-    "InstanceType",
-    Description="Select Instance Type",
-    Type="String",
-    Default="t2.large",
-    AllowedValues=["t2.large", "t2.xlarge", "m4.large", "m4.xlarge"]
-)))
-
-secret_key = template.add_parameter(Parameter(
-    "KeyPair",
-    Description="Select Key Pair",
-    Type="AWS::EC2::KeyPair::KeyName"
-))
-
-aws_access_key = template.add_parameter(Parameter(
-    "AWSACCESSKEY",
-    Description="Enter Your AWS Access Key ID",
-    Type="String",
-	NoEcho=True
-))
-
-aws_secret_key = template.add_parameter(Parameter(
-    "AWSSECRETKEY",
-    Description="Enter Your AWS Secret Key",
-    Type="String",
-	NoEcho=True
-))
-
-
-template.add_metadata({
-    'AWS::CloudFormation::Interface': {
-        'ParameterGroups': [
-            {
-                'Label': {'default': 'Network Configuration'},
-                'Parameters': ["VPCID", "PublicSubnet"]
-            },
-			{
-                'Label': {'default': 'App Configuration'},
-                'Parameters': ["InstanceType", "KeyPair", "AWSACCESSKEY", "AWSSECRETKEY"]
-            },
-        ],
-        'ParameterLabels': {
-            'VPCID': {"default" : "VPC ID"},
-			'PublicSubnet': {"default" : "Public Subnet ID"},
-			'InstanceType': {"default" : "Instance Type"},
-			'KeyPair': {"default" : "Key Pair"},
-			'AWSACCESSKEY': {"default" : "AWS_ACCESS_KEY"},
-			'AWSSECRETKEY': {"default" : "AWS_SECRET_KEY"},
-        }
+
+def add_parameters(build):
+    template, config = build.template, build.config
+
+    vpc_id = template.add_parameter(Parameter(
+        "VPCID",
+        Description="Select Your VPC ID",
+        Type="AWS::EC2::VPC::Id",
+    ))
+
+    # An ALB takes subnets in at least two zones; the classic ELB takes one
+    if config.load_balancer_type == "elbv2":
+        subnets_description = ("Select Your Public Subnet IDs, one per "
+                               "Availability Zone; the load balancers need "
+                               "at least two and the first one hosts MongoDB")
+    else:
+        subnets_description = ("Select Your Public Subnet IDs, one per "
+                               "Availability Zone; the first one hosts "
+                               "MongoDB")
+
+    public_subnets = template.add_parameter(Parameter(
+        "PublicSubnets",
+        Description=subnets_description,
+        Type="List<AWS::EC2::Subnet::Id>",
+    ))
+
+    instance_type = Ref(template.add_parameter(Parameter(
+        "InstanceType",
+        Description="Select Instance Type",
+        Type="String",
+        Default="t2.large",
+        AllowedValues=["t2.large", "t2.xlarge", "m4.large", "m4.xlarge"]
+    )))
+
+    mongo_instance_type = Ref(template.add_parameter(Parameter(
+        "MongoInstanceType",
+        Description="Select MongoDB Instance Type; the r families keep more "
+                    "of the working set in the WiredTiger cache",
+        Type="String",
+        Default="t2.large",
+        AllowedValues=[
+            "t2.large", "t2.xlarge", "m4.large", "m4.xlarge", "m4.2xlarge",
+            "m5.large", "m5.xlarge", "m5.2xlarge",
+            "r4.large", "r4.xlarge", "r4.2xlarge",
+            "r5.large", "r5.xlarge", "r5.2xlarge",
+        ]
+    )))
+
+    secret_key = template.add_parameter(Parameter(
+        "KeyPair",
+        Description="Select Key Pair",
+        Type="AWS::EC2::KeyPair::KeyName"
+    ))
+
+    aws_access_key = template.add_parameter(Parameter(
+        "AWSACCESSKEY",
+        Description="Enter Your AWS Access Key ID",
+        Type="String",
+        NoEcho=True
+    ))
+
+    aws_secret_key = template.add_parameter(Parameter(
+        "AWSSECRETKEY",
+        Description="Enter Your AWS Secret Key",
+        Type="String",
+        NoEcho=True
+    ))
+
+    cluster_min_size = template.add_parameter(Parameter(
+        "ClusterMinSize",
+        Description="Minimum number of ECS container instances",
+        Type="Number",
+        Default="1",
+        MinValue="1",
+    ))
+
+    cluster_max_size = template.add_parameter(Parameter(
+        "ClusterMaxSize",
+        Description="Maximum number of ECS container instances",
+        Type="Number",
+        Default="4",
+        MinValue="1",
+    ))
+
+    cluster_reservation_target = template.add_parameter(Parameter(
+        "ClusterReservationTarget",
+        Description="Target capacity provider reservation (%) of the ECS "
+                    "cluster; below 100 keeps spare instances running",
+        Type="Number",
+        Default="100",
+        MinValue="10",
+        MaxValue="100",
+    ))
+
+    service_min_count = template.add_parameter(Parameter(
+        "ServiceMinCount",
+        Description="Minimum number of running BigId (scanner, when split) tasks",
+        Type="Number",
+        Default="1",
+        MinValue="1",
+    ))
+
+    service_max_count = template.add_parameter(Parameter(
+        "ServiceMaxCount",
+        Description="Maximum number of running BigId (scanner, when split) tasks",
+        Type="Number",
+        Default="4",
+        MinValue="1",
+    ))
+
+    service_cpu_target = template.add_parameter(Parameter(
+        "ServiceCpuTarget",
+        Description="Target average CPU utilization (%) of the BigId service",
+        Type="Number",
+        Default="70",
+        MinValue="10",
+        MaxValue="100",
+    ))
+
+    service_memory_target = template.add_parameter(Parameter(
+        "ServiceMemoryTarget",
+        Description="Target average memory utilization (%) of the BigId service",
+        Type="Number",
+        Default="80",
+        MinValue="10",
+        MaxValue="100",
+    ))
+
+    task_placement = template.add_parameter(Parameter(
+        "TaskPlacement",
+        Description="Tasks are balanced across Availability Zones first; within "
+                    "a zone binpack fills one instance's memory before using the "
+                    "next, spread places tasks on distinct instances first",
+        Type="String",
+        Default="binpack",
+        AllowedValues=["binpack", "spread"],
+    ))
+
+    template.add_condition("SpreadTasks", Equals(Ref(task_placement), "spread"))
+
+    health_check_interval = template.add_parameter(Parameter(
+        "HealthCheckInterval",
+        Description="Seconds between load balancer health checks",
+        Type="Number",
+        Default="10",
+        # The only intervals a Network Load Balancer accepts
+        AllowedValues=["10", "30"],
+    ))
+
+    deregistration_delay = template.add_parameter(Parameter(
+        "DeregistrationDelay",
+        Description="Seconds in-flight requests get to drain from a stopping task",
+        Type="Number",
+        Default="30",
+        MinValue="0",
+        MaxValue="3600",
+    ))
+
+    idle_timeout = template.add_parameter(Parameter(
+        "IdleTimeout",
+        Description="Seconds an idle client connection is kept open",
+        Type="Number",
+        Default="60",
+        MinValue="1",
+        MaxValue="4000",
+    ))
+
+    deployment_minimum_healthy_percent = template.add_parameter(Parameter(
+        "DeploymentMinimumHealthyPercent",
+        Description="Share (%) of a service's tasks that must stay running "
+                    "during a deploy",
+        Type="Number",
+        Default="100",
+        MinValue="0",
+        MaxValue="100",
+    ))
+
+    deployment_maximum_percent = template.add_parameter(Parameter(
+        "DeploymentMaximumPercent",
+        Description="Upper bound (%) of a service's tasks during a deploy; "
+                    "above 100 new tasks start before the old ones stop",
+        Type="Number",
+        Default="200",
+        MinValue="100",
+        MaxValue="400",
+    ))
+
+    rolling_update_batch_size = template.add_parameter(Parameter(
+        "RollingUpdateBatchSize",
+        Description="Container instances replaced at once when their launch "
+                    "configuration changes",
+        Type="Number",
+        Default="1",
+        MinValue="1",
+    ))
+
+    rolling_update_pause_time = template.add_parameter(Parameter(
+        "RollingUpdatePauseTime",
+        Description="How long a replaced batch gets to join the cluster, as an "
+                    "ISO 8601 duration",
+        Type="String",
+        Default="PT10M",
+        AllowedPattern="PT([0-9]+H)?([0-9]+M)?([0-9]+S)?",
+        ConstraintDescription="must be an ISO 8601 duration such as PT10M",
+    ))
+
+    log_retention_days = template.add_parameter(Parameter(
+        "LogRetentionDays",
+        Description="Days the container logs are kept in CloudWatch Logs",
+        Type="Number",
+        Default="30",
+        AllowedValues=["1", "3", "5", "7", "14", "30", "60", "90", "120", "150",
+                       "180", "365", "400", "545", "731", "1827", "3653"],
+    ))
+
+    image_pull_behavior = template.add_parameter(Parameter(
+        "ImagePullBehavior",
+        Description="How the ECS agent pulls task images; prefer-cached only "
+                    "pulls an image the instance doesn't have yet",
+        Type="String",
+        Default="prefer-cached",
+        AllowedValues=["default", "always", "once", "prefer-cached"],
+    ))
+
+    image_cleanup_interval = template.add_parameter(Parameter(
+        "ImageCleanupInterval",
+        Description="How often the ECS agent removes unused images, e.g. 30m",
+        Type="String",
+        Default="30m",
+        AllowedPattern="[0-9]+[smh]",
+        ConstraintDescription="must be a duration such as 30m or 3h",
+    ))
+
+    image_minimum_cleanup_age = template.add_parameter(Parameter(
+        "ImageMinimumCleanupAge",
+        Description="How long an image stays cached after its last task stopped",
+        Type="String",
+        Default="3h",
+        AllowedPattern="[0-9]+[smh]",
+        ConstraintDescription="must be a duration such as 30m or 3h",
+    ))
+
+    images_deleted_per_cycle = template.add_parameter(Parameter(
+        "ImagesDeletedPerCycle",
+        Description="Maximum number of images removed per cleanup cycle",
+        Type="Number",
+        Default="5",
+        MinValue="1",
+        MaxValue="100",
+    ))
+
+    pre_pull_images = template.add_parameter(Parameter(
+        "PrePullImages",
+        Description="Pull all bigid images in parallel while an instance boots, "
+                    "before it joins the cluster",
+        Type="String",
+        Default="true",
+        AllowedValues=["true", "false"],
+    ))
+
+    build.add(
+        vpc_id=vpc_id,
+        public_subnets=public_subnets,
+        instance_type=instance_type,
+        mongo_instance_type=mongo_instance_type,
+        secret_key=secret_key,
+        aws_access_key=aws_access_key,
+        aws_secret_key=aws_secret_key,
+        cluster_min_size=cluster_min_size,
+        cluster_max_size=cluster_max_size,
+        cluster_reservation_target=cluster_reservation_target,
+        service_min_count=service_min_count,
+        service_max_count=service_max_count,
+        service_cpu_target=service_cpu_target,
+        service_memory_target=service_memory_target,
+        task_placement=task_placement,
+        health_check_interval=health_check_interval,
+        deregistration_delay=deregistration_delay,
+        idle_timeout=idle_timeout,
+        deployment_minimum_healthy_percent=deployment_minimum_healthy_percent,
+        deployment_maximum_percent=deployment_maximum_percent,
+        rolling_update_batch_size=rolling_update_batch_size,
+        rolling_update_pause_time=rolling_update_pause_time,
+        log_retention_days=log_retention_days,
+        image_pull_behavior=image_pull_behavior,
+        image_cleanup_interval=image_cleanup_interval,
+        image_minimum_cleanup_age=image_minimum_cleanup_age,
+        images_deleted_per_cycle=images_deleted_per_cycle,
+        pre_pull_images=pre_pull_images,
+    )
+
+    if config.launch_template:
+        on_demand_base_capacity = template.add_parameter(Parameter(
+            "OnDemandBaseCapacity",
+            Description="Container instances that are always on-demand",
+            Type="Number",
+            Default="1",
+            MinValue="0",
+        ))
+
+        on_demand_percentage = template.add_parameter(Parameter(
+            "OnDemandPercentage",
+            Description="Share (%) of the instances above the base capacity "
+                        "that is on-demand; the rest are Spot instances",
+            Type="Number",
+            Default="50",
+            MinValue="0",
+            MaxValue="100",
+        ))
+
+        build.add(
+            on_demand_base_capacity=on_demand_base_capacity,
+            on_demand_percentage=on_demand_percentage,
+        )
+
+    if config.on_demand_scanner:
+        scanner_min_count = template.add_parameter(Parameter(
+            "ScannerMinCount",
+            Description="bigid-scanner tasks kept running while no scan is queued",
+            Type="Number",
+            Default="0",
+            MinValue="0",
+        ))
+
+        scanner_max_count = template.add_parameter(Parameter(
+            "ScannerMaxCount",
+            Description="Maximum number of parallel bigid-scanner tasks",
+            Type="Number",
+            Default="4",
+            MinValue="1",
+        ))
+
+        scan_queue_metric_namespace = template.add_parameter(Parameter(
+            "ScanQueueMetricNamespace",
+            Description="CloudWatch namespace of the scan queue depth metric",
+            Type="String",
+            Default="BigId",
+        ))
+
+        scan_queue_metric_name = template.add_parameter(Parameter(
+            "ScanQueueMetricName",
+            Description="CloudWatch metric counting the queued scans, published "
+                        "by the orchestrator with a ClusterName dimension",
+            Type="String",
+            Default="PendingScans",
+        ))
+
+        nightly_scan_start = template.add_parameter(Parameter(
+            "NightlyScanStart",
+            Description="When the nightly full scan window opens (UTC)",
+            Type="String",
+            Default="cron(0 1 * * ? *)",
+        ))
+
+        nightly_scan_end = template.add_parameter(Parameter(
+            "NightlyScanEnd",
+            Description="When the nightly full scan window closes (UTC)",
+            Type="String",
+            Default="cron(0 6 * * ? *)",
+        ))
+
+        nightly_scanner_count = template.add_parameter(Parameter(
+            "NightlyScannerCount",
+            Description="bigid-scanner tasks kept running during the nightly "
+                        "scan window",
+            Type="Number",
+            Default="2",
+            MinValue="0",
+        ))
+
+        build.add(
+            scanner_min_count=scanner_min_count,
+            scanner_max_count=scanner_max_count,
+            scan_queue_metric_namespace=scan_queue_metric_namespace,
+            scan_queue_metric_name=scan_queue_metric_name,
+            nightly_scan_start=nightly_scan_start,
+            nightly_scan_end=nightly_scan_end,
+            nightly_scanner_count=nightly_scanner_count,
+        )
+
+    if config.monitoring:
+        alarm_email = template.add_parameter(Parameter(
+            "AlarmEmail",
+            Description="Email address notified of the stack's alarms; leave "
+                        "empty to only show them in the CloudWatch console",
+            Type="String",
+            Default="",
+        ))
+
+        template.add_condition("HasAlarmEmail", Not(Equals(Ref(alarm_email), "")))
+
+        build.add(alarm_email=alarm_email)
+
+    if config.ssm_amis:
+        ecs_image_id = template.add_parameter(Parameter(
+            "ECSImageId",
+            Description="SSM parameter holding the ECS-optimized AMI ID",
+            Type="AWS::SSM::Parameter::Value<AWS::EC2::Image::Id>",
+            Default="/aws/service/ecs/optimized-ami/amazon-linux-2/recommended/image_id",
+        ))
+
+        mongo_image_id = template.add_parameter(Parameter(
+            "MongoImageId",
+            Description="SSM parameter holding the Amazon Linux AMI ID for MongoDB",
+            Type="AWS::SSM::Parameter::Value<AWS::EC2::Image::Id>",
+            Default="/aws/service/ami-amazon-linux-latest/amzn2-ami-hvm-x86_64-gp2",
+        ))
+
+        # For the non-blocking log mode, see add_log_groups
+        log_max_buffer_size = template.add_parameter(Parameter(
+            "LogMaxBufferSize",
+            Description="Per-container buffer for log lines not yet shipped to "
+                        "CloudWatch Logs; lines beyond it are dropped rather than "
+                        "blocking the container",
+            Type="String",
+            Default="4m",
+            AllowedPattern="[0-9]+[kmg]?",
+            ConstraintDescription="must be a size such as 512k or 4m",
+        ))
+
+        build.add(
+            ecs_image_id=ecs_image_id,
+            mongo_image_id=mongo_image_id,
+            log_max_buffer_size=log_max_buffer_size,
+        )
+
+    if config.mongo_data_volume:
+        mongo_volume_type = template.add_parameter(Parameter(
+            "MongoVolumeType",
+            Description="EBS volume type of the MongoDB data volume",
+            Type="String",
+            Default="gp3",
+            AllowedValues=["gp3", "io2"],
+        ))
+
+        mongo_volume_size = template.add_parameter(Parameter(
+            "MongoVolumeSize",
+            Description="Size (GiB) of the MongoDB data volume",
+            Type="Number",
+            Default="100",
+            MinValue="10",
+            MaxValue="16384",
+        ))
+
+        # gp3 takes 3000 to 16000 IOPS and io2 100 to 64000; the parameter
+        # can only have one range, so it starts at gp3's baseline
+        mongo_volume_iops = template.add_parameter(Parameter(
+            "MongoVolumeIops",
+            Description="Provisioned IOPS of the MongoDB data volume, up to "
+                        "16000 for gp3 and 64000 for io2",
+            Type="Number",
+            Default="3000",
+            MinValue="3000",
+            MaxValue="64000",
+        ))
+
+        mongo_volume_throughput = template.add_parameter(Parameter(
+            "MongoVolumeThroughput",
+            Description="Throughput (MiB/s) of a gp3 MongoDB data volume",
+            Type="Number",
+            Default="125",
+            MinValue="125",
+            MaxValue="1000",
+        ))
+
+        template.add_condition("MongoVolumeIsGp3",
+                               Equals(Ref(mongo_volume_type), "gp3"))
+
+        build.add(
+            mongo_volume_type=mongo_volume_type,
+            mongo_volume_size=mongo_volume_size,
+            mongo_volume_iops=mongo_volume_iops,
+            mongo_volume_throughput=mongo_volume_throughput,
+        )
+
+    if config.vpc_endpoints:
+        route_table_ids = template.add_parameter(Parameter(
+            "RouteTableIds",
+            Description="Route tables of the instance subnets, for the S3 "
+                        "gateway endpoint",
+            Type="CommaDelimitedList",
+        ))
+
+        build.add(route_table_ids=route_table_ids)
+
+    if config.mongo_replicas > 1:
+        mongo_subnets = template.add_parameter(Parameter(
+            "MongoSubnets",
+            Description="One subnet per MongoDB replica set member, ideally in "
+                        "different Availability Zones",
+            Type="List<AWS::EC2::Subnet::Id>",
+        ))
+
+        # Only the name goes through the template: the members read the key
+        # at boot, so it never shows in their UserData
+        mongo_key_file = template.add_parameter(Parameter(
+            "MongoKeyFileParameter",
+            Description="SSM SecureString parameter holding the shared secret "
+                        "the replica set members authenticate each other "
+                        "with, 6 to 1024 base64 characters",
+            Type="String",
+            Default="/bigid/mongo-keyfile",
+            AllowedPattern="/[A-Za-z0-9_.\\-/]+",
+            ConstraintDescription="must be a parameter path starting with /",
+        ))
+
+        mongo_read_preference = template.add_parameter(Parameter(
+            "MongoReadPreference",
+            Description="Read preference in the MongoConnectionString output, "
+                        "for clients other than bigid",
+            Type="String",
+            Default="primary",
+            AllowedValues=["primary", "primaryPreferred", "secondary",
+                           "secondaryPreferred", "nearest"],
+        ))
+
+        build.add(
+            mongo_subnets=mongo_subnets,
+            mongo_key_file=mongo_key_file,
+            mongo_read_preference=mongo_read_preference,
+        )
+
+    # Console parameter groups, by label
+    parameter_groups = OrderedDict([
+        ('Network Configuration', ["VPCID", "PublicSubnets"]),
+        ('App Configuration', ["InstanceType", "KeyPair", "AWSACCESSKEY", "AWSSECRETKEY"]),
+        ('MongoDB Configuration', ["MongoInstanceType"]),
+        ('Load Balancer Configuration', [
+            "HealthCheckInterval", "DeregistrationDelay", "IdleTimeout",
+        ]),
+        ('Deployment Configuration', [
+            "DeploymentMinimumHealthyPercent", "DeploymentMaximumPercent",
+            "RollingUpdateBatchSize", "RollingUpdatePauseTime",
+        ]),
+        ('Logging and Monitoring', ["LogRetentionDays"]),
+        ('Container Instance Configuration', [
+            "ImagePullBehavior", "ImageCleanupInterval", "ImageMinimumCleanupAge",
+            "ImagesDeletedPerCycle", "PrePullImages",
+        ]),
+        ('Scaling Configuration', [
+            "ClusterMinSize", "ClusterMaxSize", "ClusterReservationTarget",
+            "ServiceMinCount", "ServiceMaxCount",
+            "ServiceCpuTarget", "ServiceMemoryTarget", "TaskPlacement",
+        ]),
+    ])
+
+    parameter_labels = {
+        'VPCID': {"default" : "VPC ID"},
+        'PublicSubnets': {"default" : "Public Subnet IDs"},
+        'InstanceType': {"default" : "Instance Type"},
+        'KeyPair': {"default" : "Key Pair"},
+        'MongoInstanceType': {"default": "MongoDB Instance Type"},
+        'AWSACCESSKEY': {"default" : "AWS_ACCESS_KEY"},
+        'AWSSECRETKEY': {"default" : "AWS_SECRET_KEY"},
+        'ClusterMinSize': {"default": "Min Container Instances"},
+        'ClusterMaxSize': {"default": "Max Container Instances"},
+        'ClusterReservationTarget': {"default": "Cluster Reservation Target (%)"},
+        'ServiceMinCount': {"default": "Min BigId Tasks"},
+        'ServiceMaxCount': {"default": "Max BigId Tasks"},
+        'ServiceCpuTarget': {"default": "Service CPU Target (%)"},
+        'ServiceMemoryTarget': {"default": "Service Memory Target (%)"},
+        'TaskPlacement': {"default": "Task Placement"},
+        'HealthCheckInterval': {"default": "Health Check Interval"},
+        'DeregistrationDelay': {"default": "Deregistration Delay"},
+        'IdleTimeout': {"default": "Idle Timeout"},
+        'DeploymentMinimumHealthyPercent': {"default": "Minimum Healthy Percent"},
+        'DeploymentMaximumPercent': {"default": "Maximum Percent"},
+        'RollingUpdateBatchSize': {"default": "Rolling Update Batch Size"},
+        'RollingUpdatePauseTime': {"default": "Rolling Update Pause Time"},
+        'LogRetentionDays': {"default": "Log Retention (days)"},
+        'ImagePullBehavior': {"default": "Image Pull Behavior"},
+        'ImageCleanupInterval': {"default": "Image Cleanup Interval"},
+        'ImageMinimumCleanupAge': {"default": "Minimum Image Age"},
+        'ImagesDeletedPerCycle': {"default": "Images Deleted Per Cycle"},
+        'PrePullImages': {"default": "Pre-pull Images"},
     }
-})
\ No newline at end of file
+
+    if config.launch_template:
+        parameter_groups['Container Instance Configuration'] += [
+            "OnDemandBaseCapacity", "OnDemandPercentage",
+        ]
+        parameter_labels['OnDemandBaseCapacity'] = {"default": "On-Demand Base Capacity"}
+        parameter_labels['OnDemandPercentage'] = {"default": "On-Demand Percentage"}
+
+    if config.on_demand_scanner:
+        parameter_groups['Scanner Configuration'] = [
+            "ScannerMinCount", "ScannerMaxCount",
+            "ScanQueueMetricNamespace", "ScanQueueMetricName",
+            "NightlyScanStart", "NightlyScanEnd", "NightlyScannerCount",
+        ]
+        parameter_labels['ScannerMinCount'] = {"default": "Min Scanner Tasks"}
+        parameter_labels['ScannerMaxCount'] = {"default": "Max Scanner Tasks"}
+        parameter_labels['ScanQueueMetricNamespace'] = {"default": "Scan Queue Metric Namespace"}
+        parameter_labels['ScanQueueMetricName'] = {"default": "Scan Queue Metric Name"}
+        parameter_labels['NightlyScanStart'] = {"default": "Nightly Scan Start"}
+        parameter_labels['NightlyScanEnd'] = {"default": "Nightly Scan End"}
+        parameter_labels['NightlyScannerCount'] = {"default": "Nightly Scanner Tasks"}
+
+    if config.monitoring:
+        parameter_groups['Logging and Monitoring'].append("AlarmEmail")
+        parameter_labels['AlarmEmail'] = {"default": "Alarm Email"}
+
+    if config.vpc_endpoints:
+        parameter_groups['Network Configuration'].append("RouteTableIds")
+        parameter_labels['RouteTableIds'] = {"default": "Route Table IDs"}
+
+    if config.ssm_amis:
+        parameter_groups['App Configuration'].append("ECSImageId")
+        parameter_groups['MongoDB Configuration'].insert(1, "MongoImageId")
+        parameter_groups['Logging and Monitoring'].insert(1, "LogMaxBufferSize")
+        parameter_labels['ECSImageId'] = {"default": "ECS AMI Parameter"}
+        parameter_labels['MongoImageId'] = {"default": "MongoDB AMI Parameter"}
+        parameter_labels['LogMaxBufferSize'] = {"default": "Log Buffer Size"}
+
+    if config.mongo_data_volume:
+        parameter_groups['MongoDB Configuration'] += [
+            "MongoVolumeType", "MongoVolumeSize", "MongoVolumeIops",
+            "MongoVolumeThroughput",
+        ]
+        parameter_labels['MongoVolumeType'] = {"default": "MongoDB Volume Type"}
+        parameter_labels['MongoVolumeSize'] = {"default": "MongoDB Volume Size (GiB)"}
+        parameter_labels['MongoVolumeIops'] = {"default": "MongoDB Volume IOPS"}
+        parameter_labels['MongoVolumeThroughput'] = {"default": "MongoDB Volume Throughput (MiB/s)"}
+
+    if config.mongo_replicas > 1:
+        parameter_groups['Network Configuration'].append("MongoSubnets")
+        parameter_groups['MongoDB Configuration'] += ["MongoKeyFileParameter", "MongoReadPreference"]
+        parameter_labels['MongoSubnets'] = {"default": "MongoDB Subnets"}
+        parameter_labels['MongoKeyFileParameter'] = {"default": "MongoDB Key File SSM Parameter"}
+        parameter_labels['MongoReadPreference'] = {"default": "MongoDB Read Preference"}
+
+    if config.split_services or config.on_demand_scanner:
+        discovery_namespace = template.add_parameter(Parameter(
+            "DiscoveryNamespace",
+            Description="Private DNS namespace the bigid services register in",
+            Type="String",
+            Default="bigid.local",
+        ))
+        parameter_groups['Service Configuration'] = ["DiscoveryNamespace"]
+        parameter_labels['DiscoveryNamespace'] = {"default": "Discovery Namespace"}
+        build.add(discovery_namespace=discovery_namespace)
+
+    if config.split_services:
+        # The scanner is sized by ServiceMinCount/ServiceMaxCount instead
+        component_desired_counts = {}
+        for component in ["web", "orch", "corr", "ui"]:
+            title = "%sDesiredCount" % component.capitalize()
+            component_desired_counts["bigid-%s" % component] = \
+                template.add_parameter(Parameter(
+                    title,
+                    Description="Number of running bigid-%s tasks" % component,
+                    Type="Number",
+                    Default="1",
+                    MinValue="1",
+                ))
+            parameter_labels[title] = {"default": "bigid-%s Tasks" % component}
+
+        parameter_groups['Service Configuration'] += [
+            p.title for p in component_desired_counts.values()
+        ]
+
+        build.add(component_desired_counts=component_desired_counts)
+
+    template.add_metadata({
+        'AWS::CloudFormation::Interface': {
+            'ParameterGroups': [
+                {'Label': {'default': label}, 'Parameters': parameters}
+                for label, parameters in parameter_groups.items()
+            ],
+            'ParameterLabels': parameter_labels,
+        }
+    })
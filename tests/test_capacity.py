@@ -0,0 +1,94 @@
+from tools.capacity import (
+    CPU,
+    MEMORY,
+    PORTS,
+    Host,
+    Task,
+    pack,
+    plan_capacity,
+    tasks_per_host,
+)
+
+
+def task_definition(memory, cpu=256, host_port=None, network_mode=None):
+    container = {"Name": "app", "Memory": memory, "Cpu": cpu}
+    if host_port is not None:
+        container["PortMappings"] = [
+            {"ContainerPort": 80, "HostPort": host_port}]
+    properties = {"ContainerDefinitions": [container]}
+    if network_mode:
+        properties["NetworkMode"] = network_mode
+    return {"Type": "AWS::ECS::TaskDefinition", "Properties": properties}
+
+
+def template(definition, instance_types=("t2.large",), desired_count=2):
+    return {
+        "Parameters": {
+            "InstanceType": {"Type": "String",
+                             "Default": instance_types[0],
+                             "AllowedValues": list(instance_types)},
+            "ClusterMaxSize": {"Type": "String", "Default": "4"},
+        },
+        "Mappings": {},
+        "Resources": {
+            "AppTask": definition,
+            "AppService": {
+                "Type": "AWS::ECS::Service",
+                "Properties": {"TaskDefinition": {"Ref": "AppTask"},
+                               "DesiredCount": desired_count},
+            },
+        },
+    }
+
+
+def task(definition, instance_type="t2.large"):
+    return Task("AppTask", definition, template(definition), instance_type)
+
+
+def test_fixed_host_port_allows_one_task_per_host():
+    count, blockers = tasks_per_host(
+        task(task_definition(1024, host_port=80)), "t2.large")
+
+    assert count == 1
+    assert blockers == [PORTS]
+
+
+def test_dynamic_host_port_fills_host_memory():
+    count, blockers = tasks_per_host(
+        task(task_definition(1024, host_port=0)), "t2.large")
+
+    assert count == Host("t2.large").memory // 1024
+    assert blockers == [MEMORY]
+
+
+def test_pack_returns_none_for_a_task_that_fits_no_host():
+    assert pack([task(task_definition(16384))], "t2.large") is None
+
+
+def test_pack_spreads_port_bound_tasks():
+    definition = task_definition(1024, host_port=80)
+
+    hosts = pack([task(definition), task(definition)], "t2.large")
+
+    assert len(hosts) == 2
+
+
+def test_plan_reports_task_that_fits_no_instance_type():
+    plans = plan_capacity(template(task_definition(12288, cpu=4096),
+                                   ("t2.large", "t2.xlarge")))
+
+    errors = dict((plan.instance_type, plan.errors()) for plan in plans)
+    assert errors["t2.large"] == [
+        "AppTask does not fit on t2.large (%s, %s)" % (CPU, MEMORY)]
+    assert errors["t2.xlarge"] == []
+    large = [plan for plan in plans if plan.instance_type == "t2.large"][0]
+    assert large.fleets == []
+
+
+def test_plan_warns_when_peak_exceeds_cluster_max_size():
+    plan, = plan_capacity(template(task_definition(1024, host_port=80),
+                                   desired_count=6))
+
+    assert plan.errors() == []
+    assert plan.warnings() == [
+        "the peak needs 6 t2.large hosts, ClusterMaxSize is 4"]
@@ -0,0 +1,52 @@
+import pytest
+
+from stack.config import Config
+from tools.matrix import build_setting
+
+
+@pytest.mark.parametrize("environ", [
+    {"BIGID_LOAD_BALANCER": "gateway"},
+    {"BIGID_DYNAMIC_HOST_PORTS": "1", "BIGID_LOAD_BALANCER": "classic"},
+    {"BIGID_SPLIT_SERVICES": "1", "BIGID_SSM_AMIS": "1",
+     "BIGID_LOAD_BALANCER": "classic"},
+    {"BIGID_SPLIT_SERVICES": "1"},
+    {"BIGID_ON_DEMAND_SCANNER": "1"},
+    {"BIGID_MONGO_REPLICAS": "2"},
+    {"BIGID_MONGO_REPLICAS": "0"},
+])
+def test_from_environ_rejects_invalid_combinations(environ):
+    with pytest.raises(ValueError):
+        Config.from_environ(environ)
+
+
+def test_from_environ_defaults_to_elbv2_for_split_services():
+    config = Config.from_environ({
+        "BIGID_SPLIT_SERVICES": "yes",
+        "BIGID_SSM_AMIS": " True ",
+    })
+
+    assert config.split_services
+    assert config.load_balancer_type == "elbv2"
+
+
+def test_from_environ_defaults():
+    config = Config.from_environ({})
+
+    assert config.load_balancer_type == "classic"
+    assert config.mongo_replicas == 1
+    assert config.compact
+
+
+@pytest.mark.parametrize("value, setting", [
+    (True, "true"),
+    (False, "false"),
+    (3, "3"),
+    ("1", "1"),
+])
+def test_build_setting_reads_json_scalars(value, setting):
+    assert build_setting("env.json", "BIGID_MONITORING", value) == setting
+
+
+def test_build_setting_rejects_other_values():
+    with pytest.raises(ValueError):
+        build_setting("env.json", "BIGID_MONITORING", ["1"])
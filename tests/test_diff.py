@@ -0,0 +1,152 @@
+import copy
+
+from tools.diff import (
+    INTERRUPTION,
+    NO_INTERRUPTION,
+    REPLACEMENT,
+    ROLLING,
+    UNKNOWN,
+    diff_resources,
+)
+
+
+def launch_template_resources(user_data="echo one\n"):
+    return {
+        "LaunchTemplate": {
+            "Type": "AWS::EC2::LaunchTemplate",
+            "Properties": {
+                "LaunchTemplateData": {
+                    "InstanceType": "t2.large",
+                    "UserData": {"Fn::Base64": {"Fn::Join": ["", [
+                        "#!/bin/bash\n", user_data]]}},
+                },
+            },
+        },
+        "Group": {
+            "Type": "AWS::AutoScaling::AutoScalingGroup",
+            "Properties": {
+                "MinSize": "1",
+                "MaxSize": "4",
+                "MixedInstancesPolicy": {"LaunchTemplate": {
+                    "LaunchTemplateSpecification": {
+                        "LaunchTemplateId": {"Ref": "LaunchTemplate"},
+                        "Version": {"Fn::GetAtt": [
+                            "LaunchTemplate", "LatestVersionNumber"]},
+                    },
+                }},
+            },
+            "UpdatePolicy": {"AutoScalingRollingUpdate": {
+                "MinInstancesInService": "1",
+            }},
+        },
+    }
+
+
+def changes_by_title(old, new, imports=None):
+    return dict((change.title, change)
+                for change in diff_resources(old, new, imports))
+
+
+def test_launch_template_update_rolls_the_group():
+    changes = changes_by_title(
+        launch_template_resources(),
+        launch_template_resources(user_data="echo two\n"))
+
+    assert changes["LaunchTemplate"].behavior == NO_INTERRUPTION
+    group = changes["Group"]
+    assert group.behavior == ROLLING
+    policy = group.properties["MixedInstancesPolicy"]
+    assert policy.cause == "LaunchTemplate"
+    assert policy.cause_attributes == ["LatestVersionNumber"]
+
+
+def test_launch_template_update_without_rolling_update_keeps_instances():
+    old = launch_template_resources()
+    new = launch_template_resources(user_data="echo two\n")
+    del new["Group"]["UpdatePolicy"]
+    del old["Group"]["UpdatePolicy"]
+
+    changes = changes_by_title(old, new)
+
+    assert changes["Group"].behavior == NO_INTERRUPTION
+
+
+def test_launch_template_update_through_nested_stack_import():
+    # The group's layer reads the version as a parameter the parent
+    # passes from the template's layer output
+    old = launch_template_resources()
+    new = launch_template_resources(user_data="echo two\n")
+    for resources in (old, new):
+        spec = resources["Group"]["Properties"]["MixedInstancesPolicy"][
+            "LaunchTemplate"]["LaunchTemplateSpecification"]
+        spec["Version"] = {"Ref": "LaunchTemplateLatestVersionNumber"}
+    imports = {"LaunchTemplateLatestVersionNumber": {
+        ("LaunchTemplate", "LatestVersionNumber")}}
+
+    changes = changes_by_title(old, new, imports)
+
+    assert changes["Group"].behavior == ROLLING
+
+
+def test_attribute_change_does_not_follow_plain_ref():
+    old = launch_template_resources()
+    new = launch_template_resources(user_data="echo two\n")
+    for resources in (old, new):
+        spec = resources["Group"]["Properties"]["MixedInstancesPolicy"][
+            "LaunchTemplate"]["LaunchTemplateSpecification"]
+        spec["Version"] = "1"
+
+    changes = changes_by_title(old, new)
+
+    assert "Group" not in changes
+
+
+def test_replacement_follows_references():
+    old = {
+        "Task": {
+            "Type": "AWS::ECS::TaskDefinition",
+            "Properties": {"ContainerDefinitions": [{"Memory": "1024"}]},
+        },
+        "Service": {
+            "Type": "AWS::ECS::Service",
+            "Properties": {"TaskDefinition": {"Ref": "Task"}},
+        },
+    }
+    new = copy.deepcopy(old)
+    new["Task"]["Properties"]["ContainerDefinitions"][0]["Memory"] = "2048"
+
+    changes = changes_by_title(old, new)
+
+    assert changes["Task"].behavior == REPLACEMENT
+    assert changes["Service"].behavior == ROLLING
+    assert changes["Service"].properties["TaskDefinition"].cause == "Task"
+
+
+def test_user_data_inside_base64_is_resolved():
+    old = {"Host": {
+        "Type": "AWS::EC2::Instance",
+        "Properties": {"UserData": {"Fn::Base64": {"Fn::Join": ["", [
+            "echo one\n"]]}}},
+    }}
+    new = copy.deepcopy(old)
+    new["Host"]["Properties"]["UserData"]["Fn::Base64"]["Fn::Join"][1] = [
+        "echo two\n"]
+
+    changes = changes_by_title(old, new)
+
+    assert changes["Host"].behavior == INTERRUPTION
+
+
+def test_changed_reference_is_unknown():
+    old = {"Host": {
+        "Type": "AWS::EC2::Instance",
+        "Properties": {"ImageId": "ami-1"},
+    }}
+    new = copy.deepcopy(old)
+    new["Host"]["Properties"]["ImageId"] = {"Ref": "ImageId"}
+
+    changes = changes_by_title(old, new)
+
+    assert changes["Host"].behavior == UNKNOWN
+    assert changes["Host"].properties["ImageId"].paths == [
+        "ImageId (unresolved)"]
@@ -0,0 +1,169 @@
+import pytest
+
+from stack.config import Config
+from stack.nested import split_template
+from stack.template import build_template
+
+
+def template():
+    return {
+        "Description": "BigID",
+        "Parameters": {
+            "VpcId": {"Type": "AWS::EC2::VPC::Id"},
+            "Subnets": {"Type": "List<AWS::EC2::Subnet::Id>"},
+            "ImageId": {
+                "Type": "AWS::SSM::Parameter::Value<AWS::EC2::Image::Id>",
+                "Default": "/aws/service/ecs/optimized-ami",
+            },
+        },
+        "Resources": {
+            "LoadBalancerSecurityGroup": {
+                "Type": "AWS::EC2::SecurityGroup",
+                "Properties": {"VpcId": {"Ref": "VpcId"}},
+            },
+            "LoadBalancer": {
+                "Type": "AWS::ElasticLoadBalancingV2::LoadBalancer",
+                "Properties": {
+                    "Subnets": {"Ref": "Subnets"},
+                    "SecurityGroups": [{"Ref": "LoadBalancerSecurityGroup"}],
+                },
+            },
+            "ECSCluster": {"Type": "AWS::ECS::Cluster"},
+            "LaunchTemplate": {
+                "Type": "AWS::EC2::LaunchTemplate",
+                "Properties": {"LaunchTemplateData": {
+                    "ImageId": {"Ref": "ImageId"},
+                    "UserData": {"Fn::Base64": {"Fn::Sub":
+                        "echo ECS_CLUSTER=${ECSCluster} >> /etc/ecs"}},
+                }},
+            },
+            "AppTask": {
+                "Type": "AWS::ECS::TaskDefinition",
+                "Properties": {"ContainerDefinitions": []},
+            },
+            "AppService": {
+                "Type": "AWS::ECS::Service",
+                "DependsOn": ["LoadBalancer", "AppTask"],
+                "Properties": {
+                    "Cluster": {"Ref": "ECSCluster"},
+                    "TaskDefinition": {"Ref": "AppTask"},
+                    "Tags": [{"Key": "LoadBalancer", "Value": {
+                        "Fn::GetAtt": ["LoadBalancer", "DNSName"]}}],
+                },
+            },
+        },
+        "Outputs": {
+            "URL": {"Value": {"Fn::Join": ["", [
+                "http://", {"Fn::GetAtt": ["LoadBalancer", "DNSName"]}]]}},
+        },
+    }
+
+
+def test_resources_go_to_their_layers():
+    parent, nested = split_template(template())
+
+    assert list(nested) == ["Network", "Cluster", "Services"]
+    assert sorted(nested["Network"]["Resources"]) == [
+        "LoadBalancer", "LoadBalancerSecurityGroup"]
+    assert sorted(nested["Services"]["Resources"]) == [
+        "AppService", "AppTask"]
+    assert sorted(parent["Resources"]) == [
+        "ClusterStack", "NetworkStack", "ServicesStack"]
+
+
+def test_cross_layer_references_become_parameters_and_outputs():
+    parent, nested = split_template(template())
+
+    service = nested["Services"]["Resources"]["AppService"]
+    assert service["Properties"]["Cluster"] == {"Ref": "ECSCluster"}
+    assert service["Properties"]["TaskDefinition"] == {"Ref": "AppTask"}
+    assert service["Properties"]["Tags"][0]["Value"] == {
+        "Ref": "LoadBalancerDNSName"}
+    assert nested["Services"]["Parameters"]["LoadBalancerDNSName"] == {
+        "Type": "String"}
+
+    assert nested["Network"]["Outputs"]["LoadBalancerDNSName"] == {
+        "Value": {"Fn::GetAtt": ["LoadBalancer", "DNSName"]}}
+    assert nested["Cluster"]["Outputs"]["ECSCluster"] == {
+        "Value": {"Ref": "ECSCluster"}}
+
+    stack = parent["Resources"]["ServicesStack"]
+    assert stack["Properties"]["Parameters"]["LoadBalancerDNSName"] == {
+        "Fn::GetAtt": ["NetworkStack", "Outputs.LoadBalancerDNSName"]}
+    assert stack["Properties"]["Parameters"]["ECSCluster"] == {
+        "Fn::GetAtt": ["ClusterStack", "Outputs.ECSCluster"]}
+    assert stack["DependsOn"] == ["ClusterStack", "NetworkStack"]
+
+
+def test_same_layer_dependencies_stay_in_the_child():
+    parent, nested = split_template(template())
+
+    service = nested["Services"]["Resources"]["AppService"]
+    assert service["DependsOn"] == ["AppTask"]
+
+
+def test_sub_references_to_other_layers_are_rewritten():
+    template_dict = template()
+    template_dict["Resources"]["LaunchTemplate"]["Properties"][
+        "LaunchTemplateData"]["UserData"] = {"Fn::Base64": {"Fn::Sub":
+            "echo ${LoadBalancer.DNSName} ${ECSCluster}"}}
+
+    parent, nested = split_template(template_dict)
+
+    data = nested["Cluster"]["Resources"]["LaunchTemplate"]["Properties"][
+        "LaunchTemplateData"]
+    assert data["UserData"] == {"Fn::Base64": {"Fn::Sub":
+        "echo ${LoadBalancerDNSName} ${ECSCluster}"}}
+    assert "LoadBalancerDNSName" in nested["Cluster"]["Parameters"]
+
+
+def test_parameters_are_passed_down():
+    parent, nested = split_template(template())
+
+    # SSM parameters are resolved by the parent, lists are joined
+    assert nested["Cluster"]["Parameters"]["ImageId"] == {
+        "Type": "AWS::EC2::Image::Id"}
+    network = parent["Resources"]["NetworkStack"]["Properties"]
+    assert network["Parameters"]["Subnets"] == {
+        "Fn::Join": [",", {"Ref": "Subnets"}]}
+    assert network["Parameters"]["VpcId"] == {"Ref": "VpcId"}
+    assert parent["Parameters"] == template()["Parameters"]
+
+
+def test_root_outputs_pass_through_the_owning_layer():
+    parent, nested = split_template(template())
+
+    assert parent["Outputs"]["URL"] == {"Value": {"Fn::Join": ["", [
+        "http://",
+        {"Fn::GetAtt": ["NetworkStack", "Outputs.LoadBalancerDNSName"]},
+    ]]}}
+    assert "LoadBalancerDNSName" in nested["Network"]["Outputs"]
+
+
+def test_unknown_resource_type_is_rejected():
+    template_dict = template()
+    template_dict["Resources"]["Queue"] = {"Type": "AWS::SQS::Queue"}
+
+    with pytest.raises(ValueError):
+        split_template(template_dict)
+
+
+@pytest.mark.parametrize("config", [
+    Config(),
+    Config(split_services=True, ssm_amis=True, launch_template=True,
+           monitoring=True, mongo_replicas=3),
+    Config(on_demand_scanner=True, ssm_amis=True, dynamic_host_ports=True,
+           vpc_endpoints=True, mongo_data_volume=True),
+])
+def test_every_child_parameter_is_passed(config):
+    parent, nested = split_template(build_template(config).to_dict())
+
+    for layer, child in nested.items():
+        stack = parent["Resources"]["%sStack" % layer]["Properties"]
+        passed = stack.get("Parameters", {})
+        assert sorted(passed) == sorted(child.get("Parameters", {}))
+        for value in passed.values():
+            if "Fn::GetAtt" in value:
+                producer, output = value["Fn::GetAtt"]
+                name = output[len("Outputs."):]
+                assert name in nested[producer[:-len("Stack")]]["Outputs"]
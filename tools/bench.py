@@ -0,0 +1,263 @@
+"""Benchmark template generation against a stored baseline.
+
+    python -m tools.bench [--save] [--baseline FILE]
+
+Measures, each the best of --repeat runs:
+
+- cold import time: a fresh interpreter importing stack.template, and
+  running the whole of create.py;
+- per build scenario, build_template() and to_json() time, the peak
+  memory Python allocates for both, and the size of the output;
+- a scaled scenario: the split-services template with every task
+  definition and service copied --scale times over, to show how
+  generation time grows with the number of resources. Each copy adds
+  ten resources; troposphere takes 500 at most. Past the first copies
+  the template is too large to deploy, so it only exercises the
+  generator.
+
+The results are compared with the baseline (benchmarks/baseline.json by
+default), and a metric more than --tolerance over it fails the run.
+--save records the results as the new baseline instead. Timings depend
+on the machine, so save the baseline where the comparison runs.
+
+To see where a build spends its time, create.py takes BIGID_PROFILE=FILE
+to write cProfile stats of the build to FILE (read them with `python -m
+pstats FILE`), and BIGID_TRACEMALLOC=N to print the N lines that
+allocated the most memory to stderr.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import timeit
+import tracemalloc
+from collections import OrderedDict
+
+from troposphere import Ref
+from troposphere.ecs import Service, TaskDefinition
+
+from stack.config import Config
+from stack.template import build_template
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+default_baseline = os.path.join(root, "benchmarks", "baseline.json")
+
+scenarios = [
+    ("default", {}),
+    ("split", {"split_services": True, "ssm_amis": True}),
+    ("full", {
+        "split_services": True, "dynamic_host_ports": True,
+        "fast_boot": True, "ssm_amis": True, "vpc_endpoints": True,
+        "launch_template": True, "on_demand_scanner": True,
+        "monitoring": True, "mongo_replicas": 3,
+    }),
+]
+
+# Below this a timing difference is noise, whatever the ratio
+min_seconds_change = 0.005
+
+import_statement = (
+    "import timeit; started = timeit.default_timer(); "
+    "import stack.template; print(timeit.default_timer() - started)"
+)
+
+
+def best(function, repeat):
+    # Fastest of repeat runs, and the last result
+    times = []
+    for _ in range(repeat):
+        started = timeit.default_timer()
+        result = function()
+        times.append(timeit.default_timer() - started)
+    return min(times), result
+
+
+def import_seconds(repeat):
+    times = []
+    for _ in range(repeat):
+        output = subprocess.check_output(
+            [sys.executable, "-c", import_statement], cwd=root)
+        times.append(float(output.decode("utf-8")))
+    return min(times)
+
+
+def create_seconds(repeat):
+    with open(os.devnull, "w") as devnull:
+        return best(lambda: subprocess.check_call(
+            [sys.executable, "create.py"], cwd=root, stdout=devnull,
+            stderr=devnull),
+            repeat)[0]
+
+
+def peak_memory(function):
+    # KiB Python allocated at most while function ran
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1] // 1024
+    finally:
+        tracemalloc.stop()
+
+
+def scaled_template(config, copies):
+    """Return the template built for config with every ECS task definition
+    and service added copies more times."""
+    template = build_template(config)
+    originals = list(template.resources.values())
+    for index in range(1, copies + 1):
+        task_definitions = {}
+        for resource in originals:
+            if isinstance(resource, TaskDefinition):
+                task_definitions[resource.title] = _copy(
+                    template, resource, index)
+        for resource in originals:
+            if isinstance(resource, Service):
+                original = resource.TaskDefinition.data["Ref"]
+                _copy(template, resource, index,
+                      TaskDefinition=Ref(task_definitions[original]))
+    return template
+
+
+def _copy(template, resource, index, **properties):
+    # Through the constructor, so the copy is validated like the original
+    properties = dict(resource.properties, **properties)
+    if "DependsOn" in resource.resource:
+        properties["DependsOn"] = resource.resource["DependsOn"]
+    return type(resource)("%s%d" % (resource.title, index),
+                          template=template, **properties)
+
+
+def measure_build(name, build, repeat):
+    metrics = OrderedDict()
+    build_time, template = best(build, repeat)
+    json_time, output = best(template.to_json, repeat)
+    metrics["%s resources" % name] = len(template.resources)
+    metrics["%s build_seconds" % name] = build_time
+    metrics["%s to_json_seconds" % name] = json_time
+    metrics["%s peak_kib" % name] = peak_memory(
+        lambda: build().to_json())
+    metrics["%s bytes" % name] = len(output)
+    return metrics
+
+
+def run(repeat, scale):
+    metrics = OrderedDict([
+        ("import stack.template seconds", import_seconds(repeat)),
+        ("create.py seconds", create_seconds(repeat)),
+    ])
+    for name, settings in scenarios:
+        config = Config(**settings)
+        metrics.update(measure_build(
+            name, lambda: build_template(config), repeat))
+    config = Config(**dict(scenarios)["split"])
+    for copies in scale:
+        metrics.update(measure_build(
+            "split x%d" % (copies + 1),
+            lambda: scaled_template(config, copies), repeat))
+    return metrics
+
+
+def regressions(baseline, metrics, tolerance):
+    found = []
+    for name in sorted(metrics):
+        if name not in baseline or name.endswith(" resources"):
+            continue
+        before, after = baseline[name], metrics[name]
+        if name.endswith("seconds") and \
+                after - before < min_seconds_change:
+            continue
+        if after > before * (1 + tolerance):
+            found.append(name)
+    return found
+
+
+def format_value(name, value):
+    if name.endswith("seconds"):
+        return "%.1fms" % (value * 1000)
+    if name.endswith("peak_kib"):
+        return "%.1fMiB" % (value / 1024.0)
+    return "%d" % value
+
+
+def profiled(function, profile_path=None, tracemalloc_top=0,
+             out=sys.stderr):
+    """Return function() run under cProfile, with its stats written to
+    profile_path, and/or tracemalloc, with the tracemalloc_top lines that
+    allocated the most written to out."""
+    if tracemalloc_top:
+        tracemalloc.start()
+    if profile_path:
+        import cProfile
+        profile = cProfile.Profile()
+        result = profile.runcall(function)
+        profile.dump_stats(profile_path)
+    else:
+        result = function()
+    if tracemalloc_top:
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        for stat in snapshot.statistics("lineno")[:tracemalloc_top]:
+            out.write("%s\n" % stat)
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m tools.bench",
+        description="Benchmark import, build and serialization of the "
+                    "templates against a stored baseline.")
+    parser.add_argument("--baseline", default=default_baseline,
+                        help="baseline JSON (default: %(default)s)")
+    parser.add_argument("--save", action="store_true",
+                        help="write the results as the baseline")
+    parser.add_argument("-n", "--repeat", type=int, default=5,
+                        help="runs per timing, the best counts "
+                             "(default: %(default)s)")
+    parser.add_argument("--scale", default="4,19,39",
+                        help="comma separated extra copies of the ECS "
+                             "resources for the scaled scenario "
+                             "(default: %(default)s)")
+    parser.add_argument("--tolerance", type=float, default=0.3,
+                        help="fraction over the baseline that fails "
+                             "(default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    scale = [int(copies) for copies in args.scale.split(",") if copies]
+    metrics = run(args.repeat, scale)
+
+    baseline = {}
+    if os.path.exists(args.baseline) and not args.save:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["Metrics"]
+    width = max(len(name) for name in metrics)
+    for name in metrics:
+        line = "%-*s %12s" % (width, name, format_value(name, metrics[name]))
+        if name in baseline and baseline[name]:
+            line += "  %12s %+6.0f%%" % (
+                format_value(name, baseline[name]),
+                (metrics[name] / float(baseline[name]) - 1) * 100)
+        print(line)
+
+    if args.save:
+        directory = os.path.dirname(args.baseline)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(args.baseline, "w") as f:
+            json.dump({"Python": sys.version.split()[0], "Metrics": metrics},
+                      f, indent=2, sort_keys=True)
+            f.write("\n")
+        print("saved %s" % args.baseline)
+        return 0
+
+    found = regressions(baseline, metrics, args.tolerance)
+    if found:
+        print("over the baseline by more than %d%%: %s" % (
+            args.tolerance * 100, ", ".join(found)))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,436 @@
+"""Check that the tasks of a rendered template fit their container instances.
+
+    python -m tools.capacity build/bigid.cfn.json [--parameters params.json]
+
+Each task definition is sized through ContainerSizingMap for every
+allowed InstanceType, plus the same-sized types of InstanceTypeOverrideMap
+a launch template falls back to. ECS places a task on a host only if:
+
+- the CPU units and memory reservations of its containers fit what the
+  host has left, after the OS and the ECS agent took their share;
+- none of its fixed host ports is taken yet, which with bridge
+  networking holds one copy of a task per host;
+- with awsvpc networking, the host still has an ENI to attach, one of
+  them being its own primary interface.
+
+For each type it reports how many copies of each task fit on a host and
+what stops the next one, then packs every service at its peak (the
+maximum of its scaling target, or its desired count) onto the fewest
+hosts and prices a fleet of each type, cheapest first.
+
+With the overrides of a MixedInstancesPolicy the group launches whatever
+mix of them Spot has, so the peak is also packed onto hosts that have
+the least CPU, memory and ENIs of all the candidates. That many hosts
+hold it in any mix; the "mixed" line prices them from all of the
+cheapest to all of the dearest type. Prices are on-demand, a Spot
+discount comes on top.
+
+A task that fits no host of an allowed type fails the check; a fleet
+larger than ClusterMaxSize, or hard memory limits the host can't back,
+only warn.
+
+A build directory is read as one template, the way tools.diff reads it.
+With --parameters the counts come from a deployment's parameters file,
+and only its InstanceType is planned if it sets one.
+"""
+import argparse
+import json
+import os
+import sys
+
+# Instance type -> (vCPUs, memory MiB, ENIs, on-demand USD/hour). Prices are
+# us-east-1 Linux; only their ratios matter for picking a fleet.
+instance_catalog = {
+    "m4.large": (2, 8192, 2, 0.100),
+    "m4.xlarge": (4, 16384, 4, 0.200),
+    "m5.large": (2, 8192, 3, 0.096),
+    "m5.xlarge": (4, 16384, 4, 0.192),
+    "m5a.large": (2, 8192, 3, 0.086),
+    "m5a.xlarge": (4, 16384, 4, 0.172),
+    "t2.large": (2, 8192, 3, 0.0928),
+    "t2.xlarge": (4, 16384, 3, 0.1856),
+    "t3.large": (2, 8192, 3, 0.0832),
+    "t3.xlarge": (4, 16384, 4, 0.1664),
+}
+
+# The kernel reports a few percent less than the nominal memory, and the
+# ECS agent registers only that
+registered_memory_ratio = 0.97
+
+# Kept for the agent itself, as stack.cluster.sizing budgets for
+agent_reserved_memory = 300
+
+CPU = "CPU"
+MEMORY = "memory"
+PORTS = "ports"
+ENIS = "ENIs"
+
+# Copies of one task tried on an empty host
+max_tasks_per_host = 100
+
+
+def load_template(path, parameters=None):
+    """Return the template at path as one dict of Parameters, Mappings and
+    Resources.
+
+    A build directory's parent and nested stacks are merged. The
+    defaults of the parameters in parameters (name -> value) are
+    replaced by their values.
+    """
+    if os.path.isdir(path):
+        paths = sorted(
+            os.path.join(path, name) for name in os.listdir(path)
+            if name.endswith(".cfn.json")
+        )
+    else:
+        paths = [path]
+    templates = []
+    for template_path in paths:
+        with open(template_path) as f:
+            templates.append(json.load(f))
+    return merge_templates(templates, parameters)
+
+
+def load_parameters(path):
+    # A CloudFormation parameters file like params.json
+    with open(path) as f:
+        return dict((p["ParameterKey"], p["ParameterValue"])
+                    for p in json.load(f))
+
+
+def merge_templates(templates, parameters=None):
+    # Children repeat the parameters they get from the parent, with the
+    # parent's defaults; the parent, the one with Stack resources, goes
+    # first
+    templates = sorted(templates, key=lambda t: not any(
+        r["Type"] == "AWS::CloudFormation::Stack"
+        for r in t.get("Resources", {}).values()
+    ))
+    merged = {"Parameters": {}, "Mappings": {}, "Resources": {}}
+    for template in templates:
+        for name, parameter in template.get("Parameters", {}).items():
+            merged["Parameters"].setdefault(name, dict(parameter))
+        merged["Mappings"].update(template.get("Mappings", {}))
+        for title, resource in template.get("Resources", {}).items():
+            if resource["Type"] != "AWS::CloudFormation::Stack":
+                merged["Resources"][title] = resource
+    for name, value in (parameters or {}).items():
+        if name in merged["Parameters"]:
+            merged["Parameters"][name]["Default"] = value
+    return merged
+
+
+def resolve(value, template, instance_type):
+    # The value a Ref or FindInMap has with InstanceType set to
+    # instance_type and every other parameter at its default
+    if isinstance(value, dict) and len(value) == 1:
+        (function, argument), = value.items()
+        if function == "Ref":
+            if argument == "InstanceType":
+                return instance_type
+            return template["Parameters"].get(argument, {}).get("Default")
+        if function == "Fn::FindInMap":
+            name, key, field = [resolve(a, template, instance_type)
+                                for a in argument]
+            return template["Mappings"][name][key][field]
+    return value
+
+
+class Task(object):
+    # The placement needs of one task definition on one instance type
+
+    def __init__(self, title, definition, template, instance_type):
+        properties = definition["Properties"]
+        self.title = title
+        self.awsvpc = properties.get("NetworkMode") == "awsvpc"
+        self.cpu = self.memory = self.memory_limit = 0
+        self.ports = set()
+        for container in properties["ContainerDefinitions"]:
+            def number(key):
+                return int(resolve(container.get(key, 0), template,
+                                   instance_type) or 0)
+            self.cpu += number("Cpu")
+            self.memory_limit += number("Memory")
+            # Placed by the reservation where there is one
+            self.memory += number("MemoryReservation") or number("Memory")
+            if self.awsvpc:
+                # Each task gets its own ENI and so its own ports
+                continue
+            for mapping in container.get("PortMappings", []):
+                port = int(resolve(mapping.get("HostPort", 0), template,
+                                   instance_type) or 0)
+                if port:
+                    self.ports.add((port, mapping.get("Protocol", "tcp")))
+
+
+class Host(object):
+
+    def __init__(self, instance_type):
+        # A tuple of types is a host that may be any of them, with the
+        # least of each resource and the highest price
+        types = instance_type if isinstance(instance_type, tuple) \
+            else (instance_type,)
+        specs = [instance_catalog[t] for t in types]
+        vcpus, memory, enis = [min(values) for values in zip(*specs)][:3]
+        self.price = max(spec[3] for spec in specs)
+        self.instance_type = instance_type
+        self.cpu = vcpus * 1024
+        self.memory = int(memory * registered_memory_ratio) - \
+            agent_reserved_memory
+        self.enis = enis - 1
+        self.ports = set()
+        self.tasks = []
+
+    def blockers(self, task):
+        # What keeps task off this host, if anything
+        blockers = []
+        if task.cpu > self.cpu:
+            blockers.append(CPU)
+        if task.memory > self.memory:
+            blockers.append(MEMORY)
+        if task.ports & self.ports:
+            blockers.append(PORTS)
+        if task.awsvpc and not self.enis:
+            blockers.append(ENIS)
+        return blockers
+
+    def place(self, task):
+        self.cpu -= task.cpu
+        self.memory -= task.memory
+        self.ports |= task.ports
+        if task.awsvpc:
+            self.enis -= 1
+        self.tasks.append(task)
+
+    @property
+    def memory_limit(self):
+        return sum(task.memory_limit for task in self.tasks)
+
+
+def tasks_per_host(task, instance_type):
+    """Return how many copies of task fit on an empty host of
+    instance_type, and what stops the next one."""
+    host = Host(instance_type)
+    while len(host.tasks) < max_tasks_per_host:
+        blockers = host.blockers(task)
+        if blockers:
+            return len(host.tasks), blockers
+        host.place(task)
+    return len(host.tasks), []
+
+
+def pack(tasks, instance_type):
+    """Return the hosts of instance_type that tasks fill, first fit
+    decreasing by memory, or None if one of them fits no host."""
+    hosts = []
+    for task in sorted(tasks, key=lambda t: (t.memory, t.cpu, t.title),
+                       reverse=True):
+        for host in hosts:
+            if not host.blockers(task):
+                break
+        else:
+            host = Host(instance_type)
+            if host.blockers(task):
+                return None
+            hosts.append(host)
+        host.place(task)
+    return hosts
+
+
+def candidate_types(template, instance_type):
+    # The types an Auto Scaling group may launch for InstanceType
+    overrides = template["Mappings"].get("InstanceTypeOverrideMap", {})
+    return [instance_type] + [
+        overrides[instance_type][key]
+        for key in sorted(overrides.get(instance_type, {}))
+    ]
+
+
+def peak_counts(template, tasks=None):
+    """Return task definition -> copies running with every service at its
+    peak: its scaling target's maximum, or tasks if given, and else its
+    desired count."""
+    resources = template["Resources"]
+    scaled = {}
+    for resource in resources.values():
+        if resource["Type"] == "AWS::ApplicationAutoScaling::ScalableTarget":
+            properties = resource["Properties"]
+            for title in _referenced(properties["ResourceId"]):
+                scaled[title] = properties["MaxCapacity"] if tasks is None \
+                    else tasks
+    counts = {}
+    for title, resource in sorted(resources.items()):
+        if resource["Type"] != "AWS::ECS::Service":
+            continue
+        properties = resource["Properties"]
+        count = resolve(scaled.get(title, properties.get("DesiredCount", 1)),
+                        template, None)
+        task_definition = properties["TaskDefinition"]["Ref"]
+        counts[task_definition] = counts.get(task_definition, 0) + \
+            int(count or 0)
+    return counts
+
+
+def _referenced(value):
+    if isinstance(value, list):
+        return sum([_referenced(v) for v in value], [])
+    if isinstance(value, dict):
+        if "Fn::GetAtt" in value:
+            return [value["Fn::GetAtt"][0]]
+        if "Ref" in value:
+            return [value["Ref"]]
+        return sum([_referenced(v) for v in value.values()], [])
+    return []
+
+
+class Plan(object):
+    # The capacity of one InstanceType value
+
+    def __init__(self, template, instance_type, counts):
+        self.instance_type = instance_type
+        self.candidates = [t for t in candidate_types(template, instance_type)
+                           if t in instance_catalog]
+        self.counts = counts
+        self.tasks = dict(
+            (title, Task(title, template["Resources"][title], template,
+                         instance_type))
+            for title in counts
+        )
+        self.per_host = dict(
+            ((title, candidate), tasks_per_host(task, candidate))
+            for title, task in self.tasks.items()
+            for candidate in self.candidates
+        )
+        workload = [self.tasks[title] for title in sorted(counts)
+                    for _ in range(counts[title])]
+        # (USD/hour, instance type, hosts), cheapest first
+        self.fleets = []
+        for candidate in self.candidates:
+            hosts = pack(workload, candidate)
+            if hosts is not None:
+                self.fleets.append((
+                    sum(host.price for host in hosts), candidate, hosts))
+        self.fleets.sort(key=lambda fleet: (fleet[0], fleet[1]))
+        # (lowest USD/hour, highest USD/hour, hosts) of any mix of the
+        # candidates, see the module docstring
+        self.mixed_fleet = None
+        if len(self.candidates) > 1:
+            hosts = pack(workload, tuple(self.candidates))
+            if hosts is not None:
+                prices = [instance_catalog[c][3] for c in self.candidates]
+                self.mixed_fleet = (len(hosts) * min(prices),
+                                    len(hosts) * max(prices), hosts)
+        self.cluster_max_size = int(
+            resolve({"Ref": "ClusterMaxSize"}, template, None) or 0)
+
+    def errors(self):
+        return [
+            "%s does not fit on %s (%s)" % (title, candidate,
+                                            ", ".join(blockers))
+            for (title, candidate), (count, blockers)
+            in sorted(self.per_host.items()) if not count
+        ]
+
+    def warnings(self):
+        warnings = []
+        for cost, candidate, hosts in self.fleets:
+            if self.cluster_max_size and \
+                    len(hosts) > self.cluster_max_size:
+                warnings.append(
+                    "the peak needs %d %s hosts, ClusterMaxSize is %d"
+                    % (len(hosts), candidate, self.cluster_max_size))
+        if self.mixed_fleet and self.cluster_max_size and \
+                len(self.mixed_fleet[2]) > self.cluster_max_size:
+            warnings.append(
+                "the peak needs %d hosts of a mixed fleet, ClusterMaxSize "
+                "is %d" % (len(self.mixed_fleet[2]), self.cluster_max_size))
+        if self.fleets:
+            cost, candidate, hosts = self.fleets[0]
+            available = Host(candidate).memory
+            for host in hosts:
+                if host.memory_limit > available:
+                    warnings.append(
+                        "hard memory limits of %s add up to %d MiB, %s has "
+                        "%d MiB for tasks"
+                        % (", ".join(t.title for t in host.tasks),
+                           host.memory_limit, candidate, available))
+                    break
+        return warnings
+
+    def format(self):
+        def cell(title, candidate):
+            count, blockers = self.per_host[(title, candidate)]
+            if blockers:
+                return "%d (%s)" % (count, ", ".join(blockers))
+            return "%d" % count
+
+        width = max([len("per host")] + [len(t) for t in self.tasks]) + 2
+        cell_width = max([len(c) for c in self.candidates] + [
+            len(cell(title, candidate)) for title, candidate in self.per_host
+        ]) + 2
+        lines = ["InstanceType %s:" % self.instance_type]
+        for title in ["per host"] + sorted(self.tasks):
+            cells = [candidate if title == "per host"
+                     else cell(title, candidate)
+                     for candidate in self.candidates]
+            lines.append(("  %-*s" % (width, title) + "".join(
+                "%-*s" % (cell_width, c) for c in cells)).rstrip())
+        lines.append("  peak: %s" % ", ".join(
+            "%d x %s" % (self.counts[title], title)
+            for title in sorted(self.counts)))
+        for index, (cost, candidate, hosts) in enumerate(self.fleets):
+            lines.append("  %-9s %d x %s, $%.2f/hour" % (
+                "cheapest:" if not index else "", len(hosts), candidate,
+                cost))
+        if self.mixed_fleet:
+            low, high, hosts = self.mixed_fleet
+            lines.append("  %-9s %d x any of %s, $%.2f-%.2f/hour" % (
+                "mixed:", len(hosts), ", ".join(self.candidates), low, high))
+        lines += ["  warning: %s" % w for w in self.warnings()]
+        lines += ["  error: %s" % e for e in self.errors()]
+        return lines
+
+
+def plan_capacity(template, deployed=False, tasks=None):
+    """Return a Plan per InstanceType template allows, or only for the one
+    its parameters are set to if deployed."""
+    parameter = template["Parameters"].get("InstanceType")
+    if parameter is None:
+        return []
+    if deployed or "AllowedValues" not in parameter:
+        instance_types = [parameter["Default"]]
+    else:
+        instance_types = parameter["AllowedValues"]
+    counts = peak_counts(template, tasks)
+    return [Plan(template, instance_type, counts)
+            for instance_type in instance_types]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m tools.capacity",
+        description="Check that the tasks of a rendered template fit every "
+                    "allowed InstanceType, and price the fleet for their "
+                    "peak.")
+    parser.add_argument("template",
+                        help="rendered template or build directory")
+    parser.add_argument("--parameters", metavar="FILE",
+                        help="parameters file whose values replace the "
+                             "defaults; with an InstanceType only that one "
+                             "is planned")
+    parser.add_argument("--tasks", type=int, metavar="N",
+                        help="copies of each autoscaled task at the peak "
+                             "(default: its scaling target's maximum)")
+    args = parser.parse_args(argv)
+
+    parameters = load_parameters(args.parameters) if args.parameters else {}
+    template = load_template(args.template, parameters)
+    plans = plan_capacity(template, "InstanceType" in parameters, args.tasks)
+    for plan in plans:
+        for line in plan.format():
+            print(line)
+    return 1 if any(plan.errors() for plan in plans) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
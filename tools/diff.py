@@ -0,0 +1,541 @@
+"""Predict what an update-stack would do, without calling AWS.
+
+    python -m tools.diff OLD NEW
+
+OLD and NEW are rendered templates, or build directories whose
+*.cfn.json files (a parent and its nested stacks) are read as one. Every
+resource is compared property by property, and each changed property is
+rated by how CloudFormation updates it:
+
+    Replacement     a new physical resource, the old one is deleted
+    Interruption    the resource is stopped and started again
+    Rolling         its instances or tasks are replaced in batches
+    NoInterruption  updated in place
+
+A replaced resource gets a new physical ID, so whatever references it
+through Ref, GetAtt or Sub changes with it; those follow-on updates are
+rated too. Some in-place updates change an attribute as well, e.g. a
+LaunchTemplate's LatestVersionNumber, and are followed to whatever reads
+that attribute.
+
+Values are compared as written. Fn::Base64, Fn::Join, Fn::Select,
+Fn::Split and Fn::Sub only rearrange what they are given, so they are
+compared argument by argument. Where a Ref, Fn::GetAtt, Fn::FindInMap,
+Fn::If or any other expression changed, e.g. a literal became a
+parameter, the value it resolves to may well be the same, so such a
+property is rated Unknown rather than by its update behavior, and its
+paths are marked "(unresolved)".
+"""
+import argparse
+import json
+import os
+import re
+import sys
+from collections import OrderedDict
+
+NO_INTERRUPTION = "NoInterruption"
+ROLLING = "Rolling"
+INTERRUPTION = "Interruption"
+REPLACEMENT = "Replacement"
+# A resource type missing from update_behaviors, or a property whose
+# changes are all in expressions only CloudFormation can resolve
+UNKNOWN = "Unknown"
+
+severity = [NO_INTERRUPTION, ROLLING, INTERRUPTION, UNKNOWN, REPLACEMENT]
+
+# Resource type -> property (a dotted path for nested ones) -> how an
+# update to it is carried out; other properties update without
+# interruption. "*" stands for every property. Taken from the "Update
+# requires" notes of the CloudFormation resource reference.
+update_behaviors = {
+    "AWS::ApplicationAutoScaling::ScalableTarget": {
+        "ResourceId": REPLACEMENT,
+        "ScalableDimension": REPLACEMENT,
+        "ServiceNamespace": REPLACEMENT,
+    },
+    "AWS::ApplicationAutoScaling::ScalingPolicy": {
+        "PolicyName": REPLACEMENT,
+        "ResourceId": REPLACEMENT,
+        "ScalableDimension": REPLACEMENT,
+        "ScalingTargetId": REPLACEMENT,
+        "ServiceNamespace": REPLACEMENT,
+    },
+    "AWS::AutoScaling::AutoScalingGroup": {
+        "AutoScalingGroupName": REPLACEMENT,
+        # Only with an AutoScalingRollingUpdate policy, see
+        # property_behavior
+        "LaunchConfigurationName": ROLLING,
+        "LaunchTemplate": ROLLING,
+        "MixedInstancesPolicy": ROLLING,
+        "VPCZoneIdentifier": ROLLING,
+    },
+    "AWS::AutoScaling::LaunchConfiguration": {
+        "*": REPLACEMENT,
+    },
+    "AWS::AutoScaling::ScalingPolicy": {},
+    "AWS::CloudFormation::Stack": {},
+    # Updates aren't supported at all
+    "AWS::CloudFormation::WaitCondition": {
+        "*": REPLACEMENT,
+    },
+    "AWS::CloudWatch::Alarm": {
+        "AlarmName": REPLACEMENT,
+    },
+    "AWS::CloudWatch::Dashboard": {
+        "DashboardName": REPLACEMENT,
+    },
+    "AWS::EC2::Instance": {
+        "AvailabilityZone": REPLACEMENT,
+        "BlockDeviceMappings": REPLACEMENT,
+        "CpuOptions": REPLACEMENT,
+        "ImageId": REPLACEMENT,
+        "KeyName": REPLACEMENT,
+        "LaunchTemplate": REPLACEMENT,
+        "NetworkInterfaces": REPLACEMENT,
+        "PlacementGroupName": REPLACEMENT,
+        "PrivateIpAddress": REPLACEMENT,
+        "SecurityGroups": REPLACEMENT,
+        "SubnetId": REPLACEMENT,
+        "Tenancy": REPLACEMENT,
+        # EBS-backed instances are stopped and started for these
+        "EbsOptimized": INTERRUPTION,
+        "InstanceType": INTERRUPTION,
+        "KernelId": INTERRUPTION,
+        "RamdiskId": INTERRUPTION,
+        "UserData": INTERRUPTION,
+    },
+    "AWS::EC2::LaunchTemplate": {
+        "LaunchTemplateName": REPLACEMENT,
+    },
+    "AWS::EC2::SecurityGroup": {
+        "GroupDescription": REPLACEMENT,
+        "GroupName": REPLACEMENT,
+        "VpcId": REPLACEMENT,
+    },
+    "AWS::EC2::VPCEndpoint": {
+        "ServiceName": REPLACEMENT,
+        "VpcEndpointType": REPLACEMENT,
+        "VpcId": REPLACEMENT,
+    },
+    "AWS::EC2::Volume": {
+        "AvailabilityZone": REPLACEMENT,
+        "Encrypted": REPLACEMENT,
+        "KmsKeyId": REPLACEMENT,
+        "SnapshotId": REPLACEMENT,
+    },
+    "AWS::EC2::VolumeAttachment": {
+        "*": REPLACEMENT,
+    },
+    "AWS::ECS::CapacityProvider": {
+        "AutoScalingGroupProvider.AutoScalingGroupArn": REPLACEMENT,
+        "Name": REPLACEMENT,
+    },
+    "AWS::ECS::Cluster": {
+        "ClusterName": REPLACEMENT,
+    },
+    "AWS::ECS::ClusterCapacityProviderAssociations": {
+        "Cluster": REPLACEMENT,
+    },
+    "AWS::ECS::Service": {
+        "Cluster": REPLACEMENT,
+        "DeploymentController": REPLACEMENT,
+        "LaunchType": REPLACEMENT,
+        "Role": REPLACEMENT,
+        "SchedulingStrategy": REPLACEMENT,
+        "ServiceName": REPLACEMENT,
+        # A new deployment, paced by the DeploymentConfiguration
+        "LoadBalancers": ROLLING,
+        "NetworkConfiguration": ROLLING,
+        "PlacementConstraints": ROLLING,
+        "PlacementStrategies": ROLLING,
+        "ServiceRegistries": ROLLING,
+        "TaskDefinition": ROLLING,
+    },
+    # Task definitions are immutable; any change registers a revision
+    "AWS::ECS::TaskDefinition": {
+        "*": REPLACEMENT,
+    },
+    "AWS::ElasticLoadBalancing::LoadBalancer": {
+        "LoadBalancerName": REPLACEMENT,
+        "Scheme": REPLACEMENT,
+    },
+    "AWS::ElasticLoadBalancingV2::Listener": {
+        "LoadBalancerArn": REPLACEMENT,
+    },
+    "AWS::ElasticLoadBalancingV2::LoadBalancer": {
+        "Name": REPLACEMENT,
+        "Scheme": REPLACEMENT,
+        "Type": REPLACEMENT,
+    },
+    "AWS::ElasticLoadBalancingV2::TargetGroup": {
+        "Name": REPLACEMENT,
+        "Port": REPLACEMENT,
+        "Protocol": REPLACEMENT,
+        "TargetType": REPLACEMENT,
+        "VpcId": REPLACEMENT,
+    },
+    "AWS::IAM::InstanceProfile": {
+        "InstanceProfileName": REPLACEMENT,
+        "Path": REPLACEMENT,
+    },
+    "AWS::IAM::Role": {
+        "Path": REPLACEMENT,
+        "RoleName": REPLACEMENT,
+    },
+    "AWS::Logs::LogGroup": {
+        "LogGroupName": REPLACEMENT,
+    },
+    "AWS::SNS::Subscription": {
+        "Endpoint": REPLACEMENT,
+        "Protocol": REPLACEMENT,
+        "TopicArn": REPLACEMENT,
+    },
+    "AWS::SNS::Topic": {
+        "FifoTopic": REPLACEMENT,
+        "TopicName": REPLACEMENT,
+    },
+    "AWS::ServiceDiscovery::Instance": {
+        "*": REPLACEMENT,
+    },
+    "AWS::ServiceDiscovery::PrivateDnsNamespace": {
+        "Name": REPLACEMENT,
+        "Vpc": REPLACEMENT,
+    },
+    "AWS::ServiceDiscovery::Service": {
+        "HealthCheckCustomConfig": REPLACEMENT,
+        "Name": REPLACEMENT,
+        "NamespaceId": REPLACEMENT,
+    },
+}
+
+# Resource type -> property -> the Fn::GetAtt attributes an in-place
+# update to it changes
+changed_attributes = {
+    # Each change to the data is a new version, made the default one
+    "AWS::EC2::LaunchTemplate": {
+        "LaunchTemplateData": ["DefaultVersionNumber", "LatestVersionNumber"],
+    },
+}
+
+# Intrinsic functions whose result follows from their arguments alone
+transparent_functions = {"Fn::Base64", "Fn::Join", "Fn::Select", "Fn::Split",
+                         "Fn::Sub"}
+
+_sub_reference = re.compile(r"\$\{([A-Za-z0-9]+)(?:\.([A-Za-z0-9.]+))?\}")
+
+
+def load_resources(path):
+    """Return the Resources of the template at path, and the resources
+    behind each value nested stacks pass each other.
+
+    A build directory holds a parent and its nested stacks, which are
+    read as one template.
+    """
+    if os.path.isdir(path):
+        paths = sorted(
+            os.path.join(path, name) for name in os.listdir(path)
+            if name.endswith(".cfn.json")
+        )
+    else:
+        paths = [path]
+    templates = []
+    for template_path in paths:
+        with open(template_path) as f:
+            templates.append(json.load(f))
+    return template_resources(templates)
+
+
+def template_resources(templates):
+    # With nested stacks their resources count, not the stacks. A layer
+    # imports another one's resource as a parameter named like the output
+    # it is passed from.
+    resources = {}
+    imports = {}
+    for template in templates:
+        for title, resource in template.get("Resources", {}).items():
+            if resource["Type"] != "AWS::CloudFormation::Stack" or \
+                    len(templates) == 1:
+                resources[title] = resource
+        if len(templates) > 1:
+            for name, output in template.get("Outputs", {}).items():
+                imports[name] = attribute_references(output["Value"])
+    return resources, imports
+
+
+def is_expression(value):
+    # A Ref, Condition or Fn:: intrinsic function
+    if not isinstance(value, dict) or len(value) != 1:
+        return False
+    (function, _), = value.items()
+    return function in ("Ref", "Condition") or function.startswith("Fn::")
+
+
+def changed_paths(old, new, path=""):
+    """Return (path, resolved) of each difference between old and new;
+    resolved is False where either side is an expression."""
+    if old == new:
+        return []
+    if is_expression(old) and is_expression(new) and \
+            list(old) == list(new) and list(old)[0] in transparent_functions:
+        function = list(old)[0]
+        return changed_paths(old[function], new[function], path)
+    if is_expression(old) or is_expression(new):
+        return [(path, False)]
+    if isinstance(old, dict) and isinstance(new, dict):
+        paths = []
+        for key in sorted(set(old) | set(new)):
+            paths += changed_paths(old.get(key), new.get(key),
+                                   "%s.%s" % (path, key) if path else key)
+        return paths
+    if isinstance(old, list) and isinstance(new, list) and \
+            len(old) == len(new):
+        paths = []
+        for index, (old_item, new_item) in enumerate(zip(old, new)):
+            paths += changed_paths(old_item, new_item,
+                                   "%s[%d]" % (path, index))
+        return paths
+    return [(path, True)]
+
+
+def attribute_references(value):
+    # (title, attribute) of what value refers to through Ref (attribute
+    # None), Fn::GetAtt or Fn::Sub
+    if isinstance(value, list):
+        return set().union(*[attribute_references(item) for item in value])
+    if not isinstance(value, dict):
+        return set()
+    if len(value) == 1:
+        (function, argument), = value.items()
+        if function == "Ref" and not argument.startswith("AWS::"):
+            return {(argument, None)}
+        if function == "Fn::GetAtt":
+            return {(argument[0], argument[1])}
+        if function == "Fn::Sub":
+            body = argument[0] if isinstance(argument, list) else argument
+            found = set((title, attribute or None) for title, attribute
+                        in _sub_reference.findall(body))
+            if isinstance(argument, list):
+                found |= attribute_references(argument[1])
+            return found
+    return set().union(*[attribute_references(item)
+                         for item in value.values()])
+
+
+def references(value):
+    # Titles value refers to through Ref, Fn::GetAtt or Fn::Sub
+    return set(title for title, _ in attribute_references(value))
+
+
+def property_behavior(resource, name):
+    behaviors = update_behaviors.get(resource["Type"])
+    if behaviors is None:
+        return UNKNOWN
+    if "*" in behaviors:
+        return behaviors["*"]
+    behavior = NO_INTERRUPTION
+    for path, path_behavior in behaviors.items():
+        if name == path or name.startswith(path + ".") or \
+                name.startswith(path + "["):
+            behavior = path_behavior
+    if behavior == ROLLING and \
+            resource["Type"] == "AWS::AutoScaling::AutoScalingGroup" and \
+            "AutoScalingRollingUpdate" not in resource.get("UpdatePolicy", {}):
+        # Existing instances keep their configuration
+        behavior = NO_INTERRUPTION
+    return behavior
+
+
+class PropertyChange(object):
+
+    def __init__(self, name, behavior, paths, cause=None,
+                 cause_attributes=None):
+        self.name = name
+        self.behavior = behavior
+        self.paths = paths
+        # Resource this change follows from: its replacement, or with
+        # cause_attributes the update of those attributes
+        self.cause = cause
+        self.cause_attributes = cause_attributes
+
+
+class ResourceChange(object):
+
+    def __init__(self, title, action, resource):
+        self.title = title
+        # "Add", "Remove" or "Modify"
+        self.action = action
+        self.type = resource["Type"]
+        self.resource = resource
+        self.properties = OrderedDict()
+        # Changes outside Properties (Metadata, UpdatePolicy, ...)
+        self.attributes = []
+
+    @property
+    def behavior(self):
+        if self.action != "Modify":
+            return None
+        behaviors = [p.behavior for p in self.properties.values()]
+        return max(behaviors or [NO_INTERRUPTION], key=severity.index)
+
+    @property
+    def replaced(self):
+        return self.action == "Modify" and self.behavior == REPLACEMENT
+
+    @property
+    def changed_attributes(self):
+        """None if every attribute changes, i.e. the resource is replaced,
+        else the attributes its in-place update changes."""
+        if self.replaced:
+            return None
+        names = set()
+        behaviors = changed_attributes.get(self.type, {})
+        for name in self.properties:
+            names.update(behaviors.get(name, ()))
+        return frozenset(names)
+
+    def add_property(self, change):
+        known = self.properties.get(change.name)
+        if known is None or severity.index(change.behavior) > \
+                severity.index(known.behavior):
+            self.properties[change.name] = change
+
+
+def diff_resources(old, new, imports=None):
+    """Return the ResourceChanges between two Resources dicts, most
+    disruptive first.
+
+    imports maps the parameters nested stacks import other layers'
+    resources by to those resources, as returned by load_resources.
+    """
+    imports = imports or {}
+    changes = OrderedDict()
+    for title in sorted(set(old) | set(new)):
+        if title not in new:
+            changes[title] = ResourceChange(title, "Remove", old[title])
+        elif title not in old:
+            changes[title] = ResourceChange(title, "Add", new[title])
+        elif old[title] != new[title]:
+            change = changes[title] = ResourceChange(title, "Modify",
+                                                     new[title])
+            if old[title]["Type"] != new[title]["Type"]:
+                change.add_property(PropertyChange(
+                    "Type", REPLACEMENT, ["Type"]))
+                continue
+            old_properties = old[title].get("Properties", {})
+            new_properties = new[title].get("Properties", {})
+            for name in sorted(set(old_properties) | set(new_properties)):
+                paths = changed_paths(old_properties.get(name),
+                                      new_properties.get(name), name)
+                if not paths:
+                    continue
+                behavior = property_behavior(new[title], name)
+                if behavior != NO_INTERRUPTION and \
+                        not any(resolved for _, resolved in paths):
+                    behavior = UNKNOWN
+                change.add_property(PropertyChange(
+                    name, behavior,
+                    [p if resolved else "%s (unresolved)" % p
+                     for p, resolved in paths]))
+            for attribute in sorted(set(old[title]) | set(new[title])):
+                if attribute not in ("Type", "Properties") and \
+                        old[title].get(attribute) != \
+                        new[title].get(attribute):
+                    change.attributes.append(attribute)
+
+    # Follow replacements, and updates that change attributes, to the
+    # resources referring to them, until nothing new turns up
+    pending = [(t, c.changed_attributes) for t, c in changes.items()
+               if c.action == "Modify"]
+    followed = set()
+    while pending:
+        cause, attributes = pending.pop()
+        if attributes == frozenset() or (cause, attributes) in followed:
+            continue
+        followed.add((cause, attributes))
+        for title, resource in new.items():
+            if title not in old or (title in changes and
+                                    changes[title].action != "Modify"):
+                continue
+            for name, value in resource.get("Properties", {}).items():
+                referenced = set()
+                for reference in attribute_references(value):
+                    referenced |= imports.get(reference[0], {reference})
+                read = set(attribute for referenced_title, attribute
+                           in referenced if referenced_title == cause)
+                if attributes is not None:
+                    read &= attributes
+                if not read:
+                    continue
+                change = changes.get(title)
+                if change is None:
+                    change = changes[title] = ResourceChange(
+                        title, "Modify", resource)
+                change.add_property(PropertyChange(
+                    name, property_behavior(resource, name), [name],
+                    cause=cause,
+                    cause_attributes=None if attributes is None
+                    else sorted(read)))
+                pending.append((title, change.changed_attributes))
+
+    return sorted(
+        changes.values(),
+        key=lambda c: (-severity.index(c.behavior or REPLACEMENT),
+                       c.action, c.title),
+    )
+
+
+def format_change(change):
+    if change.action == "Add":
+        return ["+ %s (%s)" % (change.title, change.type)]
+    if change.action == "Remove":
+        return ["- %s (%s)" % (change.title, change.type)]
+    lines = ["~ %s (%s): %s" % (change.title, change.type, change.behavior)]
+    for name, prop in sorted(change.properties.items(),
+                             key=lambda i: -severity.index(i[1].behavior)):
+        if prop.cause_attributes:
+            detail = "follows %s" % ", ".join(
+                "%s.%s" % (prop.cause, attribute)
+                for attribute in prop.cause_attributes)
+        elif prop.cause:
+            detail = "follows %s replacement" % prop.cause
+        else:
+            detail = ", ".join(prop.paths[:3])
+            if len(prop.paths) > 3:
+                detail += ", +%d more" % (len(prop.paths) - 3)
+        lines.append("    %-14s %s (%s)" % (prop.behavior, name, detail))
+    if change.attributes:
+        lines.append("    %-14s %s" % ("Attributes", ", ".join(
+            change.attributes)))
+    return lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m tools.diff",
+        description="Compare two rendered templates and predict which "
+                    "resources an update replaces or interrupts.")
+    parser.add_argument("old", help="deployed template or build directory")
+    parser.add_argument("new", help="new template or build directory")
+    parser.add_argument("--fail-on", choices=[INTERRUPTION, REPLACEMENT],
+                        help="exit with 1 if an update is this disruptive "
+                             "or more")
+    args = parser.parse_args(argv)
+
+    old, _ = load_resources(args.old)
+    new, imports = load_resources(args.new)
+    changes = diff_resources(old, new, imports)
+    for change in changes:
+        print("\n".join(format_change(change)))
+    if not changes:
+        print("No resource changes")
+
+    if args.fail_on:
+        threshold = severity.index(args.fail_on)
+        if any(c.action == "Modify" and
+               severity.index(c.behavior) >= threshold for c in changes):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,259 @@
+"""Estimate how long a create-stack takes and what it waits on.
+
+    python -m tools.graph build/bigid.cfn.json
+
+Builds the resource dependency graph of a rendered template from its
+DependsOn attributes and the Ref, GetAtt and Sub references between
+resources, which CloudFormation orders the same way. With a rough
+provisioning time per resource type it reports:
+
+- the critical path: the chain of resources the stack's create time is
+  made of;
+- the edges on it that hold the create up, and how much sooner the stack
+  would be done without each;
+- DependsOn edges another path already implies, which can go.
+
+Nested stacks hide the resources of their layers, so analyze a template
+rendered without BIGID_NESTED_STACKS.
+"""
+import argparse
+import json
+import re
+import sys
+
+# Rough create times (seconds) by resource type; unknown types count as
+# default_estimate. Resources with a CreationPolicy wait for their
+# instances to signal on top, which signal_estimate covers.
+provisioning_estimates = {
+    "AWS::ApplicationAutoScaling::ScalableTarget": 10,
+    "AWS::ApplicationAutoScaling::ScalingPolicy": 5,
+    "AWS::AutoScaling::AutoScalingGroup": 60,
+    "AWS::AutoScaling::LaunchConfiguration": 5,
+    "AWS::AutoScaling::ScalingPolicy": 5,
+    # Only waits for its signal
+    "AWS::CloudFormation::WaitCondition": 0,
+    "AWS::CloudWatch::Alarm": 5,
+    "AWS::CloudWatch::Dashboard": 5,
+    "AWS::EC2::Instance": 60,
+    "AWS::EC2::LaunchTemplate": 5,
+    "AWS::EC2::SecurityGroup": 5,
+    "AWS::EC2::VPCEndpoint": 90,
+    "AWS::EC2::Volume": 10,
+    "AWS::EC2::VolumeAttachment": 10,
+    "AWS::ECS::CapacityProvider": 10,
+    "AWS::ECS::Cluster": 10,
+    "AWS::ECS::ClusterCapacityProviderAssociations": 10,
+    # Until the service is stable, i.e. its tasks pass their checks
+    "AWS::ECS::Service": 150,
+    "AWS::ECS::TaskDefinition": 5,
+    "AWS::ElasticLoadBalancing::LoadBalancer": 30,
+    "AWS::ElasticLoadBalancingV2::Listener": 5,
+    "AWS::ElasticLoadBalancingV2::LoadBalancer": 180,
+    "AWS::ElasticLoadBalancingV2::TargetGroup": 5,
+    # Instance profiles take a while to propagate through IAM
+    "AWS::IAM::InstanceProfile": 120,
+    "AWS::IAM::Role": 15,
+    "AWS::Logs::LogGroup": 5,
+    "AWS::SNS::Subscription": 5,
+    "AWS::SNS::Topic": 10,
+    "AWS::ServiceDiscovery::Instance": 30,
+    # Creates a Route 53 private hosted zone
+    "AWS::ServiceDiscovery::PrivateDnsNamespace": 75,
+    "AWS::ServiceDiscovery::Service": 5,
+}
+
+default_estimate = 30
+
+# Boot, cfn-init and the UserData until cfn-signal
+signal_estimate = 240
+
+_sub_reference = re.compile(r"\$\{([A-Za-z0-9]+)(?:\.([A-Za-z0-9.]+))?\}")
+
+
+def reference_kinds(value, found=None):
+    # title -> how value refers to it: "Ref", "GetAtt <attribute>", "Sub"
+    if found is None:
+        found = {}
+    if isinstance(value, list):
+        for item in value:
+            reference_kinds(item, found)
+    elif isinstance(value, dict):
+        if len(value) == 1:
+            (function, argument), = value.items()
+            if function == "Ref":
+                found.setdefault(argument, set()).add("Ref")
+                return found
+            if function == "Fn::GetAtt":
+                found.setdefault(argument[0], set()).add(
+                    "GetAtt %s" % argument[1])
+                return found
+            if function == "Fn::Sub":
+                body = argument[0] if isinstance(argument, list) \
+                    else argument
+                for title, _ in _sub_reference.findall(body):
+                    found.setdefault(title, set()).add("Sub")
+                if isinstance(argument, list):
+                    reference_kinds(argument[1], found)
+                return found
+        for item in value.values():
+            reference_kinds(item, found)
+    return found
+
+
+class Graph(object):
+
+    def __init__(self, template):
+        resources = self.resources = template["Resources"]
+        parameters = template.get("Parameters", {})
+        # title -> dependency -> set of "DependsOn", "Ref", "GetAtt ..."
+        self.edges = {}
+        for title, resource in resources.items():
+            edges = self.edges[title] = {}
+            body = dict((k, v) for k, v in resource.items()
+                        if k != "DependsOn")
+            for dependency, kinds in reference_kinds(body).items():
+                # Parameters and pseudo parameters aren't resources
+                if dependency in resources and dependency not in parameters:
+                    edges[dependency] = kinds
+            depends_on = resource.get("DependsOn", [])
+            if not isinstance(depends_on, list):
+                depends_on = [depends_on]
+            for dependency in depends_on:
+                edges.setdefault(dependency, set()).add("DependsOn")
+        self.order = self.topological_order()
+
+    def topological_order(self):
+        order, state = [], {}
+
+        def visit(title, path):
+            if state.get(title) == "done":
+                return
+            if state.get(title) == "visiting":
+                raise ValueError("Dependency cycle: %s"
+                                 % " -> ".join(path + [title]))
+            state[title] = "visiting"
+            for dependency in sorted(self.edges[title]):
+                visit(dependency, path + [title])
+            state[title] = "done"
+            order.append(title)
+
+        for title in sorted(self.resources):
+            visit(title, [])
+        return order
+
+    def estimate(self, title):
+        resource = self.resources[title]
+        seconds = provisioning_estimates.get(resource["Type"],
+                                             default_estimate)
+        if "ResourceSignal" in resource.get("CreationPolicy", {}):
+            seconds += signal_estimate
+        return seconds
+
+    def finish_times(self, skip_edge=None):
+        # Earliest time each resource is done, with every resource started
+        # as soon as its dependencies are
+        finish = {}
+        for title in self.order:
+            start = max([
+                finish[dependency] for dependency in self.edges[title]
+                if (title, dependency) != skip_edge
+            ] or [0])
+            finish[title] = start + self.estimate(title)
+        return finish
+
+    def critical_path(self):
+        finish = self.finish_times()
+        title = max(self.order, key=lambda t: (finish[t], t))
+        path = [title]
+        while self.edges[path[-1]]:
+            path.append(max(self.edges[path[-1]],
+                            key=lambda d: (finish[d], d)))
+        return list(reversed(path)), finish
+
+    def implied(self, title, dependency):
+        # Whether dependency is reached from title through another edge
+        return any(
+            dependency == other or dependency in self._ancestors(other)
+            for other in self.edges[title] if other != dependency
+        )
+
+    def _ancestors(self, title):
+        cache = self.__dict__.setdefault("_ancestor_cache", {})
+        if title not in cache:
+            ancestors = set()
+            for dependency in self.edges[title]:
+                ancestors.add(dependency)
+                ancestors |= self._ancestors(dependency)
+            cache[title] = ancestors
+        return cache[title]
+
+    def redundant_depends_on(self):
+        return [
+            (title, dependency)
+            for title in sorted(self.edges)
+            for dependency, kinds in sorted(self.edges[title].items())
+            if kinds == {"DependsOn"} and self.implied(title, dependency)
+        ]
+
+    def serializing_edges(self, path, finish):
+        # Edges along the critical path, with what removing each would save
+        total = max(finish.values())
+        savings = []
+        for dependency, title in zip(path, path[1:]):
+            saved = total - max(self.finish_times((title, dependency))
+                                .values())
+            if saved > 0:
+                savings.append((saved, title, dependency))
+        return sorted(savings, reverse=True)
+
+
+def describe(kinds):
+    return ", ".join(sorted(kinds))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m tools.graph",
+        description="Report the provisioning critical path of a rendered "
+                    "template, and the dependencies that lengthen it.")
+    parser.add_argument("template", help="rendered template")
+    args = parser.parse_args(argv)
+
+    with open(args.template) as f:
+        template = json.load(f)
+    resources = template["Resources"]
+    graph = Graph(template)
+    path, finish = graph.critical_path()
+
+    print("Critical path, %d of %d resources, ~%ds:" % (
+        len(path), len(resources), finish[path[-1]]))
+    for index, title in enumerate(path):
+        via = ""
+        if index:
+            via = " via %s" % describe(graph.edges[title][path[index - 1]])
+        print("  %5ds  %-36s %s (+%ds%s)" % (
+            finish[title], title, resources[title]["Type"],
+            graph.estimate(title), via))
+
+    savings = graph.serializing_edges(path, finish)
+    print()
+    print("Dependencies holding up the critical path:")
+    for saved, title, dependency in savings:
+        print("  -%4ds  %s -> %s (%s)" % (
+            saved, title, dependency,
+            describe(graph.edges[title][dependency])))
+    if not savings:
+        print("  none")
+
+    redundant = graph.redundant_depends_on()
+    print()
+    print("DependsOn already implied by other dependencies:")
+    for title, dependency in redundant:
+        print("  %s -> %s" % (title, dependency))
+    if not redundant:
+        print("  none")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
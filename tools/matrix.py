@@ -0,0 +1,263 @@
+"""Render the templates of many environments at once.
+
+    python -m tools.matrix environments/*.json
+
+An environment file is either a CloudFormation parameters file like
+params.json, or an object with the build flags and parameters of one
+environment:
+
+    {
+        "Build": {"BIGID_MONITORING": "1", "BIGID_NESTED_STACKS": "1"},
+        "Parameters": [{"ParameterKey": "VPCID", "ParameterValue": "..."}]
+    }
+
+Build takes the same BIGID_* settings as create.py's environment. Each
+environment is rendered into matrix-build/<name>/ (bigid.cfn.json, its
+nested stacks and params.json), with <name> the file name without
+extension; bin/create.sh and bin/update.sh replace build/ on every run,
+so the matrix keeps out of it. Environments whose sources, build flags
+and parameters hash the same as on their last build are skipped; the
+rest are rendered in parallel. With
+--diff each re-rendered environment also lists the resources the update
+would replace or interrupt, as tools.diff rates them.
+
+Every rendered environment goes through the tools.capacity check, for
+its InstanceType if its parameters set one. An environment with a task
+that fits none of its instances is written but not marked built, and
+fails the run.
+"""
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+import troposphere
+
+from stack.config import Config
+from stack.template import render_template
+from tools.capacity import merge_templates, plan_capacity
+from tools.diff import (
+    INTERRUPTION,
+    diff_resources,
+    format_change,
+    severity,
+    template_resources,
+)
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Written last, so an interrupted build is redone on the next run
+manifest_name = "manifest.json"
+
+# The parent template, named as bin/create.sh names it; unlike the
+# environment's name it can't be one of the nested stacks' names
+template_name = "bigid.cfn.json"
+
+
+def source_digest():
+    # Everything that shapes the rendered templates, the diff and the
+    # capacity check besides the environment itself
+    digest = hashlib.sha256()
+    digest.update(troposphere.__version__.encode("utf-8"))
+    paths = [os.path.join(root, "tools", name)
+             for name in ("matrix.py", "diff.py", "capacity.py")]
+    for directory, _, files in os.walk(os.path.join(root, "stack")):
+        paths += [os.path.join(directory, f) for f in files
+                  if f.endswith(".py")]
+    for path in sorted(paths):
+        digest.update(os.path.relpath(path, root).encode("utf-8"))
+        with open(path, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def build_setting(path, name, value):
+    # Build values are read like environment variables, which are strings;
+    # JSON booleans and numbers are taken as they would be written there
+    if isinstance(value, (bool, int, float)):
+        return json.dumps(value)
+    if not isinstance(value, type(u"")) and not isinstance(value, str):
+        raise ValueError("%s: Build %s must be a string, number or boolean, "
+                         "not %s" % (path, name, json.dumps(value)))
+    return value
+
+
+class Environment(object):
+
+    def __init__(self, path, build_dir):
+        with open(path) as f:
+            spec = json.load(f)
+        if isinstance(spec, list):
+            spec = {"Parameters": spec}
+        self.name = os.path.splitext(os.path.basename(path))[0]
+        self.directory = os.path.join(build_dir, self.name)
+        self.flags = dict(
+            (name, build_setting(path, name, value))
+            for name, value in spec.get("Build", {}).items()
+        )
+        self.parameters = spec.get("Parameters", [])
+        # Validates the flags up front, before any worker starts
+        self.config = Config.from_environ(
+            dict(self.flags, BIGID_BUILD_DIR=self.directory))
+
+    def input_digest(self, sources):
+        settings = dict(vars(self.config))
+        del settings["build_dir"]
+        digest = hashlib.sha256(sources.encode("utf-8"))
+        digest.update(json.dumps([settings, self.parameters],
+                                 sort_keys=True).encode("utf-8"))
+        return digest.hexdigest()
+
+    def manifest(self):
+        try:
+            with open(os.path.join(self.directory, manifest_name)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def is_current(self, digest):
+        manifest = self.manifest()
+        return manifest.get("Inputs") == digest and all(
+            os.path.exists(os.path.join(self.directory, name))
+            for name in manifest.get("Files", [])
+        )
+
+
+def disruptive_changes(environment, files):
+    # Against the templates of the last build
+    previous = []
+    for name in environment.manifest().get("Files", []):
+        path = os.path.join(environment.directory, name)
+        if name.endswith(".cfn.json") and os.path.exists(path):
+            with open(path) as f:
+                previous.append(json.load(f))
+    if not previous:
+        return []
+    old, _ = template_resources(previous)
+    new, imports = template_resources([
+        json.loads(content) for name, content in files.items()
+        if name.endswith(".cfn.json")
+    ])
+    lines = []
+    for change in diff_resources(old, new, imports):
+        if change.action == "Modify" and severity.index(
+                change.behavior) >= severity.index(INTERRUPTION):
+            lines += format_change(change)
+    return lines
+
+
+def capacity_problems(environment, files):
+    parameters = dict((p["ParameterKey"], p["ParameterValue"])
+                      for p in environment.parameters)
+    # Checked for the environment's own InstanceType and counts
+    template = merge_templates([
+        json.loads(content) for name, content in files.items()
+        if name.endswith(".cfn.json")
+    ], parameters)
+    plans = plan_capacity(template, "InstanceType" in parameters)
+    warnings = ["%s: warning: %s" % (plan.instance_type, warning)
+                for plan in plans for warning in plan.warnings()]
+    errors = ["%s: error: %s" % (plan.instance_type, error)
+              for plan in plans for error in plan.errors()]
+    return warnings, errors
+
+
+def render(job):
+    environment, digest, diff = job
+    started = time.time()
+    template, nested = render_template(environment.config)
+
+    files = dict(nested)
+    files[template_name] = template
+    files["params.json"] = json.dumps(environment.parameters, indent=2)
+    changes = disruptive_changes(environment, files) if diff else []
+    warnings, errors = capacity_problems(environment, files)
+
+    if not os.path.isdir(environment.directory):
+        os.makedirs(environment.directory)
+    # Nested stacks the environment no longer has
+    for name in environment.manifest().get("Files", []):
+        if name not in files:
+            path = os.path.join(environment.directory, name)
+            if os.path.exists(path):
+                os.remove(path)
+    for name, content in files.items():
+        with open(os.path.join(environment.directory, name), "w") as f:
+            f.write(content + "\n")
+    if not errors:
+        with open(os.path.join(environment.directory, manifest_name),
+                  "w") as f:
+            json.dump({"Inputs": digest, "Files": sorted(files)}, f,
+                      indent=2)
+    return (environment.name, time.time() - started,
+            changes + warnings + errors, len(errors))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m tools.matrix",
+        description="Render the templates of many environments in parallel, "
+                    "skipping the ones whose inputs haven't changed.")
+    parser.add_argument("environments", nargs="+", metavar="ENVIRONMENT",
+                        help="environment or parameters JSON file")
+    parser.add_argument("--build-dir",
+                        default=os.path.join(root, "matrix-build"),
+                        help="directory the environments are rendered into "
+                             "(default: %(default)s)")
+    parser.add_argument("-j", "--jobs", type=int,
+                        default=multiprocessing.cpu_count(),
+                        help="worker processes (default: one per CPU)")
+    parser.add_argument("-f", "--force", action="store_true",
+                        help="render every environment, changed or not")
+    parser.add_argument("--diff", action="store_true",
+                        help="list the resources each update would replace "
+                             "or interrupt")
+    args = parser.parse_args(argv)
+
+    environments = [Environment(path, args.build_dir)
+                    for path in args.environments]
+    names = [e.name for e in environments]
+    duplicates = sorted(set(n for n in names if names.count(n) > 1))
+    if duplicates:
+        parser.error("environments share a name: %s" % ", ".join(duplicates))
+
+    sources = source_digest()
+    jobs = []
+    for environment in environments:
+        digest = environment.input_digest(sources)
+        if not args.force and environment.is_current(digest):
+            print("unchanged %s" % environment.name)
+        else:
+            jobs.append((environment, digest, args.diff))
+
+    started = time.time()
+    if len(jobs) > 1 and args.jobs > 1:
+        pool = multiprocessing.Pool(min(args.jobs, len(jobs)))
+        try:
+            results = list(pool.imap_unordered(render, jobs))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [render(job) for job in jobs]
+    failed = []
+    for name, seconds, lines, errors in sorted(results):
+        print("rendered  %s (%.1fs)" % (name, seconds))
+        for line in lines:
+            print("    " + line)
+        if errors:
+            failed.append(name)
+
+    print("%d rendered, %d unchanged in %.1fs" % (
+        len(jobs), len(environments) - len(jobs), time.time() - started))
+    if failed:
+        print("capacity check failed: %s" % ", ".join(failed))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())